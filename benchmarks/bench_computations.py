@@ -0,0 +1,211 @@
+"""Benchmark the computations of the derived fields (plotting/computations.py).
+
+- Smoothing: mslp smoothed frame by frame with metpy.calc.smooth_n_point, as the
+  plotting scripts did in plot_files, and with computations.smooth_n_point on all
+  the time steps at once, as they do now once per run (see utils.read_derived).
+  Reported are the largest difference and the time per frame.
+- De-accumulation: the rain rate computed by loading the whole accumulated field
+  and differentiating it, as compute_rate did, and with computations.deaccumulate
+  chunk by chunk, written into the derived cache (field_cache.write_dataset).
+  Reported are the time and the peak memory allocated (traced by tracemalloc)
+  for a growing number of forecast steps.
+- Thermodynamics: equivalent potential temperature (with the dewpoint), wind
+  speed and geopotential height of a cube of 4 pressure levels, computed with
+  metpy.calc on the DataArrays (through pint) as computations.py did, and with
+  thermo.py as it does now. Reported are the times and the largest difference.
+- Kinematics: divergence, vorticity, total deformation and temperature advection
+  on the same cube, with metpy.calc on the DataArrays (computing the grid deltas
+  and map factors every time) and with kinematics.py on the grid metrics computed
+  once. Reported are the times and the largest difference relative to the largest
+  value. The time to compute the grid metrics and to load them from disk is also
+  reported.
+
+Synthetic fields with the size of the cropped ICON-D2 domain are used.
+
+    python benchmarks/bench_computations.py --steps 49
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import metpy.calc as mpcalc
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'plotting'))
+import field_cache
+import kinematics
+import thermo
+from computations import compute_geopot_height, compute_thetae, compute_wind_speed, deaccumulate, smooth_n_point
+from metpy.units import units
+
+
+def mslp_field(steps, shape=(675, 625)):
+    y, x = np.mgrid[0:shape[0], 0:shape[1]]
+    field = 101300 + 1500 * np.sin(y / 90.) * np.cos(x / 120.)
+    data = field + np.random.normal(scale=30, size=(steps,) + shape)
+    return data.astype(np.float32)
+
+
+def accumulated_field(steps, shape=(675, 625)):
+    """Accumulated precipitation, lazy as read_dataset returns it"""
+    times = pd.date_range('2021-01-01', periods=steps, freq='1h')
+    rate = np.random.gamma(0.3, 2., size=(steps,) + shape).astype(np.float32)
+    return xr.DataArray(np.cumsum(rate, axis=0), name='RAIN_GSP', dims=('time', 'lat', 'lon'),
+                        coords={'time': times}).chunk({'time': 1})
+
+
+def rate_loaded(acc, folder):
+    rate = acc.load().differentiate(coord='time', datetime_unit='h')
+    field_cache.write_dataset(folder, xr.Dataset({'rain_rate': rate}))
+
+
+def rate_chunked(acc, folder):
+    rate = deaccumulate(acc, 'rate')
+    field_cache.write_dataset(folder, xr.Dataset({'rain_rate': rate}))
+
+
+def measure_memory(function, acc):
+    """Time and peak memory allocated by function(acc, folder)"""
+    folder = tempfile.mkdtemp()
+    try:
+        # the input is computed in memory by both, don't count it
+        values = acc.copy(data=acc.values).chunk({'time': 1})
+        tracemalloc.start()
+        start = time.perf_counter()
+        function(values, os.path.join(folder, 'rate'))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(folder)
+    return elapsed, peak
+
+
+def pressure_levels(steps, shape=(675, 625)):
+    """Temperature, relative humidity, wind and geopotential on 4 levels"""
+    plev = np.array([95000., 85000., 70000., 50000.])
+    size = (steps, len(plev)) + shape
+    coords = {'time': pd.date_range('2021-01-01', periods=steps, freq='1h'), 'plev': plev,
+              'lat': np.linspace(43, 56.48, shape[0]), 'lon': np.linspace(4, 16.48, shape[1])}
+    dims = ('time', 'plev', 'lat', 'lon')
+    t = 300 - 60 * (1 - plev[:, None, None] / 1e5) + np.random.normal(scale=5, size=size)
+    fields = {'t': (t, 'K'), 'r': (np.random.uniform(5, 100, size), '%'),
+              'u': (np.random.normal(scale=10, size=size), 'm s-1'),
+              'v': (np.random.normal(scale=10, size=size), 'm s-1'),
+              'z': (9.80665 * (1500 + 4000 * (1 - plev[:, None, None] / 1e5))
+                    + np.random.normal(scale=50, size=size), 'm**2 s**-2')}
+    dset = xr.Dataset({name: (dims, values.astype(np.float32), {'units': unit})
+                       for name, (values, unit) in fields.items()}, coords=coords)
+    dset['plev'].attrs['units'] = 'Pa'
+    return dset
+
+
+def metpy_thetae(dset):
+    """As compute_thetae did, with pint quantities (but at the actual levels)"""
+    td = mpcalc.dewpoint_from_relative_humidity(dset['t'], dset['r'].metpy.convert_units('dimensionless'))
+    theta_e = mpcalc.equivalent_potential_temperature(dset['plev'] * units.Pa, dset['t'], td)
+    return theta_e.metpy.convert_units('degC').metpy.dequantify().transpose(*dset['t'].dims)
+
+
+def metpy_wind_speed(dset):
+    return mpcalc.wind_speed(dset['u'], dset['v']).metpy.convert_units('kph').metpy.dequantify()
+
+
+def metpy_geopot_height(dset):
+    return mpcalc.geopotential_to_height(dset['z']).metpy.dequantify()
+
+
+def metpy_kinematics(dset):
+    """dset with the metpy coordinates of a latitude_longitude grid, as
+    metpy.calc needs them to compute the grid deltas and map factors"""
+    dset = dset.copy()
+    dset['lat'].attrs['units'], dset['lon'].attrs['units'] = 'degrees_north', 'degrees_east'
+    return dset.metpy.assign_crs(grid_mapping_name='latitude_longitude')
+
+
+def measure(function, repeat=3):
+    """Best time of repeat calls of function and its result"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--steps', type=int, default=49)
+    parser.add_argument('-p', '--passes', type=int, default=10)
+    args = parser.parse_args()
+
+    data = mslp_field(args.steps)
+    print('%-4s %-22s %10s %14s %12s' % ('n', 'smoothing', 'total s', 'per frame ms', 'max diff'))
+    for n in (9, 5):
+        elapsed, reference = measure(lambda: np.stack(
+            [np.asarray(mpcalc.smooth_n_point(frame, n=n, passes=args.passes)) for frame in data]))
+        print('%-4d %-22s %10.3f %14.2f %12s' % (n, 'metpy, per frame', elapsed,
+                                                 1000 * elapsed / args.steps, '-'))
+        elapsed, result = measure(lambda: smooth_n_point(data, n=n, passes=args.passes))
+        print('%-4d %-22s %10.3f %14.2f %12.3g' % (n, 'all the steps at once', elapsed,
+                                                   1000 * elapsed / args.steps,
+                                                   float(np.max(np.abs(result - reference)))))
+
+    print()
+    print('%-6s %-26s %10s %12s' % ('steps', 'rain rate', 'time s', 'memory MB'))
+    for steps in sorted(set([max(args.steps // 4, 2), max(args.steps // 2, 2), args.steps])):
+        acc = accumulated_field(steps)
+        for name, function in [('loaded, differentiate', rate_loaded),
+                               ('deaccumulate, chunked', rate_chunked)]:
+            elapsed, peak = measure_memory(function, acc)
+            print('%-6d %-26s %10.3f %12.1f' % (steps, name, elapsed, peak / 1e6))
+
+    print()
+    print('%-22s %10s %10s %9s %12s' % ('thermodynamics', 'metpy s', 'thermo s', 'speedup', 'max diff'))
+    dset = pressure_levels(max(args.steps // 4, 1))
+    for name, reference, function in [
+            ('theta_e', metpy_thetae, lambda d: compute_thetae(d)['theta_e']),
+            ('wind speed', metpy_wind_speed, lambda d: compute_wind_speed(d)['wind_speed']),
+            ('geopotential height', metpy_geopot_height, lambda d: compute_geopot_height(d)['geop'])]:
+        elapsed_metpy, expected = measure(lambda: reference(dset))
+        elapsed, result = measure(lambda: function(dset))
+        print('%-22s %10.3f %10.3f %8.1fx %12.3g' % (name, elapsed_metpy, elapsed, elapsed_metpy / elapsed,
+                                                    float(np.nanmax(np.abs(result.values - expected.values)))))
+
+    print()
+    print('%-22s %10s %10s %9s %12s' % ('kinematics', 'metpy s', 'kinem. s', 'speedup', 'max rel diff'))
+    folder = tempfile.mkdtemp()
+    try:
+        kinematics.metrics_folder = folder
+        lat, lon = dset['lat'].values, dset['lon'].values
+        elapsed, _ = measure(lambda: kinematics.GridMetrics(lat, lon))
+        print('%-22s %10s %10.3f' % ('grid metrics', '-', elapsed))
+        kinematics.GridMetrics.for_grid(lat, lon)
+        kinematics._grids.clear()
+        elapsed, grid = measure(lambda: kinematics.GridMetrics.for_grid(lat, lon), repeat=1)
+        print('%-22s %10s %10.3f' % ('grid metrics, cached', '-', elapsed))
+    finally:
+        shutil.rmtree(folder)
+    wind = metpy_kinematics(dset)
+    u, v, t = dset['u'].values, dset['v'].values, dset['t'].values
+    for name, reference, function in [
+            ('divergence', lambda: mpcalc.divergence(wind['u'], wind['v']),
+             lambda: kinematics.divergence(u, v, grid)),
+            ('vorticity', lambda: mpcalc.vorticity(wind['u'], wind['v']),
+             lambda: kinematics.vorticity(u, v, grid)),
+            ('total deformation', lambda: mpcalc.total_deformation(wind['u'], wind['v']),
+             lambda: kinematics.deformation(u, v, grid)[2]),
+            ('temperature advection', lambda: mpcalc.advection(wind['t'], wind['u'], wind['v']),
+             lambda: kinematics.advection(t, u, v, grid))]:
+        elapsed_metpy, expected = measure(reference)
+        elapsed, result = measure(function)
+        expected = expected.metpy.dequantify().values
+        print('%-22s %10.3f %10.3f %8.1fx %12.3g' % (
+            name, elapsed_metpy, elapsed, elapsed_metpy / elapsed,
+            float(np.nanmax(np.abs(result - expected)) / np.nanmax(np.abs(expected)))))
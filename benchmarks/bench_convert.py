@@ -0,0 +1,106 @@
+"""Compare the native GRIB to NETCDF conversion (ingest.convert_files) with the
+cdo chain which was used before
+
+- 2d: cdo -f nc copy -seltime,... -mergetime <files> out.nc
+- 3d: cdo merge <files> merged.grib2 && cdo -f nc copy -seltime,... merged.grib2 out.nc
+
+Synthetic GRIB files on the ICON-D2 grid are written to a temporary folder first.
+The cdo chain is skipped if cdo is not installed.
+
+    python benchmarks/bench_convert.py --steps 49 --levels 950 850 700 500
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import download_dwd
+import ingest
+from mock_dwd_server import grib_message
+
+run_string = '2021010100'
+hourly_times = ','.join('%02d:00' % h for h in range(24))
+
+
+def write_files(folder, steps, levels):
+    files_2d, files_3d = [], []
+    for step in steps:
+        name = os.path.join(folder, 'icon-d2_germany_regular-lat-lon_single-level_%s_%03d_2d_t_2m.grib2'
+                            % (run_string, step))
+        with open(name, 'wb') as f:
+            f.write(grib_message(step))
+        files_2d.append(name)
+        for level in levels:
+            name = os.path.join(folder, 'icon-d2_germany_regular-lat-lon_pressure-level_%s_%03d_%s_t.grib2'
+                                % (run_string, step, level))
+            with open(name, 'wb') as f:
+                f.write(grib_message(step, 't', int(level)))
+            files_3d.append(name)
+    return files_2d, files_3d
+
+
+def cdo_2d(files, output):
+    subprocess.run(['cdo', '-s', '-f', 'nc', 'copy', '-seltime,%s' % hourly_times,
+                    '-mergetime', *files, output], check=True)
+    return [output]
+
+
+def cdo_3d(files, output):
+    merged = output.replace('.nc', '.grib2')
+    subprocess.run(['cdo', '-s', 'merge', *files, merged], check=True)
+    subprocess.run(['cdo', '-s', '-f', 'nc', 'copy', '-seltime,%s' % hourly_times,
+                    merged, output], check=True)
+    return [merged, output]
+
+
+def native(compression):
+    def convert(files, output):
+        kind = '3d' if 'pressure-level' in files[0] else '2d'
+        store = ingest.VariableStore(output, download_dwd.get_times(files, run_string),
+                                     levels=download_dwd.get_levels(files, kind),
+                                     compression=compression)
+        ingest.convert_files(files, store)
+        return [output]
+    return convert
+
+
+def measure(name, function, files, output):
+    start = time.perf_counter()
+    written = function(files, output)
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(f) for f in written) / 1e6
+    print('%-12s %7.2f s  %8.1f MB written' % (name, elapsed, size))
+    for f in written:
+        os.remove(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--steps', type=int, default=49)
+    parser.add_argument('-l', '--levels', nargs='+', default=download_dwd.levels_3d)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        files_2d, files_3d = write_files(folder, range(args.steps), args.levels)
+        print('%d 2d and %d 3d GRIB files, %.1f MB' % (
+            len(files_2d), len(files_3d),
+            sum(os.path.getsize(f) for f in files_2d + files_3d) / 1e6))
+        methods = [('native nc3', native(None)), ('native nc4', native(ingest.compression))]
+        if shutil.which('cdo'):
+            methods.insert(0, ('cdo', None))
+        else:
+            print('cdo not found, only the native conversion is measured')
+        for kind, files in [('2d', files_2d), ('3d', files_3d)]:
+            print('--- %s' % kind)
+            output = os.path.join(folder, 'out_%s.nc' % kind)
+            for name, function in methods:
+                if function is None:
+                    function = cdo_2d if kind == '2d' else cdo_3d
+                measure(name, function, files, output)
+    finally:
+        shutil.rmtree(folder)
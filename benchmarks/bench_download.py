@@ -0,0 +1,101 @@
+"""Compare the throughput of download_dwd.py against the old wget fan-out.
+
+The old approach (one wget | bzip2 process per file, 10 per variable and
+4 variables at the same time) is emulated with a thread pool which opens a
+new connection for every file. Both are run against the local mock server.
+
+    python benchmarks/bench_download.py --variables t_2m td_2m u_10m v_10m
+"""
+import argparse
+import asyncio
+import bz2
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import download_dwd
+import mock_dwd_server
+
+run_string = '2021010100'
+
+
+def old_get_and_extract_one(url):
+    """Same as get_and_extract_one in the old functions_download_dwd.sh"""
+    file = os.path.basename(url).replace('.bz2', '')
+    if shutil.which('wget') and shutil.which('bzip2'):
+        subprocess.run('wget -t 2 -q -O - "%s" | bzip2 -dc > "%s"' % (url, file),
+                       shell=True, check=True)
+    else:
+        with urllib.request.urlopen(url) as response:
+            data = bz2.decompress(response.read())
+        with open(file, 'wb') as f:
+            f.write(data)
+    return file
+
+
+def old_download_variable(var):
+    async def listing():
+        async with download_dwd.create_session() as session:
+            url = '%s%s/%s/' % (download_dwd.base_url, run_string[-2:], var)
+            return await download_dwd.list_urls(session, url,
+                                                download_dwd.file_pattern(var, '2d', run_string))
+    urls = asyncio.run(listing())
+    with ThreadPoolExecutor(10) as pool:
+        return list(pool.map(old_get_and_extract_one, urls))
+
+
+def run_old(variables):
+    with ThreadPoolExecutor(4) as pool:
+        return sum(pool.map(old_download_variable, variables), [])
+
+
+def run_new(variables):
+    async def download():
+        async with download_dwd.create_session() as session:
+            results = await asyncio.gather(*[download_dwd.download_files(session, var, '2d', run_string)
+                                             for var in variables])
+        return sum(results, [])
+    return asyncio.run(download())
+
+
+def measure(name, function, variables, folder):
+    os.chdir(folder)
+    for f in os.listdir(folder):
+        os.remove(f)
+    start = time.perf_counter()
+    files = function(variables)
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(f) for f in files) / 1e6
+    print('%-8s %5d files in %6.2f s  %7.1f files/s  %7.1f MB/s (decompressed)' % (
+        name, len(files), elapsed, len(files) / elapsed, size / elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--variables', nargs='+', default=['t_2m', 'td_2m', 'u_10m', 'v_10m'])
+    parser.add_argument('-s', '--file_size', type=int, default=1 << 18,
+                        help='Uncompressed size of every file in bytes')
+    args = parser.parse_args()
+
+    payload = lambda name: mock_dwd_server.synthetic_payload(name, args.file_size)
+    server, url = mock_dwd_server.start_server(
+        mock_dwd_server.icon_d2_tree(run_string, vars_2d=args.variables, vars_3d=[]),
+        payload=payload)
+    download_dwd.base_url = url
+
+    folder = tempfile.mkdtemp()
+    try:
+        # Warm up the server cache so that we only measure the transfer
+        os.chdir(folder)
+        run_new(args.variables)
+        measure('old', run_old, args.variables, folder)
+        measure('new', run_new, args.variables, folder)
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder)
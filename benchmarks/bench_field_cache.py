@@ -0,0 +1,111 @@
+"""Compare the plotting stage reading the fields from the NETCDF files in every
+process with the shared cache of decoded fields (plotting/field_cache.py).
+
+Like copy_data.run (parallel -j 3 over scripts x projections) several processes,
+--jobs at a time, read the same few variables and load them on their projection.
+Reported are the wall time of the whole stage, the total CPU time of the
+processes and the largest sum of the proportional set size (PSS, where shared
+pages are split between the processes which map them) of the processes running
+at the same time, once the data is loaded.
+
+    python benchmarks/bench_field_cache.py --steps 49 --processes 9 --jobs 3
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import time
+
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from bench_run_store import map_product, write_files
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'plotting'))
+import field_cache
+
+run_string = '2021010100'
+map_vars = ['t', 'fi', 'pmsl']
+
+
+def pss_mb():
+    """Proportional set size of this process, None where it is not available"""
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        return None
+
+
+def load(path):
+    with xr.open_dataset(path) as dset:
+        return dset.squeeze(drop=True).load()
+
+
+def plot_process(results_queue, files, cache_folder):
+    if cache_folder is None:
+        dset = xr.merge([load(files[v]) for v in map_vars])
+    else:
+        cache = field_cache.FieldCache(run_string, cache_folder)
+        dset = xr.merge([cache.get(field_cache.file_key(files[v]), lambda v=v: load(files[v]))
+                         for v in map_vars])
+    data = map_product(dset)
+    times = os.times()
+    results_queue.put((times.user + times.system, pss_mb()))
+    del data
+
+
+def run_processes(context, files, n_processes, cache_folder):
+    """Results of n_processes plot processes started together"""
+    results_queue = context.Queue()
+    processes = [context.Process(target=plot_process, args=(results_queue, files, cache_folder))
+                 for _ in range(n_processes)]
+    for process in processes:
+        process.start()
+    results = []
+    while len(results) < n_processes:
+        try:
+            results.append(results_queue.get(timeout=1))
+        except queue.Empty:
+            if not any(p.is_alive() for p in processes):
+                raise RuntimeError('A plot process died (out of memory?)')
+    for process in processes:
+        process.join()
+    return results
+
+
+def measure(name, files, n_processes, jobs, cache_folder=None):
+    context = multiprocessing.get_context('spawn')
+    start = time.perf_counter()
+    cpu, pss = 0, 0
+    for i in range(0, n_processes, jobs):
+        results = run_processes(context, files, min(jobs, n_processes - i), cache_folder)
+        cpu += sum(r[0] for r in results)
+        if all(r[1] is not None for r in results):
+            pss = max(pss, sum(r[1] for r in results))
+    elapsed = time.perf_counter() - start
+    print('%-16s %7.2f s wall %8.2f s CPU   PSS %8.1f MB' % (name, elapsed, cpu, pss))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--steps', type=int, default=49)
+    parser.add_argument('-p', '--processes', type=int, default=9)
+    parser.add_argument('-j', '--jobs', type=int, default=3,
+                        help='Processes running at the same time')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        files = write_files(folder, args.steps)
+        measure('files', files, args.processes, args.jobs)
+        cache_folder = os.path.join(folder, 'fields')
+        measure('cache (cold)', files, args.processes, args.jobs, cache_folder)
+        measure('cache (warm)', files, args.processes, args.jobs, cache_folder)
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,187 @@
+"""End-to-end benchmark of the ingestion against the local mock server serving
+GRIB files on the ICON-D2 grid.
+
+The stages are measured one after the other, each in a new process so that
+its peak memory can be reported
+- last_run:  discovery of the most recent run (get_last_run.py, empty cache)
+- download:  download and decompression of the files to disk (download_dwd.download_files)
+- convert:   conversion of the files on disk into NETCDF (download_dwd.convert_variable)
+- in_memory: download, decoding in memory and writing of the NETCDF (--in-memory)
+
+The NETCDF files written by convert and in_memory are checked (all the steps and
+levels, no missing values). A stage which crashes, fails the check or doesn't
+finish within stage_timeout is reported as FAILED and the script exits with 1.
+
+Throughput is given in files/s and in MB/s of (decompressed) GRIB.
+
+    python benchmarks/bench_ingest.py --steps 13 --latency 0.03 --bandwidth 2e7
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue as queue_module
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import download_dwd
+import get_last_run
+import mock_dwd_server
+
+run_string = '2021010100'
+# Seconds after which a stage is considered hung
+stage_timeout = 1800
+
+
+def stage_last_run(base_url, folder, plan):
+    get_last_run.cache_file = os.path.join(folder, 'listings_cache.json')
+    get_last_run.get_most_recent_run(base_url=base_url.split('/icon-d2/')[0])
+    return 0, 0
+
+
+def stage_download(base_url, folder, plan):
+    download_dwd.base_url = base_url
+
+    async def download():
+        async with download_dwd.create_session() as session:
+            return await asyncio.gather(*[download_dwd.download_files(
+                session, p['var'], p['kind'], run_string, levels=p['levels']) for p in plan])
+    files = sum(asyncio.run(download()), [])
+    return len(files), sum(os.path.getsize(f) for f in files)
+
+
+def stage_convert(base_url, folder, plan):
+    def convert(p):
+        files = sorted(f for f in os.listdir(folder)
+                       if f.endswith('_%s.grib2' % p['var']) and run_string in f)
+        download_dwd.convert_variable(files, p['var'], p['kind'], run_string)
+        return len(files), sum(os.path.getsize(f) for f in files)
+    with ThreadPoolExecutor(download_dwd.max_conversions) as pool:
+        results = list(pool.map(convert, plan))
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def stage_in_memory(base_url, folder, plan):
+    download_dwd.base_url = base_url
+    for f in os.listdir(folder):
+        if f.endswith('.nc') or f.endswith('.grib2') or f.startswith('manifest_'):
+            os.remove(f)
+    # Count what is decoded, as the files are never written
+    sizes = []
+    decode_into = download_dwd.ingest.decode_into
+
+    def counting_decode_into(data, store):
+        sizes.append(len(data))
+        decode_into(data, store)
+    download_dwd.ingest.decode_into = counting_decode_into
+    failed = asyncio.run(download_dwd.download_plan(plan, run_string, in_memory=True))
+    if failed:
+        raise RuntimeError(failed)
+    return len(sizes), sum(sizes)
+
+
+def run_stage(queue, stage, base_url, folder, plan):
+    os.chdir(folder)
+    start = time.perf_counter()
+    n_files, n_bytes = stage(base_url, folder, plan)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, n_files, n_bytes, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def check_outputs(folder, plan, steps):
+    """The NETCDF files of plan in folder have all the steps (and levels), with values"""
+    for p in plan:
+        path = os.path.join(folder, download_dwd.output_file_kind(p['var'], p['kind'], run_string))
+        assert os.path.isfile(path), '%s was not written' % path
+        with xr.open_dataset(path) as dset:
+            for name, values in dset.data_vars.items():
+                if 'time' not in values.dims:
+                    continue
+                assert values.sizes['time'] == steps, '%s has %d steps instead of %d' % (
+                    path, values.sizes['time'], steps)
+                if p['levels']:
+                    assert values.sizes['plev'] == len(p['levels']), '%s misses levels' % path
+                assert np.isfinite(values.values).all(), '%s has missing values' % path
+
+
+def measure(name, stage, base_url, folder, plan, timeout=stage_timeout):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=run_stage, args=(queue, stage, base_url, folder, plan))
+    process.start()
+    start = time.perf_counter()
+    result = None
+    # Don't wait forever if the stage crashes (e.g. aborted by HDF5) or hangs
+    while result is None and time.perf_counter() - start < timeout:
+        try:
+            result = queue.get(timeout=1)
+        except queue_module.Empty:
+            if not process.is_alive() and queue.empty():
+                break
+    if result is None:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        queue.close()
+        raise RuntimeError('Stage %s failed (exit code %s)' % (name, process.exitcode))
+    process.join()
+    queue.close()
+    elapsed, n_files, n_bytes, max_rss = result
+    if n_files:
+        print('%-10s %7.2f s %6d files %8.1f files/s %8.1f MB/s   peak RSS %7.1f MB' % (
+            name, elapsed, n_files, n_files / elapsed, n_bytes / 1e6 / elapsed, max_rss / 1024.))
+    else:
+        print('%-10s %7.2f s %42s peak RSS %7.1f MB' % (name, elapsed, '', max_rss / 1024.))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v2d', '--variables_2d', nargs='+', default=['t_2m', 'pmsl', 'u_10m', 'v_10m'])
+    parser.add_argument('-v3d', '--variables_3d', nargs='+', default=['t', 'fi'])
+    parser.add_argument('-s', '--steps', type=int, default=13)
+    parser.add_argument('-l', '--latency', type=float, default=0.,
+                        help='Latency of every request to the mock server in seconds')
+    parser.add_argument('-b', '--bandwidth', type=float, default=None,
+                        help='Bandwidth of every connection to the mock server in bytes/s')
+    args = parser.parse_args()
+
+    levels = download_dwd.levels_3d
+    tree = mock_dwd_server.icon_d2_tree(run_string, vars_2d=args.variables_2d,
+                                        vars_3d=args.variables_3d, levels=levels,
+                                        f_steps=range(args.steps))
+    dates = [(datetime.today() - timedelta(days=1)).strftime('%Y%m%d'),
+             datetime.now().strftime('%Y%m%d')]
+    tree.update(mock_dwd_server.icon_d2_eps_tree(dates, ['00', '03', '06', '09', '12', '15', '18', '21']))
+    server, url = mock_dwd_server.start_server(tree, payload=mock_dwd_server.grib_payload,
+                                               latency=args.latency, bandwidth=args.bandwidth)
+    plan = [{'var': v, 'kind': '2d', 'levels': None} for v in args.variables_2d] + \
+        [{'var': v, 'kind': '3d', 'levels': levels} for v in args.variables_3d]
+    folder = tempfile.mkdtemp()
+    try:
+        print('Creating the files on the server...')
+        size = server.prefetch('/weather/nwp/icon-d2/grib/')
+        print('%d MB (bz2) on the server' % (size / 1e6))
+        failed = []
+        for name, stage in [('last_run', stage_last_run), ('download', stage_download),
+                            ('convert', stage_convert), ('in_memory', stage_in_memory)]:
+            try:
+                measure(name, stage, url, folder, plan)
+                if name in ('convert', 'in_memory'):
+                    check_outputs(folder, plan, args.steps)
+            except (RuntimeError, AssertionError) as error:
+                print('%-10s FAILED: %s' % (name, error))
+                failed.append(name)
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder)
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,72 @@
+"""Time the run discovery of get_last_run.py against the local mock server.
+
+Three cases are compared
+- old: runs probed one after another, listings parsed with BeautifulSoup
+- cold: runs probed concurrently with the streaming parser and an empty cache
+- warm: same as cold but with the cache filled, i.e. the "nothing new" check
+        done by the cronjob every 2 hours
+
+    python benchmarks/bench_last_run.py --latency 0.05
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import requests
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import get_last_run
+import mock_dwd_server
+
+runs = ['00', '03', '06', '09', '12', '15', '18', '21']
+
+
+def old_get_url_paths(url, ext='', prefix='', params={}, **kwargs):
+    """get_url_paths as it was before the cache and the streaming parser"""
+    response = requests.get(url, params=params)
+    if response.ok:
+        response_text = response.text
+    else:
+        return response.raise_for_status()
+    soup = BeautifulSoup(response_text, 'html.parser')
+    parent = [url + node.get('href') for node in soup.find_all('a') if (
+        node.get('href').endswith(ext)) & (node.get('href').startswith(prefix))]
+    return parent
+
+
+def measure(name, base_url, repeat=3, **kwargs):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _, sel_run = get_last_run.get_most_recent_run(base_url=base_url, **kwargs)
+        timings.append(time.perf_counter() - start)
+    print('%-5s %7.3f s (best of %d), most recent run %s' % (name, min(timings), repeat, sel_run))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--latency', type=float, default=0.05,
+                        help='Latency of every request to the mock server in seconds')
+    args = parser.parse_args()
+
+    dates = [(datetime.today() - timedelta(days=1)).strftime('%Y%m%d'),
+             datetime.now().strftime('%Y%m%d')]
+    server, _ = mock_dwd_server.start_server(mock_dwd_server.icon_d2_eps_tree(dates, runs),
+                                             latency=args.latency)
+    base_url = 'http://127.0.0.1:%d/weather/nwp' % server.server_address[1]
+    get_last_run.cache_file = os.path.join(tempfile.mkdtemp(), 'listings_cache.json')
+
+    try:
+        new_get_url_paths, new_max_workers = get_last_run.get_url_paths, get_last_run.max_workers
+        get_last_run.get_url_paths, get_last_run.max_workers = old_get_url_paths, 1
+        measure('old', base_url, use_cache=False)
+        get_last_run.get_url_paths, get_last_run.max_workers = new_get_url_paths, new_max_workers
+        measure('cold', base_url, repeat=1)
+        measure('warm', base_url)
+    finally:
+        server.shutdown()
+        os.remove(get_last_run.cache_file)
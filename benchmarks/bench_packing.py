@@ -0,0 +1,97 @@
+"""Compare the NETCDF files of the plot-only variables stored as float32 with the
+packed storage (ingest.packed_variables, PACKED_STORAGE=1).
+
+Synthetic smooth fields with the size of the cropped ICON-D2 domain are written
+through ingest.VariableStore with the current compression, then every file is
+loaded as read_dataset does (decoded lazily, then loaded). Reported are the
+size on disk, the load time, the peak memory allocated while loading (as traced
+by tracemalloc) and the largest error of the packed values. The values are
+decoded to float32 when loaded, so the packing saves disk space and I/O, not
+the memory of the loaded fields.
+
+    python benchmarks/bench_packing.py --steps 49
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import ingest
+
+run = pd.Timestamp('2021-01-01 00:00')
+# Variable: (GRIB short name, units, range of the synthetic values)
+variables = {'clct': ('CLCT', '%', (0., 100.)),
+             'relhum': ('r', '%', (0., 100.)),
+             'ww': ('WW', 'Numeric', (0., 99.)),
+             'dbz_cmax': ('DBZ_CMAX', 'dBZ', (-30., 70.)),
+             'synmsg_bt_cl_ir10.8': ('SYNMSG_BT_CL_IR10.8', 'K', (200., 300.))}
+
+
+def synthetic_field(shape, value_range, step, integer=False):
+    lat, lon = np.meshgrid(np.linspace(0, 6 * np.pi, shape[0]), np.linspace(0, 6 * np.pi, shape[1]),
+                           indexing='ij')
+    values = (np.sin(lat + step / 5.) * np.cos(lon - step / 7.) + 1) / 2
+    values += np.random.normal(scale=0.02, size=shape)
+    values = value_range[0] + np.clip(values, 0, 1) * (value_range[1] - value_range[0])
+    return np.round(values).astype(np.float32) if integer else values.astype(np.float32)
+
+
+def write_file(path, var, steps, shape, packing):
+    name, units, value_range = variables[var]
+    times = [run + pd.Timedelta(hours=h) for h in range(steps)]
+    store = ingest.VariableStore(path, times, compression=ingest.compression, packing=packing)
+    fields = []
+    for h, time_step in enumerate(times):
+        values = synthetic_field(shape, value_range, h, integer=var == 'ww')
+        store.append({'name': name, 'long_name': var, 'units': units, 'standard_name': 'unknown',
+                      'time': time_step, 'run': run, 'level_type': 'surface', 'level': 0,
+                      'lat': np.linspace(43, 56.48, shape[0]), 'lon': np.linspace(4, 16.48, shape[1]),
+                      'values': values})
+        fields.append(values)
+    store.close()
+    return name, np.stack(fields)
+
+
+def load(path, name, repeat=3):
+    """Values of name in the file at path, best load time of repeat and peak memory"""
+    timings = []
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        with xr.open_dataset(path, chunks={}) as dset:
+            values = dset[name].load()
+        timings.append(time.perf_counter() - start)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return values, min(timings), peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--steps', type=int, default=49)
+    args = parser.parse_args()
+
+    ingest.packed_storage = True
+    shape = (675, 625)
+    folder = tempfile.mkdtemp()
+    try:
+        print('%-22s %-8s %9s %9s %11s %10s' % ('variable', 'storage', 'disk MB', 'load s',
+                                                'memory MB', 'max error'))
+        for var in variables:
+            for storage, packing in [('float32', None), ('packed', ingest.packing(var))]:
+                path = os.path.join(folder, '%s_%s.nc' % (var, storage))
+                name, original = write_file(path, var, args.steps, shape, packing)
+                values, elapsed, peak = load(path, name)
+                error = float(np.nanmax(np.abs(values.values - original)))
+                print('%-22s %-8s %9.1f %9.3f %11.1f %10.4f' % (
+                    var, storage, os.path.getsize(path) / 1e6, elapsed, peak / 1e6, error))
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,102 @@
+"""Compare disk footprint and load time per product of the NETCDF formats
+written by the ingestion: NETCDF3 (no compression, as cdo wrote them) and
+NETCDF4 compressed with zlib or zstd (ingest.compressions), read with the
+available xarray engines in the same way as utils.read_dataset does
+(open_mfdataset with the chunks of the files, subsetting, load).
+
+Synthetic files with the size of the cropped ICON-D2 domain are created first,
+packed with 16 bits like the GRIB files so that they compress realistically.
+
+    python benchmarks/bench_read_dataset.py --steps 49
+"""
+import argparse
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import ingest
+from bench_run_store import levels, map_product, meteogram_product, run_string, variables_2d, variables_3d
+
+chunk_cache_size = 64 * 1024 * 1024
+
+
+def write_files(folder, steps, compression, shape=(675, 625)):
+    run = pd.to_datetime(run_string, format='%Y%m%d%H')
+    coords = {'time': pd.date_range(run, periods=steps, freq='1h'),
+              'lat': np.linspace(43, 56.48, shape[0]), 'lon': np.linspace(4, 16.48, shape[1])}
+    y, x = np.mgrid[0:shape[0], 0:shape[1]]
+    files = {}
+    for var, name in list(variables_2d.items()) + list(variables_3d.items()):
+        if var in variables_3d:
+            dims, var_coords = ('time', 'plev', 'lat', 'lon'), dict(coords, plev=levels)
+        else:
+            dims, var_coords = ('time', 'lat', 'lon'), coords
+        size = [len(var_coords[d]) for d in dims]
+        field = 10 * np.sin(y / 50.) * np.cos(x / 80.)
+        data = 270 + field + np.random.normal(scale=0.3, size=size)
+        # Same precision as 16 bits GRIB packing over the range of the field
+        data = (np.round(data * 64) / 64).astype(np.float32)
+        dset = xr.Dataset({name: (dims, data)}, coords=var_coords)
+        files[var] = os.path.join(folder, '%s_%s_de.nc' % (var, run_string))
+        if compression is None:
+            dset.to_netcdf(files[var], format='NETCDF3_64BIT')
+        else:
+            chunks = tuple(1 if d in ('time', 'plev') else len(var_coords[d]) for d in dims)
+            dset.to_netcdf(files[var], format='NETCDF4',
+                           encoding={name: dict(compression, chunksizes=chunks)})
+    return files
+
+
+def open_files(files, variables, engine):
+    kwargs = {}
+    if engine == 'netcdf4':
+        netCDF4.set_chunk_cache(chunk_cache_size)
+    elif engine == 'h5netcdf':
+        kwargs['driver_kwds'] = {'rdcc_nbytes': chunk_cache_size}
+    return xr.open_mfdataset([files[v] for v in variables], engine=engine, chunks={},
+                             preprocess=lambda ds: ds.squeeze(drop=True), **kwargs)
+
+
+def measure(function, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--steps', type=int, default=49)
+    args = parser.parse_args()
+
+    formats = [('nc3', None, ['scipy', 'netcdf4']),
+               ('nc4 zlib', ingest.compressions['zlib'], ['netcdf4', 'h5netcdf'])]
+    if netCDF4.__has_zstandard_support__:
+        formats.append(('nc4 zstd', ingest.compressions['zstd'], ['netcdf4']))
+    map_vars, meteogram_vars = ['t', 'fi', 'pmsl'], ['t_2m', 'pmsl', 't']
+    print('%-10s %-9s %9s %10s %14s' % ('format', 'engine', 'disk MB', 'map s', 'meteogram s'))
+    for name, compression, engines in formats:
+        folder = tempfile.mkdtemp()
+        try:
+            files = write_files(folder, args.steps, compression)
+            size = sum(os.path.getsize(f) for f in files.values()) / 1e6
+            for engine in engines:
+                if engine == 'h5netcdf' and importlib.util.find_spec('h5py') is None:
+                    continue
+                t_map = measure(lambda: map_product(open_files(files, map_vars, engine)))
+                t_meteogram = measure(lambda: meteogram_product(
+                    open_files(files, meteogram_vars, engine)))
+                print('%-10s %-9s %9.1f %10.3f %14.3f' % (name, engine, size, t_map, t_meteogram))
+        finally:
+            shutil.rmtree(folder)
@@ -0,0 +1,115 @@
+"""Time the opening and loading of the data of some products from the NETCDF
+files (one per variable, read with open_mfdataset as utils.read_dataset does)
+from the per-run Zarr store (plotting/run_store.py) and, for the meteogram, from
+the point store (plotting/point_store.py).
+
+Synthetic files with the size of the cropped ICON-D2 domain are created first.
+The products are
+- map: temperature and geopotential at 2 levels + mslp on a projection, all steps
+- meteogram: 2m temperature, mslp and temperature on all levels at a few points
+
+    python benchmarks/bench_run_store.py --steps 49
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'plotting'))
+import ingest
+import point_store
+import run_store
+from domains import proj_defs
+
+run_string = '2021010100'
+variables_2d = {'t_2m': '2t', 'pmsl': 'prmsl', 'u_10m': '10u', 'v_10m': '10v'}
+variables_3d = {'t': 't', 'fi': 'z'}
+levels = [95000., 85000., 70000., 50000.]
+points = [(53.55, 9.99), (43.72, 10.40), (45.46, 9.19), (52.09, 5.12), (48.14, 11.58)]
+
+
+def write_files(folder, steps, shape=(675, 625)):
+    run = pd.to_datetime(run_string, format='%Y%m%d%H')
+    coords = {'time': pd.date_range(run, periods=steps, freq='1h'),
+              'lat': np.linspace(43, 56.48, shape[0]), 'lon': np.linspace(4, 16.48, shape[1])}
+    files = {}
+    for var, name in list(variables_2d.items()) + list(variables_3d.items()):
+        if var in variables_3d:
+            dims, var_coords = ('time', 'plev', 'lat', 'lon'), dict(coords, plev=levels)
+        else:
+            dims, var_coords = ('time', 'lat', 'lon'), coords
+        size = [len(var_coords[d]) for d in dims]
+        data = (270 + np.random.normal(scale=0.3, size=size)).astype(np.float32)
+        dset = xr.Dataset({name: (dims, data)}, coords=var_coords)
+        files[var] = os.path.join(folder, '%s_%s_de.nc' % (var, run_string))
+        dset.to_netcdf(files[var], encoding={name: dict(ingest.compression)})
+    return files
+
+
+def from_files(files, variables):
+    return xr.open_mfdataset([files[v] for v in variables],
+                             preprocess=lambda ds: ds.squeeze(drop=True))
+
+
+def map_product(dset):
+    proj = proj_defs['it']
+    return dset.sel(plev=[50000, 85000], method='nearest').sel(
+        lat=slice(proj['llcrnrlat'], proj['urcrnrlat']),
+        lon=slice(proj['llcrnrlon'], proj['urcrnrlon'])).load()
+
+
+def meteogram_product(dset):
+    return [dset.sel(lat=lat, lon=lon, method='nearest').load() for lat, lon in points]
+
+
+def meteogram_points(store, variables):
+    return [store.read(variables, lat, lon) for lat, lon in points]
+
+
+def measure(name, open_function, product, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        product(open_function())
+        timings.append(time.perf_counter() - start)
+    print('%-28s %7.3f s (best of %d)' % (name, min(timings), repeat))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--steps', type=int, default=49)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        files = write_files(folder, args.steps)
+        path = run_store.store_path(folder, run_string)
+        start = time.perf_counter()
+        for var, nc_file in files.items():
+            run_store.write_variable(path, var, nc_file, layouts=run_store.layouts)
+        run_store.consolidate(path)
+        print('Store written in %.2f s' % (time.perf_counter() - start))
+
+        map_vars, meteogram_vars = ['t', 'fi', 'pmsl'], ['t_2m', 'pmsl', 't']
+        measure('map: files', lambda: from_files(files, map_vars), map_product)
+        measure('map: store (maps)', lambda: run_store.open_variables(path, map_vars), map_product)
+        measure('meteogram: files', lambda: from_files(files, meteogram_vars), meteogram_product)
+        measure('meteogram: store (maps)',
+                lambda: run_store.open_variables(path, meteogram_vars), meteogram_product)
+        measure('meteogram: store (columns)',
+                lambda: run_store.open_variables(path, meteogram_vars, 'columns'), meteogram_product)
+        points_path = point_store.store_path(folder, run_string)
+        start = time.perf_counter()
+        point_store.write_store(points_path, {v: files[v] for v in meteogram_vars})
+        print('Point store written in %.2f s' % (time.perf_counter() - start))
+        measure('meteogram: point store', lambda: point_store.PointStore(points_path),
+                lambda p: meteogram_points(p, meteogram_vars))
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,257 @@
+"""Local stand-in for https://opendata.dwd.de/weather/nwp/icon-d2/grib/
+
+Serves directory listings in the same format as the DWD server together with
+synthetic .grib2.bz2 files, so that the download stage can be measured offline.
+The files are either random bytes (synthetic_payload) or valid GRIB2 messages on
+the ICON-D2 grid (grib_payload) which can go through the whole ingestion.
+Latency and bandwidth (per connection) can be set to emulate a real link.
+It can be used standalone
+
+    python mock_dwd_server.py --port 8000 --run 2021010100 --grib --latency 0.03 --bandwidth 5e6
+
+and then pointed at with DWD_BASE_URL=http://localhost:8000/weather/nwp/icon-d2/grib/
+"""
+import argparse
+import bz2
+import hashlib
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+variables_2d = ["t_2m", "td_2m", "u_10m", "v_10m", "pmsl", "tot_prec"]
+variables_3d = ["t", "fi", "relhum", "u", "v"]
+levels_3d = ["950", "850", "700", "600", "500", "300"]
+steps = range(0, 49)
+# Uncompressed size of every synthetic file
+file_size = 1 << 20
+# ICON-D2 regular grid
+grid_shape = (746, 1215)
+# eccodes shortName of the variables in the GRIB payloads, the others are
+# written as 2t (single level) or t (pressure levels)
+short_names = {'t_2m': '2t', 'td_2m': '2d', 'u_10m': '10u', 'v_10m': '10v', 'pmsl': 'prmsl',
+               'tot_prec': 'tp', 'fi': 'z', 'relhum': 'r', 'u': 'u', 'v': 'v', 'hsurf': 'orog'}
+
+
+def synthetic_payload(name, size=file_size):
+    """Compressible but not trivial content, different for every file"""
+    seed = name.encode()
+    block = (seed * (4096 // len(seed) + 1))[:4096]
+    random_block = os.urandom(4096)
+    data = (block + random_block) * (size // 8192 + 1)
+    return bz2.compress(data[:size], compresslevel=1)
+
+
+def grib_message(step, name='2t', level=None, run_string='2021010100', shape=grid_shape):
+    """GRIB2 message on the ICON-D2 regular grid with a smooth field plus noise,
+    packed with 16 bits like the DWD files"""
+    import eccodes
+    nj, ni = shape
+    gid = eccodes.codes_grib_new_from_samples('regular_ll_pl_grib2' if level else 'regular_ll_sfc_grib2')
+    try:
+        for key, value in [('Ni', ni), ('Nj', nj),
+                           ('latitudeOfFirstGridPointInDegrees', 43.18),
+                           ('longitudeOfFirstGridPointInDegrees', 356.06),
+                           ('latitudeOfLastGridPointInDegrees', 43.18 + 0.02 * (nj - 1)),
+                           ('longitudeOfLastGridPointInDegrees', (356.06 + 0.02 * (ni - 1)) % 360),
+                           ('iDirectionIncrementInDegrees', 0.02),
+                           ('jDirectionIncrementInDegrees', 0.02),
+                           ('jScansPositively', 1), ('dataDate', int(run_string[:8])),
+                           ('dataTime', int(run_string[8:]) * 100),
+                           ('stepUnits', 'h'), ('endStep', step), ('bitsPerValue', 16)]:
+            eccodes.codes_set(gid, key, value)
+        eccodes.codes_set(gid, 'shortName', name)
+        if level:
+            eccodes.codes_set(gid, 'level', level)
+        y, x = np.mgrid[0:nj, 0:ni]
+        values = 270 + 10 * np.sin(y / 50. + step / 6.) * np.cos(x / 80.) \
+            + np.random.normal(scale=0.3, size=(nj, ni))
+        eccodes.codes_set_values(gid, values.ravel())
+        return eccodes.codes_get_message(gid)
+    finally:
+        eccodes.codes_release(gid)
+
+
+def grib_payload(name, shape=grid_shape):
+    """bz2 compressed GRIB file matching the variable, run, step and level in name"""
+    match = re.search(r'_(\d{10})_(\d{3})_(\w+?)_(.+)\.grib2\.bz2$', name)
+    run_string, step, level, var = match.group(1), int(match.group(2)), match.group(3), match.group(4)
+    if 'pressure-level' in name:
+        message = grib_message(step, short_names.get(var, 't'), int(level), run_string, shape)
+    else:
+        message = grib_message(step, short_names.get(var, '2t'), None, run_string, shape)
+    return bz2.compress(message)
+
+
+def icon_d2_tree(run_string, vars_2d=variables_2d, vars_3d=variables_3d,
+                 levels=levels_3d, f_steps=steps, prefix='/weather/nwp/icon-d2/grib/'):
+    """Map every directory of the server to the names of the files it contains"""
+    run = run_string[-2:]
+    tree = {}
+    for var in vars_2d:
+        tree['%s%s/%s/' % (prefix, run, var)] = [
+            'icon-d2_germany_regular-lat-lon_single-level_%s_%03d_2d_%s.grib2.bz2' % (run_string, s, var)
+            for s in f_steps]
+    for var in vars_3d:
+        tree['%s%s/%s/' % (prefix, run, var)] = [
+            'icon-d2_germany_regular-lat-lon_pressure-level_%s_%03d_%s_%s.grib2.bz2' % (run_string, s, l, var)
+            for s in f_steps for l in levels]
+    tree['%s%s/hsurf/' % (prefix, run)] = [
+        'icon-d2_germany_regular-lat-lon_time-invariant_%s_000_0_hsurf.grib2.bz2' % run_string]
+    return tree
+
+
+def icon_d2_eps_tree(date_strings, runs, vars_2d=['t_2m'], vars_3d=['t'], levels=['850'],
+                     f_steps=steps, prefix='/weather/nwp/icon-d2-eps/grib/'):
+    """Same as icon_d2_tree for the ensemble files checked by get_last_run.py.
+    The last date and run in the lists only contain the first steps, as if
+    they were still being published."""
+    tree = {}
+    for run in runs:
+        names = {var: [] for var in vars_2d + vars_3d}
+        for date_string in date_strings:
+            run_string = date_string + run
+            latest = (date_string, run) == (date_strings[-1], runs[-1])
+            run_steps = list(f_steps)[:5] if latest else f_steps
+            for var in vars_2d:
+                names[var] += ['icon-d2-eps_germany_icosahedral_single-level_%s_%03d_2d_%s.grib2.bz2' % (
+                    run_string, s, var) for s in run_steps]
+            for var in vars_3d:
+                names[var] += ['icon-d2-eps_germany_icosahedral_pressure-level_%s_%03d_%s_%s.grib2.bz2' % (
+                    run_string, s, l, var) for s in run_steps for l in levels]
+        for var in names:
+            tree['%s%s/%s/' % (prefix, run, var)] = names[var]
+    return tree
+
+
+def listing_page(path, names):
+    """HTML listing formatted like the nginx autoindex of opendata.dwd.de"""
+    date = datetime.utcnow().strftime('%d-%b-%Y %H:%M')
+    lines = ['<html>', '<head><title>Index of %s</title></head>' % path,
+             '<body>', '<h1>Index of %s</h1><hr><pre><a href="../">../</a>' % path]
+    for name in names:
+        lines.append('<a href="%s">%s</a> %s %20s' % (name, name[:50], date, '-'))
+    lines += ['</pre><hr></body>', '</html>']
+    return '\n'.join(lines).encode()
+
+
+class MockDWDServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tree, payload=synthetic_payload, latency=0., bandwidth=None):
+        self.tree = tree
+        self.payload = payload
+        # Seconds to wait before answering every request, to emulate the round trip
+        self.latency = latency
+        # Bytes/s sent on every connection, unlimited if None
+        self.bandwidth = bandwidth
+        self.last_modified = formatdate(time.time(), usegmt=True)
+        self.files = {}
+        self.lock = threading.Lock()
+        super().__init__(address, MockDWDHandler)
+
+    def get_file(self, path):
+        with self.lock:
+            if path not in self.files:
+                self.files[path] = self.payload(os.path.basename(path))
+            return self.files[path]
+
+    def prefetch(self, prefix=''):
+        """Create all the files under prefix in advance, so that their creation
+        is not measured. Return their total size"""
+        return sum(len(self.get_file(path + name)) for path, names in self.tree.items()
+                   if path.startswith(prefix) for name in names)
+
+
+class MockDWDHandler(BaseHTTPRequestHandler):
+    # Needed for keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.write_throttled(body)
+
+    def write_throttled(self, body, chunk_size=1 << 16):
+        if not self.server.bandwidth:
+            self.wfile.write(body)
+            return
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / self.server.bandwidth)
+
+    def send_listing(self, path, names):
+        etag = '"%s"' % hashlib.md5('\n'.join(names).encode()).hexdigest()
+        if self.headers.get('If-None-Match') == etag or \
+                self.headers.get('If-Modified-Since') == self.server.last_modified:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = listing_page(path, names)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.server.last_modified)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = self.path.split('?')[0]
+        tree = self.server.tree
+        if path in tree:
+            self.send_listing(path, tree[path])
+        elif os.path.dirname(path) + '/' in tree and \
+                os.path.basename(path) in tree[os.path.dirname(path) + '/']:
+            self.send_body(self.server.get_file(path), 'application/octet-stream')
+        else:
+            self.send_error(404)
+
+    do_HEAD = do_GET
+
+
+def start_server(tree, port=0, **kwargs):
+    """Start the server in a background thread and return it together with its base url"""
+    server = MockDWDServer(('127.0.0.1', port), tree, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:%d/weather/nwp/icon-d2/grib/' % server.server_address[1]
+    return server, url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('-r', '--run', required=True, help='Run to serve as YYYYMMDDHH')
+    parser.add_argument('-g', '--grib', action='store_true', help='Serve valid GRIB files')
+    parser.add_argument('-l', '--latency', type=float, default=0.,
+                        help='Latency of every request in seconds')
+    parser.add_argument('-b', '--bandwidth', type=float, default=None,
+                        help='Bandwidth of every connection in bytes/s')
+    args = parser.parse_args()
+
+    server, url = start_server(icon_d2_tree(args.run), port=args.port,
+                               payload=grib_payload if args.grib else synthetic_payload,
+                               latency=args.latency, bandwidth=args.bandwidth)
+    print('Serving %s' % url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
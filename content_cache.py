@@ -0,0 +1,94 @@
+"""Content-addressed cache of the files which rarely change between runs.
+
+The invariant fields (e.g. HSURF) are the same for every run, but their files on
+the server have the run in the name and the processed files in MODEL_DATA_FOLDER
+are deleted at every run. The processed files are instead stored once in
+cache_folder (by default MODEL_DATA_FOLDER/cache/, which is not touched by the
+cleaning in copy_data.run) under their content hash, with an index mapping a key
+(e.g. the variable and the crop) to the hash. A new run then links the file from
+the cache instead of downloading and converting it again.
+"""
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+
+from manifest import file_hash
+
+cache_folder = os.environ.get('DWD_CACHE_FOLDER',
+                              os.path.join(os.environ.get('MODEL_DATA_FOLDER', '.'), 'cache'))
+# Entries older than this (seconds) are not used, so that the files are downloaded
+# again from time to time in case DWD updates them (e.g. with a new model version).
+# The files on the server can't be compared directly since they differ in the run.
+max_age = 7 * 24 * 3600
+
+
+class ContentCache():
+    def __init__(self, folder=None):
+        self.folder = folder if folder else cache_folder
+        self.objects = os.path.join(self.folder, 'objects')
+        self.index_path = os.path.join(self.folder, 'index.json')
+        self.lock = threading.Lock()
+        os.makedirs(self.objects, exist_ok=True)
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest)
+
+    def get(self, key, max_age=max_age):
+        """Entry of key if its object is in the cache and it's not too old"""
+        with self.lock:
+            entry = self._load().get(key)
+        if entry is None or time.time() - entry['time'] > max_age:
+            return None
+        path = self.object_path(entry['hash'])
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+            return None
+        return entry
+
+    def restore(self, entry, path):
+        """Put the object of entry at path, as a hard link when possible"""
+        tmp_path = path + '.part'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(self.object_path(entry['hash']), tmp_path)
+        except OSError:
+            shutil.copyfile(self.object_path(entry['hash']), tmp_path)
+        os.replace(tmp_path, path)
+
+    def put(self, key, path, digest=None, **attrs):
+        """Store the content of path under key. Other attributes (e.g. the
+        run it comes from) are kept in the entry"""
+        digest = digest if digest else file_hash(path)
+        object_path = self.object_path(digest)
+        if not os.path.isfile(object_path):
+            tmp_path = '%s.%d.part' % (object_path, os.getpid())
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, object_path)
+        entry = dict(hash=digest, size=os.path.getsize(object_path), time=time.time(), **attrs)
+        with self.lock, open(self.index_path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = self._load()
+            index[key] = entry
+            self.prune(index)
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f, indent=1)
+            os.replace(tmp_path, self.index_path)
+        return entry
+
+    def prune(self, index):
+        """Remove the objects which are not referenced by index anymore"""
+        used = set(e['hash'] for e in index.values())
+        for name in os.listdir(self.objects):
+            if name not in used and not name.endswith('.part'):
+                os.remove(os.path.join(self.objects, name))
@@ -0,0 +1,446 @@
+"""Asynchronous download engine for the ICON-D2 files on the DWD opendata server.
+
+All the variables passed on the command line are fetched in a single event loop
+which shares one pool of keep-alive connections, so that we don't open a new TLS
+connection for every file as the wget/parallel fan-out used to do.
+Files are decompressed while they are streamed and converted into a single
+NETCDF file (see ingest.convert_files) as soon as all the timesteps of a variable
+are on disk.
+With --in-memory the decompressed GRIB files are instead decoded in memory and
+written directly into the final NETCDF file, so that they never touch the disk.
+
+Example (same as download_merge_2d_variable_icon_d2 for every variable)
+
+    python download_dwd.py 2d t_2m td_2m pmsl
+"""
+import argparse
+import asyncio
+import bz2
+import json
+import os
+import random
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import pandas as pd
+
+import ingest  # also puts plotting/ in the path
+import catalog
+import point_store
+import run_store
+from content_cache import ContentCache
+from domains import bbox_to_string, get_crop_bbox
+from manifest import Manifest, manifest_file, new_hash
+
+base_url = os.environ.get('DWD_BASE_URL',
+                          'https://opendata.dwd.de/weather/nwp/icon-d2/grib/')
+
+# Connection pool options
+max_connections = 32
+max_connections_per_host = 10
+keepalive_timeout = 60
+# Retry options: wait backoff_base * 2**attempt (+ jitter) between attempts
+max_retries = 4
+backoff_base = 0.5
+chunk_size = 1 << 16
+# Maximum number of variables converted at the same time
+max_conversions = 4
+
+levels_3d = ['950', '850', '700', '500']
+# Kinds of variables which are kept in the cross-run cache
+cached_kinds = ['invariant']
+# Only the union of the domains of the plotted projections (plus a margin) is stored
+crop_bbox = get_crop_bbox()
+
+
+def get_run_string():
+    """Read the run to process from the environment, as set by copy_data.run"""
+    return '%s%s%s%s' % (os.environ['year'], os.environ['month'],
+                         os.environ['day'], os.environ['run'])
+
+
+def file_pattern(var, kind, run_string, levels=levels_3d):
+    """Regex matching the files of one variable in the server listing.
+    This is the same as filename_grep in functions_download_dwd.sh"""
+    if kind == '2d':
+        return r'icon-d2_germany_regular-lat-lon_single-level_%s_(.*)_2d_%s\.grib2\.bz2' % (
+            run_string, re.escape(var))
+    elif kind == '3d':
+        return r'icon-d2_germany_regular-lat-lon_pressure-level_%s_(.*)_(%s)_%s\.grib2\.bz2' % (
+            run_string, '|'.join(levels), re.escape(var))
+    elif kind == 'invariant':
+        return r'icon-d2_germany_regular-lat-lon_time-invariant_%s_000_0_%s\.grib2\.bz2' % (
+            run_string, re.escape(var))
+    else:
+        raise ValueError('kind must be one of 2d, 3d, invariant')
+
+
+def output_file(var, run_string):
+    """Name of the merged NETCDF file for one variable"""
+    return '%s_%s_de.nc' % (var, run_string)
+
+
+def output_file_kind(var, kind, run_string):
+    """Invariant files are named with the variable in capital letters"""
+    if kind == 'invariant':
+        return output_file(var.upper(), run_string)
+    return output_file(var, run_string)
+
+
+async def with_retries(coro_function, *args):
+    """Call coro_function(*args) retrying with exponential backoff on network errors"""
+    for attempt in range(max_retries + 1):
+        try:
+            return await coro_function(*args)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == max_retries:
+                raise
+            wait = backoff_base * 2 ** attempt * (1 + random.random())
+            print('Retrying %s in %3.1f s (%s)' % (args[-1], wait, e))
+            await asyncio.sleep(wait)
+
+
+async def _get_listing(session, url):
+    async with session.get(url) as response:
+        response.raise_for_status()
+        return await response.text()
+
+
+async def list_urls(session, url, pattern):
+    """Return all the files in the listing at url whose name matches pattern"""
+    text = await with_retries(_get_listing, session, url)
+    regex = re.compile(pattern)
+    files = sorted(set(href for href in re.findall(r'href="([^"]+)"', text)
+                       if regex.fullmatch(href)))
+    return [url + f for f in files]
+
+
+async def _fetch_and_extract(session, manifest, url):
+    file = os.path.basename(url).replace('.bz2', '')
+    tmp_file = file + '.part'
+    decompressor = bz2.BZ2Decompressor()
+    digest = new_hash()
+    async with session.get(url) as response:
+        response.raise_for_status()
+        with open(tmp_file, 'wb') as f:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                data = decompressor.decompress(chunk)
+                digest.update(data)
+                f.write(data)
+    if not decompressor.eof:
+        os.remove(tmp_file)
+        raise aiohttp.ClientPayloadError('Truncated bz2 stream')
+    # Only complete files get the final name, so that an interrupted download
+    # is never mistaken for a good one
+    os.replace(tmp_file, file)
+    if manifest is not None:
+        manifest.record(file, digest=digest.hexdigest(), url=url)
+    return file
+
+
+async def fetch_and_extract(session, url, manifest=None):
+    """Download url and decompress it on the fly in the current folder.
+    Without a manifest files already on disk are trusted, otherwise they are
+    only reused if they match their entry in the manifest."""
+    file = os.path.basename(url).replace('.bz2', '')
+    if manifest is None and os.path.isfile(file):
+        return file
+    if manifest is not None and manifest.verify(file):
+        return file
+    return await with_retries(_fetch_and_extract, session, manifest, url)
+
+
+async def _fetch_and_decode(session, url, store):
+    decompressor = bz2.BZ2Decompressor()
+    chunks = []
+    async with session.get(url) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(chunk_size):
+            chunks.append(decompressor.decompress(chunk))
+    if not decompressor.eof:
+        raise aiohttp.ClientPayloadError('Truncated bz2 stream')
+    # eccodes releases the GIL so the decoding can run in a thread
+    await asyncio.get_running_loop().run_in_executor(None, ingest.decode_into,
+                                                     b''.join(chunks), store)
+
+
+async def fetch_and_decode(session, url, store):
+    """Download url, decompress and decode it in memory writing the fields into store"""
+    await with_retries(_fetch_and_decode, session, url, store)
+
+
+def get_steps(urls):
+    """Forecast steps (in hours) of the files in urls"""
+    return sorted(set(int(re.search(r'_\d{10}_(\d{3})_', u).group(1)) for u in urls))
+
+
+def get_times(urls, run_string):
+    """Validity times of the files in urls"""
+    run = pd.to_datetime(run_string, format='%Y%m%d%H')
+    return [run + pd.Timedelta(hours=step) for step in get_steps(urls)]
+
+
+def get_levels(urls, kind):
+    """Pressure levels (in hPa) of the files in urls"""
+    if kind != '3d':
+        return None
+    levels = set(re.search(r'_\d{10}_\d{3}_(\d+)_', u).group(1) for u in urls)
+    return sorted(levels, key=int, reverse=True)
+
+
+def convert_variable(files, var, kind, run_string):
+    """Convert the GRIB files of a variable into a single NETCDF file"""
+    store = ingest.VariableStore(output_file_kind(var, kind, run_string),
+                                 get_times(files, run_string),
+                                 levels=get_levels(files, kind), crop=crop_bbox,
+                                 compression=ingest.compression, packing=ingest.packing(var))
+    ingest.convert_files(files, store)
+
+
+def output_attrs(var, kind, levels=None):
+    """Attributes recorded in the manifest for the NETCDF files, so that they are
+    created again when the crop (e.g. a new projection is added), the levels or
+    the packing change"""
+    attrs = {'crop': bbox_to_string(crop_bbox) if crop_bbox is not None else None}
+    if kind == '3d':
+        attrs['levels'] = ','.join(levels or levels_3d)
+    packing = ingest.packing(var)
+    if packing is not None:
+        attrs['packing'] = '%s %g %g' % (packing['dtype'], packing['scale_factor'],
+                                         packing['add_offset'])
+    return attrs
+
+
+async def download_files(session, var, kind, run_string, manifest=None, levels=None):
+    """Download and decompress all the files of a variable, return their names"""
+    url = '%s%s/%s/' % (base_url, run_string[-2:], var)
+    urls = await list_urls(session, url, file_pattern(var, kind, run_string, levels or levels_3d))
+    if not urls:
+        print('No files found for %s in %s' % (var, url))
+    return await asyncio.gather(*[fetch_and_extract(session, u, manifest) for u in urls])
+
+
+async def ingest_variable(session, var, kind, run_string, manifest=None, levels=None):
+    """Download all the files of a variable and decode them in memory into a single NETCDF"""
+    url = '%s%s/%s/' % (base_url, run_string[-2:], var)
+    urls = await list_urls(session, url, file_pattern(var, kind, run_string, levels or levels_3d))
+    if not urls:
+        print('No files found for %s in %s' % (var, url))
+        return
+    store = ingest.VariableStore(output_file_kind(var, kind, run_string),
+                                 get_times(urls, run_string), levels=get_levels(urls, kind),
+                                 crop=crop_bbox, compression=ingest.compression,
+                                 packing=ingest.packing(var))
+    tasks = [asyncio.ensure_future(fetch_and_decode(session, u, store)) for u in urls]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other downloads and leave nothing half written behind
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        store.discard()
+        raise
+    store.close()
+    if manifest is not None:
+        manifest.record(store.path, **output_attrs(var, kind, levels))
+        manifest.save()
+    print('Finished %s' % var)
+
+
+async def _download_variable(session, convert_semaphore, var, kind, run_string,
+                             in_memory, manifest, levels):
+    output = output_file_kind(var, kind, run_string)
+    if manifest is None:
+        manifest = Manifest(manifest_file(run_string))
+    if in_memory:
+        return await ingest_variable(session, var, kind, run_string, manifest, levels)
+    files = await download_files(session, var, kind, run_string, manifest, levels)
+    if not files:
+        return
+    # Save what we have so that a failure in the conversion doesn't need a new download
+    manifest.save()
+    async with convert_semaphore:
+        await asyncio.get_running_loop().run_in_executor(None, convert_variable,
+                                                         files, var, kind, run_string)
+    manifest.record(output, **output_attrs(var, kind, levels))
+    for f in files:
+        os.remove(f)
+        manifest.remove(f)
+    manifest.save()
+    print('Finished %s' % var)
+
+
+def cache_key(var, kind, levels=None):
+    """Key of a processed file in the cross-run cache: whatever changes its content"""
+    return json.dumps(dict(var=var, compression=ingest.compression,
+                           **output_attrs(var, kind, levels)), sort_keys=True)
+
+
+async def download_variable(session, convert_semaphore, var, kind, run_string,
+                            in_memory=False, manifest=None, levels=None):
+    """Download all the files of a variable and convert them into a single NETCDF.
+    Nothing is done if the NETCDF is already there and matches the manifest (the
+    one of run_string when none is given).
+    For 3D variables only levels (default levels_3d) are downloaded.
+    Variables of cached_kinds are taken from the cross-run cache when they were
+    processed recently enough (see content_cache.py)."""
+    output = output_file_kind(var, kind, run_string)
+    if manifest is None:
+        manifest = Manifest(manifest_file(run_string))
+    if manifest.verify(output, **output_attrs(var, kind, levels)):
+        return
+    if kind not in cached_kinds:
+        return await _download_variable(session, convert_semaphore, var, kind, run_string,
+                                        in_memory, manifest, levels)
+
+    cache = ContentCache()
+    key = cache_key(var, kind, levels)
+    entry = cache.get(key)
+    if entry is not None:
+        cache.restore(entry, output)
+        manifest.record(output, digest=entry['hash'], **output_attrs(var, kind, levels))
+        manifest.save()
+        print('Restored %s from the cache' % var)
+        return
+    await _download_variable(session, convert_semaphore, var, kind, run_string,
+                             in_memory, manifest, levels)
+    if manifest.get(output) is not None:
+        cache.put(key, output, digest=manifest.get(output)['hash'], run=run_string)
+
+
+def create_session():
+    """Session with a pool of keep-alive connections capped per host"""
+    connector = aiohttp.TCPConnector(limit=max_connections,
+                                     limit_per_host=max_connections_per_host,
+                                     keepalive_timeout=keepalive_timeout)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def download_plan(plan, run_string, in_memory=False):
+    """Download (and convert) concurrently sharing one connection pool the variables
+    in plan, a list of dictionaries with var, kind and levels (see planner.py).
+    Requests are served by the pool in the order they are made, so the variables
+    at the beginning of the plan are completed first."""
+    convert_semaphore = asyncio.Semaphore(max_conversions)
+    manifest = Manifest(manifest_file(run_string))
+    async with create_session() as session:
+        results = await asyncio.gather(*[download_variable(session, convert_semaphore,
+                                                           p['var'], p['kind'], run_string,
+                                                           in_memory=in_memory,
+                                                           manifest=manifest,
+                                                           levels=p.get('levels'))
+                                         for p in plan],
+                                       return_exceptions=True)
+    manifest.save()
+    failed = [(p['var'], r) for p, r in zip(plan, results) if isinstance(r, Exception)]
+    for var, error in failed:
+        print('Could not download %s: %s' % (var, error))
+    update_catalog(plan, run_string, manifest)
+
+    return failed
+
+
+def file_variable(output, run_string):
+    """Variable as named in the NETCDF file name, e.g. HSURF, which is the
+    name used by read_dataset"""
+    return os.path.basename(output).split('_%s' % run_string)[0]
+
+
+def update_catalog(plan, run_string, manifest=None):
+    """Record the complete NETCDF files of the variables in plan in the catalog
+    of the folder (see plotting/catalog.py), which is what read_dataset queries"""
+    manifest = manifest if manifest else Manifest(manifest_file(run_string))
+    files = {}
+    for p in plan:
+        output = output_file_kind(p['var'], p['kind'], run_string)
+        if manifest.get(output) is not None and os.path.isfile(output):
+            files[file_variable(output, run_string)] = output
+    if files:
+        catalog.add_files('.', run_string, files)
+
+
+def update_run_store(plan, run_string):
+    """Copy the NETCDF files of the variables in plan into the per-run Zarr store
+    (see plotting/run_store.py), with the layouts in the plan (maps by default).
+    Variables already copied from the same file are skipped, so this can be
+    called again after a partial failure."""
+    manifest = Manifest(manifest_file(run_string))
+    path = run_store.store_path('.', run_string)
+
+    def write(p):
+        output = output_file_kind(p['var'], p['kind'], run_string)
+        entry = manifest.get(output)
+        if entry is None or not os.path.isfile(output):
+            return
+        var = file_variable(output, run_string)
+        layouts = [l for l in p.get('layouts', ['maps'])
+                   if not run_store.is_written(path, var, l, entry['hash'])]
+        if layouts:
+            run_store.write_variable(path, var, output, layouts, source_hash=entry['hash'])
+
+    with ThreadPoolExecutor(max_conversions) as pool:
+        list(pool.map(write, plan))
+    run_store.consolidate(path)
+    print('Updated %s' % path)
+
+
+def update_point_store(plan, run_string):
+    """Write the point store of the run (see plotting/point_store.py) with the
+    variables in plan read at points, the ones with the columns layout"""
+    manifest = Manifest(manifest_file(run_string))
+    files = {}
+    for p in plan:
+        output = output_file_kind(p['var'], p['kind'], run_string)
+        if 'columns' in p.get('layouts', []) and manifest.get(output) is not None \
+                and os.path.isfile(output):
+            files[file_variable(output, run_string)] = output
+    if not files:
+        return
+    path = point_store.store_path('.', run_string)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    point_store.write_store(path, files)
+    print('Updated %s' % path)
+
+
+async def download_variables(variables, kind, run_string, in_memory=False):
+    """Download (and convert) variables of the same kind"""
+    return await download_plan([{'var': var, 'kind': kind} for var in variables],
+                               run_string, in_memory=in_memory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('kind', choices=['2d', '3d', 'invariant'],
+                        help='Type of the variables to download')
+    parser.add_argument('variables', nargs='+',
+                        help='Variables to download, as named on the DWD server')
+    parser.add_argument('-r', '--run', default=None,
+                        help='Run as YYYYMMDDHH, defaults to the one in the environment')
+    parser.add_argument('-m', '--in-memory', action='store_true',
+                        help='Decode the GRIB files in memory instead of writing them to disk')
+    parser.add_argument('--no-crop', action='store_true',
+                        help='Store the whole ICON-D2 domain instead of the plotted projections')
+    parser.add_argument('--run-store', action='store_true',
+                        help='Also copy the variables into the per-run Zarr store')
+    args = parser.parse_args()
+
+    if args.no_crop:
+        global crop_bbox
+        crop_bbox = None
+
+    run_string = args.run if args.run else get_run_string()
+    failed = asyncio.run(download_variables(args.variables, args.kind, run_string,
+                                            in_memory=args.in_memory))
+    if args.run_store:
+        update_run_store([{'var': var, 'kind': args.kind} for var in args.variables], run_string)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
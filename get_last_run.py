@@ -1,21 +1,21 @@
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import re
+import tempfile
+import threading
 import requests
-from bs4 import BeautifulSoup
 import pandas as pd
 import argparse
 
-
-parser = argparse.ArgumentParser()
-parser.add_argument('-r', '--run', help='Run to search for, otherwise defaults to all runs available for the model',
-                    required=False, default=None)
-parser.add_argument('-v2d', '--vars_2d', help='List of 2d variables to be checked',
-                    required=False, default=None, nargs='+')
-parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables to be checked',
-                    required=False, default=['t'], nargs='+')
-parser.add_argument('-l', '--levels_3d', help='List of 3d levels to be checked',
-                    required=False, default=['850'], nargs='+')
-
-args = parser.parse_args()
+# Listings already downloaded are cached on disk together with their ETag and
+# Last-Modified headers, so that we only need conditional requests to check them
+cache_file = os.path.join(os.environ.get('MODEL_DATA_FOLDER', tempfile.gettempdir()),
+                          'listings_cache.json')
+# Number of runs probed at the same time
+max_workers = 16
+href_regex = re.compile(r'href="([^"]+)"')
 
 var_2d_list = ['alb_rad', 'alhfl_s', 'ashfl_s', 'asob_s', 'asob_t', 'aswdifd_s', 'aswdifu_s',
                'aswdir_s', 'athb_s', 'cape_ml', 'cin_ml', 'clch', 'clcl', 'clcm', 'clct',
@@ -29,15 +29,79 @@ var_3d_list = ['clc', 'fi', 'omega', 'p',
                'qv', 'relhum', 't', 'tke', 'u', 'v', 'w']
 
 
-def get_url_paths(url, ext='', prefix='', params={}):
-    response = requests.get(url, params=params)
-    if response.ok:
-        response_text = response.text
-    else:
-        return response.raise_for_status()
-    soup = BeautifulSoup(response_text, 'html.parser')
-    parent = [url + node.get('href') for node in soup.find_all('a') if (
-        node.get('href').endswith(ext)) & (node.get('href').startswith(prefix))]
+class ListingCache():
+    """Small on-disk cache of the directory listings of the server"""
+
+    def __init__(self, path=None):
+        self.path = path if path else cache_file
+        self.lock = threading.Lock()
+        self.modified = False
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, url):
+        with self.lock:
+            return self.entries.get(url)
+
+    def put(self, url, etag, last_modified, hrefs):
+        with self.lock:
+            self.entries[url] = {'etag': etag, 'last_modified': last_modified,
+                                 'hrefs': hrefs}
+            self.modified = True
+
+    def save(self):
+        if not self.modified:
+            return
+        tmp_path = self.path + '.tmp'
+        with self.lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+
+def parse_hrefs(response):
+    """Extract the links from a listing while it is streamed, without building
+    a full document tree"""
+    hrefs = []
+    tail = ''
+    for chunk in response.iter_content(chunk_size=65536, decode_unicode=True):
+        text = tail + chunk
+        last = 0
+        for match in href_regex.finditer(text):
+            hrefs.append(match.group(1))
+            last = match.end()
+        # Keep the part after the last link in case a link is split between chunks
+        tail = text[max(last, len(text) - 1024):]
+    return hrefs
+
+
+def get_url_paths(url, ext='', prefix='', params={}, session=None, cache=None):
+    if session is None:
+        session = requests
+    headers = {}
+    cached = cache.get(url) if cache is not None else None
+    if cached is not None:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    with session.get(url, params=params, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            hrefs = cached['hrefs']
+        elif response.ok:
+            if response.encoding is None:
+                response.encoding = 'utf-8'
+            hrefs = parse_hrefs(response)
+            if cache is not None:
+                cache.put(url, response.headers.get('ETag'),
+                          response.headers.get('Last-Modified'), hrefs)
+        else:
+            return response.raise_for_status()
+    parent = [url + href for href in hrefs if (
+        href.endswith(ext)) & (href.startswith(prefix))]
     return parent
 
 
@@ -47,7 +111,9 @@ def find_file_name(vars_2d=None,
                    base_url="https://opendata.dwd.de/weather/nwp",
                    model_url="icon-d2-eps/grib",
                    date_string=None,
-                   run_string=None):
+                   run_string=None,
+                   session=None,
+                   cache=None):
 
     f_times = list(range(0, 49))
 
@@ -86,7 +152,8 @@ def find_file_name(vars_2d=None,
                                      (base_url, model_url, run_string, var,
                                       var_url, date_string, run_string, f_time, var))
             urls_on_server = get_url_paths("%s/%s/%s/%s/" % (base_url, model_url, run_string, var),
-                                           'grib2.bz2', prefix=var_url)
+                                           'grib2.bz2', prefix=var_url,
+                                           session=session, cache=cache)
             if set(urls_to_check).issubset(urls_on_server):
                 data['status'].append('all files available')
                 data['avail_tsteps'].append(len(urls_to_check))
@@ -112,7 +179,8 @@ def find_file_name(vars_2d=None,
                                          (base_url, model_url, run_string, var,
                                           var_url, date_string, run_string, f_time, plev, var))
             urls_on_server = get_url_paths("%s/%s/%s/%s/" % (base_url, model_url, run_string, var),
-                                           'grib2.bz2', prefix=var_url)
+                                           'grib2.bz2', prefix=var_url,
+                                           session=session, cache=cache)
             if set(urls_to_check).issubset(urls_on_server):
                 data['status'].append('all files available')
                 data['avail_tsteps'].append(len(urls_to_check))
@@ -129,8 +197,18 @@ def find_file_name(vars_2d=None,
     return df
 
 
+def create_session():
+    """Session keeping a pool of connections open for all the probes"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers,
+                                            pool_maxsize=max_workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 def get_most_recent_run(run=None, vars_2d=None, vars_3d=['t'],
-                        levels_3d=['850']):
+                        levels_3d=['850'], use_cache=True, partial=False, **kwargs):
     today_string = datetime.now().strftime('%Y%m%d')
     yesterday_string = (datetime.today() -
                         timedelta(days=1)).strftime('%Y%m%d')
@@ -138,24 +216,52 @@ def get_most_recent_run(run=None, vars_2d=None, vars_3d=['t'],
         runs = ['00', '03', '06', '09', '12', '15', '18', '21']
     else:
         runs = [run]
-    temp = []
-    for date_string in [yesterday_string, today_string]:
-        for run_string in runs:
+    cache = ListingCache() if use_cache else None
+    # All the runs are probed concurrently
+    with create_session() as session, ThreadPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(find_file_name, vars_2d=vars_2d,
+                               vars_3d=vars_3d,
+                               levels_3d=levels_3d,
+                               date_string=date_string,
+                               run_string=run_string,
+                               session=session,
+                               cache=cache, **kwargs)
+                   for date_string in [yesterday_string, today_string]
+                   for run_string in runs]
+        temp = []
+        for future in futures:
             try:
-                temp.append(find_file_name(vars_2d=vars_2d,
-                                           vars_3d=vars_3d,
-                                           levels_3d=levels_3d,
-                                           date_string=date_string,
-                                           run_string=run_string))
+                temp.append(future.result())
             except:
                 continue
+    if cache is not None:
+        cache.save()
 
     final = pd.concat(temp)
-    sel_run = final.loc[final.status == 'all files available', 'run'].max()
+    if partial:
+        # Most recent run which has started to be published
+        sel_run = final.loc[final.avail_tsteps > 0, 'run'].max()
+    else:
+        sel_run = final.loc[final.status == 'all files available', 'run'].max()
     return final, sel_run
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--run', help='Run to search for, otherwise defaults to all runs available for the model',
+                        required=False, default=None)
+    parser.add_argument('-v2d', '--vars_2d', help='List of 2d variables to be checked',
+                        required=False, default=None, nargs='+')
+    parser.add_argument('-v3d', '--vars_3d', help='List of 3d variables to be checked',
+                        required=False, default=['t'], nargs='+')
+    parser.add_argument('-l', '--levels_3d', help='List of 3d levels to be checked',
+                        required=False, default=['850'], nargs='+')
+    parser.add_argument('-p', '--partial', help='Return the most recent run even if not all the files are available yet',
+                        required=False, action='store_true')
+
+    args = parser.parse_args()
+
     final, sel_run = get_most_recent_run(run=args.run, vars_2d=args.vars_2d,
-                        vars_3d=args.vars_3d, levels_3d=args.levels_3d)
+                        vars_3d=args.vars_3d, levels_3d=args.levels_3d,
+                        partial=args.partial)
     print(sel_run)
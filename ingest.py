@@ -0,0 +1,324 @@
+"""Decode ICON-D2 GRIB messages and write them into the per-variable NETCDF files.
+
+The files have the same layout that `cdo -f nc copy` used to produce (same variable
+names, dimensions and attributes) so that they can be read by utils.read_dataset.
+GRIB files already on disk are converted with convert_files, which replaces the
+cdo mergetime/seltime chain: the files (i.e. steps and levels) are decoded in a
+thread pool and every field is written once in its slot of the output.
+"""
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import eccodes
+import netCDF4
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plotting'))
+from domains import bbox_to_string
+
+fill_value = np.float32(-9e33)
+# Threads used to decode the GRIB files in convert_files
+max_workers = min(8, os.cpu_count() or 1)
+# NETCDF4 compression of the files which are not read while they are written,
+# chosen with NETCDF_COMPRESSION. zstd compresses about as well as zlib but is
+# faster to decode; it needs the HDF5 filter plugins to be installed (e.g. with
+# netCDF4 >= 1.6 or hdf5plugin) both when writing and when reading the files.
+compressions = {
+    'zlib': {'compression': 'zlib', 'complevel': 1, 'shuffle': True},
+    'zstd': {'compression': 'zstd', 'complevel': 1, 'shuffle': True},
+    'none': None,
+}
+compression = compressions[os.environ.get('NETCDF_COMPRESSION', 'zlib')]
+# netCDF-C and HDF5 are not thread-safe: every call into them made by the
+# VariableStores of this process (create, write, sync, close) holds this lock,
+# so that the stores of different variables can be filled from many threads
+netcdf_lock = threading.Lock()
+# Variables (as named on the DWD server) which are only plotted and can be stored
+# packed as integers with PACKED_STORAGE=1: (dtype, scale_factor, add_offset,
+# max_error). Values are rounded to the nearest multiple of scale_factor (so the
+# error is at most scale_factor / 2, checked against max_error) and clipped to
+# the range of dtype; the largest value of dtype is the fill value.
+# This reduces the size on disk (and what is read) only: read_dataset decodes the
+# values to float32, so they take the same memory once loaded.
+packed_variables = {
+    'clcl': ('u1', 0.4, 0., 0.2),
+    'clcm': ('u1', 0.4, 0., 0.2),
+    'clch': ('u1', 0.4, 0., 0.2),
+    'clct': ('u1', 0.4, 0., 0.2),
+    'clc': ('u1', 0.4, 0., 0.2),
+    # Integer codes, stored exactly
+    'ww': ('u1', 1., 0., 0.5),
+    'relhum': ('i2', 0.01, 0., 0.005),
+    'dbz_cmax': ('i2', 0.01, 0., 0.005),
+    'synmsg_bt_cl_ir10.8': ('i2', 0.01, 250., 0.005),
+}
+packed_storage = os.environ.get('PACKED_STORAGE', '0') == '1'
+
+
+def packing(var):
+    """Packing of var (see packed_variables) as a dictionary with dtype,
+    scale_factor, add_offset, the valid range and the fill value, None if var
+    is not packed"""
+    if not packed_storage or var not in packed_variables:
+        return None
+    dtype, scale_factor, add_offset, max_error = packed_variables[var]
+    if scale_factor / 2 > max_error:
+        raise ValueError('The error of %s would be up to %g, more than %g' % (
+            var, scale_factor / 2, max_error))
+    info = np.iinfo(dtype)
+    return {'dtype': dtype, 'scale_factor': np.float32(scale_factor),
+            'add_offset': np.float32(add_offset), 'fill_value': info.max,
+            'valid_min': add_offset + scale_factor * info.min,
+            'valid_max': add_offset + scale_factor * (info.max - 1)}
+
+
+def split_messages(data):
+    """Yield every GRIB message contained in data without copying it"""
+    view = memoryview(data)
+    start = data.find(b'GRIB')
+    while start >= 0:
+        edition = data[start + 7]
+        if edition == 2:
+            length = int.from_bytes(data[start + 8:start + 16], 'big')
+        else:
+            length = int.from_bytes(data[start + 4:start + 7], 'big')
+        yield view[start:start + length]
+        start = data.find(b'GRIB', start + length)
+
+
+def decode_message(message):
+    """Decode a single GRIB message into a dictionary with data and metadata"""
+    gid = eccodes.codes_new_from_message(bytes(message))
+    try:
+        get = lambda key: eccodes.codes_get(gid, key)
+        ni, nj = get('Ni'), get('Nj')
+        values = eccodes.codes_get_values(gid).astype(np.float32).reshape(nj, ni)
+        if get('bitmapPresent'):
+            values[values == get('missingValue')] = np.nan
+        lat = np.linspace(get('latitudeOfFirstGridPointInDegrees'),
+                          get('latitudeOfLastGridPointInDegrees'), nj)
+        lon_first = get('longitudeOfFirstGridPointInDegrees')
+        lon_last = get('longitudeOfLastGridPointInDegrees')
+        if lon_last < lon_first:
+            lon_last += 360.
+        lon = np.linspace(lon_first, lon_last, ni)
+        lon = ((lon + 180) % 360) - 180
+        # Always store latitudes in increasing order as cdo does
+        if lat[0] > lat[-1]:
+            lat, values = lat[::-1], values[::-1, :]
+        field = {
+            'name': get('shortName'),
+            'long_name': get('name'),
+            'units': get('units'),
+            'standard_name': get('cfName') if eccodes.codes_is_defined(gid, 'cfName') else 'unknown',
+            'time': pd.to_datetime('%d%04d' % (get('validityDate'), get('validityTime')),
+                                   format='%Y%m%d%H%M'),
+            'run': pd.to_datetime('%d%04d' % (get('dataDate'), get('dataTime')),
+                                  format='%Y%m%d%H%M'),
+            'level_type': get('typeOfLevel'),
+            'level': get('level'),
+            'lat': lat,
+            'lon': lon,
+            'values': values,
+        }
+    finally:
+        eccodes.codes_release(gid)
+
+    return field
+
+
+def decode_messages(data):
+    """Decode all the GRIB messages in a (decompressed) file content"""
+    return [decode_message(m) for m in split_messages(data)]
+
+
+class VariableStore():
+    """NETCDF file of one variable which is filled one field at a time.
+    The time axis (and the levels for 3D variables) are known in advance from the
+    files listed on the server, so that every decoded field can be written directly
+    in its slot and the GRIB never needs to touch the disk.
+    With in_place=True the file is written directly under its final name and flushed
+    after every field, so that it can be read while the run is still being ingested.
+    When crop=(lon_min, lat_min, lon_max, lat_max) is given only this box is stored
+    and recorded in the crop_bbox global attribute.
+    With compression (e.g. ingest.compression) the file is written as NETCDF4 with
+    one chunk per time step and level, otherwise as NETCDF3 like cdo did. This cannot
+    be used with in_place=True as NETCDF4 files can't be read while being written.
+    With packing (see ingest.packing) the values are stored as integers with the
+    CF scale_factor and add_offset attributes, also in a NETCDF4 file."""
+
+    def __init__(self, path, times, levels=None, in_place=False, crop=None,
+                 compression=None, packing=None):
+        if in_place and (compression or packing):
+            raise ValueError('Compressed or packed files cannot be written in place')
+        self.path = path
+        self.crop = crop
+        self.compression = compression
+        self.packing = packing
+        self.lat_slice, self.lon_slice = slice(None), slice(None)
+        self.in_place = in_place
+        self.tmp_path = path if in_place else path + '.part'
+        self.times = pd.DatetimeIndex(times)
+        # Levels in hPa as they appear in the GRIB files
+        self.levels = [int(l) for l in levels] if levels is not None else None
+        self.nc = None
+        self.var = None
+        self.lock = threading.Lock()
+        # Levels written for every time index (the writes themselves are
+        # serialized by netcdf_lock)
+        self.written = {}
+        self.discarded = False
+
+    def _set_crop(self, lat, lon):
+        if self.crop is None:
+            return
+        lon_min, lat_min, lon_max, lat_max = self.crop
+        ilat = np.flatnonzero((lat >= lat_min) & (lat <= lat_max))
+        ilon = np.flatnonzero((lon >= lon_min) & (lon <= lon_max))
+        if ilat.size == 0 or ilon.size == 0:
+            raise ValueError('The crop box %s does not overlap the grid (lon %g to %g, lat %g to %g)' % (
+                bbox_to_string(self.crop), lon.min(), lon.max(), lat.min(), lat.max()))
+        self.lat_slice = slice(ilat[0], ilat[-1] + 1)
+        self.lon_slice = slice(ilon[0], ilon[-1] + 1)
+
+    def _create(self, field):
+        self._set_crop(field['lat'], field['lon'])
+        nc = netCDF4.Dataset(self.tmp_path, 'w', format='NETCDF4' if self.compression or self.packing
+                             else 'NETCDF3_64BIT_OFFSET')
+        run = field['run']
+        nc.createDimension('time', len(self.times))
+        dims = ['time']
+        if self.levels is not None:
+            nc.createDimension('plev', len(self.levels))
+            dims.append('plev')
+        lat_values = field['lat'][self.lat_slice]
+        lon_values = field['lon'][self.lon_slice]
+        nc.createDimension('lat', len(lat_values))
+        nc.createDimension('lon', len(lon_values))
+        dims += ['lat', 'lon']
+
+        time = nc.createVariable('time', 'f8', ('time',))
+        time.setncatts({'standard_name': 'time', 'axis': 'T',
+                        'units': run.strftime('hours since %Y-%m-%d %H:%M:%S'),
+                        'calendar': 'proleptic_gregorian'})
+        time[:] = (self.times - run) / pd.Timedelta('1 hour')
+        if self.levels is not None:
+            plev = nc.createVariable('plev', 'f8', ('plev',))
+            plev.setncatts({'standard_name': 'air_pressure', 'long_name': 'pressure',
+                            'units': 'Pa', 'positive': 'down', 'axis': 'Z'})
+            plev[:] = np.array(self.levels) * 100.
+        lat = nc.createVariable('lat', 'f8', ('lat',))
+        lat.setncatts({'standard_name': 'latitude', 'long_name': 'latitude',
+                       'units': 'degrees_north', 'axis': 'Y'})
+        lat[:] = lat_values
+        lon = nc.createVariable('lon', 'f8', ('lon',))
+        lon.setncatts({'standard_name': 'longitude', 'long_name': 'longitude',
+                       'units': 'degrees_east', 'axis': 'X'})
+        lon[:] = lon_values
+
+        dtype, var_fill_value = 'f4', fill_value
+        if self.packing:
+            dtype, var_fill_value = self.packing['dtype'], self.packing['fill_value']
+        options = {}
+        if self.compression or self.packing:
+            options['chunksizes'] = (1,) * (len(dims) - 2) + (len(lat_values), len(lon_values))
+        var = nc.createVariable(field['name'], dtype, tuple(dims), fill_value=var_fill_value,
+                                **options, **(self.compression or {}))
+        attrs = {'long_name': field['long_name'], 'units': field['units'],
+                 'missing_value': var_fill_value}
+        if self.packing:
+            # netCDF4 packs the values written (rounding them) with these
+            attrs.update(scale_factor=self.packing['scale_factor'],
+                         add_offset=self.packing['add_offset'])
+        if field['standard_name'] not in ('unknown', '~'):
+            attrs['standard_name'] = field['standard_name']
+        var.setncatts(attrs)
+        nc.setncatts({'Conventions': 'CF-1.6', 'institution': 'DWD',
+                      'source': 'ICON-D2'})
+        if self.crop is not None:
+            nc.setncattr('crop_bbox', bbox_to_string(self.crop))
+        self.nc, self.var = nc, var
+
+    def append(self, field):
+        """Write a decoded field in its slot. Fields which do not belong to the
+        time axis (e.g. the 15 minutes steps) are skipped, as cdo seltime did."""
+        if field['time'] not in self.times:
+            return False
+        it = self.times.get_loc(field['time'])
+        with netcdf_lock:
+            if self.discarded:
+                return False
+            if self.nc is None:
+                self._create(field)
+        values = field['values'][self.lat_slice, self.lon_slice]
+        if self.packing:
+            values = np.ma.masked_invalid(np.clip(values, self.packing['valid_min'],
+                                                  self.packing['valid_max']))
+        else:
+            values = np.where(np.isnan(values), fill_value, values)
+        with netcdf_lock:
+            if self.discarded:
+                return False
+            if self.levels is not None:
+                self.var[it, self.levels.index(int(field['level'])), :, :] = values
+            else:
+                self.var[it, :, :] = values
+            if self.in_place:
+                self.nc.sync()
+        with self.lock:
+            self.written.setdefault(it, set()).add(field['level'])
+        return True
+
+    def complete_times(self):
+        """Times for which all the levels have been written"""
+        n_levels = len(self.levels) if self.levels is not None else 1
+        with self.lock:
+            return self.times[sorted(it for it, levels in self.written.items()
+                                     if len(levels) == n_levels)]
+
+    def close(self):
+        """Close the file and give it its final name"""
+        with netcdf_lock:
+            if self.nc is None:
+                return
+            self.nc.close()
+            self.nc = None
+        if not self.in_place:
+            os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        """Close the file and remove it, after a failure. The fields still
+        being decoded (e.g. in other threads) are then skipped."""
+        with netcdf_lock:
+            self.discarded = True
+            if self.nc is not None:
+                self.nc.close()
+                self.nc = None
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+
+def decode_into(data, store):
+    """Decode the GRIB messages in data and write them into store"""
+    for field in decode_messages(data):
+        store.append(field)
+
+
+def decode_file(path, store):
+    """Decode a GRIB file on disk and write its fields into store"""
+    with open(path, 'rb') as f:
+        decode_into(f.read(), store)
+
+
+def convert_files(files, store, workers=None):
+    """Decode the GRIB files (any order of steps and levels) in a thread pool
+    and write them into store, which is then closed. eccodes releases the GIL
+    so the files are decoded in parallel; only the writes are serialized, also
+    with the ones of the other stores converted at the same time (netcdf_lock)."""
+    with ThreadPoolExecutor(workers or max_workers) as pool:
+        # list() to raise the first exception, if any
+        list(pool.map(lambda f: decode_file(f, store), files))
+    store.close()
@@ -0,0 +1,95 @@
+"""Per-run manifest of the files downloaded and converted in MODEL_DATA_FOLDER.
+
+Every artifact is recorded with its size and content hash only once it is complete,
+so that a rerun after a failure can verify what is already on disk and fetch or
+rebuild only the missing or corrupt pieces.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import threading
+
+hash_chunk_size = 1 << 20
+
+
+def new_hash():
+    return hashlib.blake2b(digest_size=20)
+
+
+def file_hash(path):
+    """Content hash of a file"""
+    h = new_hash()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(hash_chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def manifest_file(run_string):
+    return 'manifest_%s.json' % run_string
+
+
+class Manifest():
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self._load()
+        # Changes not saved yet, applied on top of the file when saving since
+        # other processes may be using the same manifest
+        self.updated = {}
+        self.removed = set()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def verify(self, path, **attrs):
+        """True if path exists and matches the size and hash in the manifest.
+        Additional attributes (e.g. the crop) must also match the recorded ones."""
+        with self.lock:
+            entry = self.entries.get(os.path.basename(path))
+        if entry is None or not os.path.isfile(path):
+            return False
+        if any(entry.get(k) != v for k, v in attrs.items()):
+            return False
+        if os.path.getsize(path) != entry['size']:
+            return False
+        return file_hash(path) == entry['hash']
+
+    def record(self, path, digest=None, **attrs):
+        """Add a complete artifact. The digest can be passed when it was already
+        computed while the file was written, so that it is not read again."""
+        entry = dict(size=os.path.getsize(path),
+                     hash=digest if digest else file_hash(path), **attrs)
+        with self.lock:
+            self.entries[os.path.basename(path)] = entry
+            self.updated[os.path.basename(path)] = entry
+            self.removed.discard(os.path.basename(path))
+
+    def get(self, path):
+        with self.lock:
+            return self.entries.get(os.path.basename(path))
+
+    def remove(self, path):
+        with self.lock:
+            self.entries.pop(os.path.basename(path), None)
+            self.updated.pop(os.path.basename(path), None)
+            self.removed.add(os.path.basename(path))
+
+    def save(self):
+        with self.lock, open(self.path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = self._load()
+            entries.update(self.updated)
+            for name in self.removed:
+                entries.pop(name, None)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f, indent=1)
+            os.replace(tmp_path, self.path)
+            self.entries = entries
+            self.updated, self.removed = {}, set()
@@ -0,0 +1,166 @@
+"""Plan the download from what the enabled plotting scripts actually read.
+
+The read_dataset(variables=..., level=...) calls (and the read_derived ones) of every
+script in plotting/ are parsed (without importing the scripts) to know which variables
+and pressure levels each product needs. Only these are downloaded, ordered so that the inputs of the
+cheapest products (fewest files) come first and these can start as early as possible.
+
+    python planner.py plot_cape.py plot_tmax.py    # download
+    python planner.py -n plot_cape.py plot_tmax.py # only print the plan
+
+With --run-store the variables are also copied into the per-run Zarr store, and
+the ones of the point products into the point store.
+"""
+import argparse
+import ast
+import asyncio
+import os
+
+import download_dwd
+from get_last_run import var_3d_list
+
+plotting_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plotting')
+# Products which read all the steps at a few points: their variables are also
+# stored with the columns layout in the run store (see plotting/run_store.py)
+point_products = ['plot_meteogram.py']
+
+
+def get_kind(var):
+    """Invariant variables are the upper case ones (e.g. HSURF), as they are
+    named in the NETCDF files"""
+    if var.isupper():
+        return 'invariant'
+    return '3d' if var in var_3d_list else '2d'
+
+
+def module_constants(tree):
+    """Module level assignments of literals (e.g. levels = (950, 850)) which
+    may be used in the arguments of read_dataset"""
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+                and isinstance(node.targets[0], ast.Name):
+            try:
+                constants[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    return constants
+
+
+def evaluate(node, constants):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        # e.g. [l * 100 for l in levels]
+        return eval(compile(ast.Expression(node), '<read_dataset>', 'eval'),
+                    {'__builtins__': {}}, dict(constants))
+
+
+def read_dataset_calls(script):
+    """Keyword arguments variables and level of the read_dataset (and read_derived,
+    which takes the function first) calls in script"""
+    with open(os.path.join(plotting_folder, script)) as f:
+        tree = ast.parse(f.read(), filename=script)
+    constants = module_constants(tree)
+    calls = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        name = getattr(node.func, 'attr', getattr(node.func, 'id', None))
+        if name in ('read_dataset', 'read_derived'):
+            kwargs = {k.arg: evaluate(k.value, constants) for k in node.keywords
+                      if k.arg in ('variables', 'level')}
+            args = node.args[1:] if name == 'read_derived' else node.args
+            if args:
+                kwargs['variables'] = evaluate(args[0], constants)
+            calls.append(kwargs)
+    return calls
+
+
+def product_needs(script):
+    """Variables needed by script, mapped to the pressure levels (hPa, as
+    strings like in the file names) for the 3D ones and None for the others"""
+    needs = {}
+    for call in read_dataset_calls(script):
+        level = call.get('level')
+        if level is None:
+            levels = download_dwd.levels_3d
+        else:
+            levels = ['%d' % (l / 100) for l in (level if isinstance(level, (list, tuple)) else [level])]
+        for var in call['variables']:
+            if get_kind(var) == '3d':
+                needs[var] = sorted(set(needs.get(var, [])) | set(levels), key=int, reverse=True)
+            else:
+                needs[var] = None
+    return needs
+
+
+def product_cost(needs):
+    """Number of files to download per forecast step"""
+    return sum(len(levels) if levels else 1 for levels in needs.values())
+
+
+def make_plan(scripts):
+    """Return the scripts sorted by cost and the list of variables to download
+    (as dictionaries with var, kind, levels and the layouts of the run store) in
+    the order they should be fetched:
+    the invariants first, then the inputs of the cheapest products"""
+    needs = {s: product_needs(s) for s in scripts}
+    scripts = sorted(scripts, key=lambda s: (product_cost(needs[s]), len(needs[s])))
+    plan = {}
+    for script in scripts:
+        for var, levels in needs[script].items():
+            if var in plan:
+                if levels:
+                    plan[var]['levels'] = sorted(set(plan[var]['levels']) | set(levels),
+                                                 key=int, reverse=True)
+            else:
+                plan[var] = {'var': var.lower(), 'kind': get_kind(var),
+                             'levels': list(levels) if levels else None, 'layouts': []}
+            layout = 'columns' if script in point_products else 'maps'
+            if layout not in plan[var]['layouts']:
+                plan[var]['layouts'].append(layout)
+    plan = sorted(plan.values(), key=lambda p: p['kind'] != 'invariant')
+    return scripts, plan
+
+
+def print_plan(scripts, plan):
+    for script in scripts:
+        needs = product_needs(script)
+        print('%-28s %3d files/step  %s' % (script, product_cost(needs), ' '.join(sorted(needs))))
+    for p in plan:
+        print('%-10s %-22s %-20s %s' % (p['kind'], p['var'], ' '.join(p['levels'] or []),
+                                        ' '.join(p['layouts'])))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scripts', nargs='+', help='Enabled plotting scripts')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='Only print the plan')
+    parser.add_argument('-r', '--run', default=None,
+                        help='Run as YYYYMMDDHH, defaults to the one in the environment')
+    parser.add_argument('-m', '--in-memory', action='store_true',
+                        help='Decode the GRIB files in memory instead of writing them to disk')
+    parser.add_argument('--no-crop', action='store_true',
+                        help='Store the whole ICON-D2 domain instead of the plotted projections')
+    parser.add_argument('--run-store', action='store_true',
+                        help='Also copy the variables into the per-run Zarr store')
+    args = parser.parse_args()
+
+    scripts, plan = make_plan(args.scripts)
+    print_plan(scripts, plan)
+    if args.dry_run:
+        return
+    if args.no_crop:
+        download_dwd.crop_bbox = None
+    run_string = args.run if args.run else download_dwd.get_run_string()
+    failed = asyncio.run(download_dwd.download_plan(plan, run_string, in_memory=args.in_memory))
+    if args.run_store:
+        download_dwd.update_run_store(plan, run_string)
+        download_dwd.update_point_store(plan, run_string)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
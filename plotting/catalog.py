@@ -0,0 +1,119 @@
+"""SQLite catalog of the NETCDF files of the runs in MODEL_DATA_FOLDER.
+
+It is written once after the ingestion (see download_dwd.update_catalog) with one
+row per run and variable (named as in the file names, e.g. t_2m or HSURF) holding
+the path of the file and its metadata: dimensions, levels, time range and grid.
+utils.read_dataset queries it to find the files of the most recent run which has
+all the variables it needs, instead of scanning the folder and matching the file
+names at every call. Files of other runs left in the folder are not mixed in.
+"""
+import json
+import os
+import sqlite3
+
+import netCDF4
+import numpy as np
+
+catalog_name = 'catalog.sqlite'
+
+schema = '''CREATE TABLE IF NOT EXISTS files (
+    run TEXT NOT NULL,
+    variable TEXT NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT,
+    dims TEXT,
+    levels TEXT,
+    time_start TEXT,
+    time_end TEXT,
+    n_times INTEGER,
+    lat_min REAL, lat_max REAL, n_lat INTEGER,
+    lon_min REAL, lon_max REAL, n_lon INTEGER,
+    format TEXT,
+    PRIMARY KEY (run, variable))'''
+
+
+def catalog_path(folder):
+    return os.path.join(folder, catalog_name)
+
+
+def connect(folder):
+    connection = sqlite3.connect(catalog_path(folder), timeout=60)
+    connection.row_factory = sqlite3.Row
+    connection.execute(schema)
+    return connection
+
+
+def describe(path):
+    """Metadata of the NETCDF file at path"""
+    with netCDF4.Dataset(path) as nc:
+        name = [v for v in nc.variables if v not in nc.dimensions and not v.endswith('_bnds')][0]
+        var = nc.variables[name]
+        entry = {'name': name, 'dims': json.dumps(var.dimensions), 'format': nc.data_model}
+        if 'plev' in nc.variables:
+            entry['levels'] = json.dumps(nc.variables['plev'][:].tolist())
+        if 'time' in nc.variables and len(nc.variables['time']) > 0:
+            time = nc.variables['time']
+            dates = netCDF4.num2date(time[[0, -1]], time.units,
+                                     getattr(time, 'calendar', 'standard'))
+            entry.update(time_start=dates[0].isoformat(), time_end=dates[-1].isoformat(),
+                         n_times=len(time))
+        for dim in ('lat', 'lon'):
+            values = nc.variables[dim][:]
+            entry.update({'%s_min' % dim: float(np.min(values)), '%s_max' % dim: float(np.max(values)),
+                          'n_%s' % dim: len(values)})
+    return entry
+
+
+def add_files(folder, run_string, files):
+    """Add (or replace) the files of a run, given as {variable: path}. Rows of
+    files which don't exist anymore (e.g. of older runs) are removed."""
+    rows = []
+    for variable, path in files.items():
+        entry = describe(path)
+        entry.update(run=run_string, variable=variable, path=os.path.abspath(path))
+        rows.append(entry)
+    with connect(folder) as connection:
+        for entry in rows:
+            connection.execute('INSERT OR REPLACE INTO files (%s) VALUES (%s)' % (
+                ', '.join(entry), ', '.join('?' * len(entry))), list(entry.values()))
+        stale = [r['path'] for r in connection.execute('SELECT path FROM files')
+                 if not os.path.isfile(r['path'])]
+        connection.executemany('DELETE FROM files WHERE path = ?', [(p,) for p in stale])
+    connection.close()
+
+
+def lookup(folder, variables):
+    """Run (YYYYMMDDHH), paths and formats of the files of variables for the most
+    recent run which has all of them in the catalog, None if there is no such run"""
+    if not os.path.isfile(catalog_path(folder)):
+        return None
+    variables = list(variables)
+    marks = ', '.join('?' * len(variables))
+    connection = connect(folder)
+    try:
+        row = connection.execute(
+            'SELECT run FROM files WHERE variable IN (%s) GROUP BY run '
+            'HAVING COUNT(DISTINCT variable) = ? ORDER BY run DESC LIMIT 1' % marks,
+            variables + [len(set(variables))]).fetchone()
+        if row is None:
+            return None
+        rows = dict((r['variable'], r) for r in connection.execute(
+            'SELECT variable, path, format FROM files WHERE run = ? AND variable IN (%s)' % marks,
+            [row['run']] + variables))
+    finally:
+        connection.close()
+    if not all(os.path.isfile(r['path']) for r in rows.values()):
+        return None
+    return row['run'], [rows[v]['path'] for v in variables], [rows[v]['format'] for v in variables]
+
+
+def latest_run(folder):
+    """Most recent run in the catalog, None if it is empty or missing"""
+    if not os.path.isfile(catalog_path(folder)):
+        return None
+    connection = connect(folder)
+    try:
+        row = connection.execute('SELECT MAX(run) AS run FROM files').fetchone()
+    finally:
+        connection.close()
+    return row['run']
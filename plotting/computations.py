@@ -1,37 +1,42 @@
-import metpy.calc as mpcalc
+from functools import partial
+import numpy as np
 import xarray as xr
-from metpy.units import units
+import kinematics
+import static_fields
+import thermo
 import utils
 
 
+def apply_kinematics(function, dset, uvar, vvar):
+    """function of kinematics.py applied to the wind uvar, vvar of dset on all
+    the time steps and levels at once (lazily on dask arrays, frame by frame),
+    with the metrics of the grid of dset computed only once"""
+    grid = kinematics.GridMetrics.for_grid(dset['lat'].values, dset['lon'].values)
+    return xr.apply_ufunc(lambda u, v: function(u, v, grid), dset[uvar], dset[vvar],
+                          input_core_dims=[['lat', 'lon']] * 2, output_core_dims=[['lat', 'lon']],
+                          dask='parallelized', output_dtypes=[dset[uvar].dtype]
+                          ).transpose(*dset[uvar].dims)
+
+
 def compute_convergence(dset, uvar='10u', vvar='10v'):
-    dx, dy = mpcalc.lat_lon_grid_deltas(dset['lon'], dset['lat'])
-    conv = - mpcalc.divergence(u=dset[uvar],
-                               v=dset[vvar],
-                               dx=dx[None, :, :],
-                               dy=dy[None, :, :]).metpy.dequantify()
-    conv = xr.DataArray(conv.values,
-                        coords=dset[uvar].coords,
-                        attrs={'standard_name': 'convergence',
-                               'units': conv.units},
-                        name='conv')
+    conv = - apply_kinematics(kinematics.divergence, dset, uvar, vvar)
+    conv.attrs = {'standard_name': 'convergence', 'units': '1 / second'}
 
-    return xr.merge([dset, conv])
+    return xr.merge([dset, conv.rename('conv')])
 
 
 def compute_vorticity(dset, uvar='10u', vvar='10v'):
-    dx, dy = mpcalc.lat_lon_grid_deltas(dset['lon'], dset['lat'])
-    vort = mpcalc.vorticity(u=dset[uvar],
-                            v=dset[vvar],
-                            dx=dx[None, :, :],
-                            dy=dy[None, :, :]).metpy.dequantify()
-    vort = xr.DataArray(vort.values,
-                        coords=dset[uvar].coords,
-                        attrs={'standard_name': 'vorticity',
-                               'units': vort.units},
-                        name='vort')
+    vort = apply_kinematics(kinematics.vorticity, dset, uvar, vvar)
+    vort.attrs = {'standard_name': 'vorticity', 'units': '1 / second'}
+
+    return xr.merge([dset, vort.rename('vort')])
 
-    return xr.merge([dset, vort])
+
+def apply_thermo(function, *args):
+    """function of thermo.py applied to the DataArrays args (lazily on dask
+    arrays, block by block), in the dtype of the first one"""
+    return xr.apply_ufunc(function, *args, dask='parallelized',
+                          output_dtypes=[args[0].dtype])
 
 
 def compute_geopot_height(dset, zvar='z', level=None):
@@ -39,35 +44,76 @@ def compute_geopot_height(dset, zvar='z', level=None):
         zlevel = dset[zvar].sel(plev=level)
     else:
         zlevel = dset[zvar]
-    gph = mpcalc.geopotential_to_height(zlevel).metpy.dequantify()
-    gph = xr.DataArray(gph.values,
+    gph = apply_thermo(thermo.geopotential_to_height, zlevel)
+    gph = xr.DataArray(gph,
                        coords=zlevel.coords,
                        attrs={'standard_name': 'geopotential height',
-                              'units': gph.units},
+                              'units': 'meter'},
                        name='geop')
 
     return xr.merge([dset, gph])
 
 
 def compute_thetae(dset, tvar='t', rvar='r'):
-    rh = mpcalc.dewpoint_from_relative_humidity(dset['t'],
-                                                dset['r'] / 100.)
-    theta_e = mpcalc.equivalent_potential_temperature(850 * units.hPa,
-                                                      dset['t'],
-                                                      rh)
-    theta_e = theta_e.metpy.convert_units('degC').metpy.dequantify()
-    theta_e = xr.DataArray(theta_e.values,
-                           coords= dset['t'].coords,
+    """Equivalent potential temperature at the pressure level(s) of tvar"""
+    t = dset[tvar]
+    pressure = t['plev']
+    if 'units' in pressure.attrs:
+        pressure = thermo.convert_units(pressure, 'Pa')
+    pressure = pressure.astype(t.dtype)
+    rh = dset[rvar]
+    # as a fraction (%, without units)
+    rh = thermo.convert_units(rh, 'dimensionless') if 'units' in rh.attrs else rh / 100.
+    td = apply_thermo(thermo.dewpoint_from_relative_humidity, t, rh)
+    theta_e = apply_thermo(thermo.equivalent_potential_temperature, pressure, t, td).transpose(*t.dims)
+    theta_e = xr.DataArray(theta_e - thermo.zero_degc,
+                           coords= dset[tvar].coords,
                            attrs={'standard_name': 'Equivalent potential temperature',
-                                  'units': theta_e.units},
+                                  'units': 'degree_Celsius'},
                             name='theta_e')
 
     return xr.merge([dset, theta_e])
 
 
+# Variables accumulated since the start of the run in the ICON-D2 output
+accumulated_variables = ['TOT_PREC', 'RAIN_GSP', 'RAIN_CON', 'SNOW_GSP', 'SNOW_CON', 'GRAU_GSP']
+
+
+def deaccumulate(da, mode='rate', time_chunk=1):
+    """De-accumulate da (e.g. one of accumulated_variables) lazily, chunk by chunk
+    along time, so that only time_chunk steps and their neighbours are in memory
+    at once and the peak memory doesn't grow with the length of the forecast.
+    - rate: rate per hour, the same as da.differentiate('time', datetime_unit='h')
+      (centered differences, one-sided at the first and last step): every chunk
+      only needs one more step on each side
+    - increment: accumulation since the first step"""
+    da = da.chunk({'time': time_chunk})
+    if mode == 'increment':
+        return da - da.isel(time=0)
+    if mode != 'rate':
+        raise ValueError('Unknown mode %s, should be rate or increment' % mode)
+    if da.sizes['time'] < 2:
+        raise ValueError('At least 2 time steps are needed to compute a rate')
+    hours = ((da.time - da.time[0]) / np.timedelta64(1, 'h')).values.astype(np.float64)
+    dt = np.diff(hours)
+    # Spacing to the previous and to the next step
+    dt_prev, dt_next = np.append(np.nan, dt), np.append(dt, np.nan)
+    # Weights of the previous, current and next step (as in numpy.gradient)
+    prev = -dt_next / (dt_prev * (dt_prev + dt_next))
+    current = (dt_next - dt_prev) / (dt_prev * dt_next)
+    next_ = dt_prev / (dt_next * (dt_prev + dt_next))
+    prev[0], current[0], next_[0] = 0., -1. / dt[0], 1. / dt[0]
+    prev[-1], current[-1], next_[-1] = -1. / dt[-1], 1. / dt[-1], 0.
+    weights = [xr.DataArray(w, coords={'time': da.time}, dims='time') for w in (prev, current, next_)]
+    rate = weights[0] * da.shift(time=1, fill_value=0) + weights[1] * da \
+        + weights[2] * da.shift(time=-1, fill_value=0)
+
+    return rate.astype(da.dtype).transpose(*da.dims).assign_attrs(da.attrs)
+
+
 def compute_snow_change(dset, snowvar='sde'):
     hsnow_acc = dset[snowvar]
-    hsnow = (hsnow_acc - hsnow_acc[0, :, :])
+    hsnow = deaccumulate(hsnow_acc, 'increment')
     hsnow = hsnow.where((hsnow > 0.25) | (hsnow < -0.25))
 
     hsnow = xr.DataArray(hsnow,
@@ -89,8 +135,8 @@ def compute_rain_snow_change(dset):
     except:
         snow_acc = dset['SNOW_GSP']
 
-    rain = (rain_acc - rain_acc[0, :, :])
-    snow = (snow_acc - snow_acc[0, :, :])
+    rain = deaccumulate(rain_acc, 'increment')
+    snow = deaccumulate(snow_acc, 'increment')
 
     rain = xr.DataArray(rain, name='rain_increment')
     snow = xr.DataArray(snow, name='snow_increment')
@@ -99,10 +145,12 @@ def compute_rain_snow_change(dset):
 
 
 def compute_wind_speed(dset, uvar='u', vvar='v'):
-    wind = mpcalc.wind_speed(dset[uvar], dset[vvar]).metpy.convert_units('kph').metpy.dequantify()
+    # Converted to kph in the same pass
+    scale, _ = thermo.conversion(dset[uvar].attrs['units'], 'kph')
+    wind = apply_thermo(partial(thermo.wind_speed, scale=scale), dset[uvar], dset[vvar])
     wind = xr.DataArray(wind, coords=dset[uvar].coords,
                            attrs={'standard_name': 'wind intensity',
-                                  'units': wind.units},
+                                  'units': thermo.units_name('kph')},
                                   name='wind_speed')
 
     return xr.merge([dset, wind])
@@ -119,8 +167,8 @@ def compute_rate(dset):
     except:
         snow_acc = dset['SNOW_GSP']
 
-    rain = rain_acc.load().differentiate(coord="time", datetime_unit="h")
-    snow = snow_acc.load().differentiate(coord="time", datetime_unit="h")
+    rain = deaccumulate(rain_acc, 'rate')
+    snow = deaccumulate(snow_acc, 'rate')
 
     rain = xr.DataArray(rain, name='rain_rate')
     snow = xr.DataArray(snow, name='snow_rate')
@@ -128,26 +176,56 @@ def compute_rate(dset):
     return xr.merge([dset, rain, snow])
 
 
-def compute_soil_moisture_sat(dset, projection):
-    proj_options = utils.proj_defs[projection]
-    saturation = xr.open_dataset(utils.soil_saturation_file)['soil_saturation']
-    saturation = saturation.assign_coords({"lon": (((saturation.lon + 180) % 360) - 180)})
-    saturation = saturation.sel(lat=slice(proj_options['llcrnrlat'],
-                                          proj_options['urcrnrlat']),
-                                lon=slice(proj_options['llcrnrlon'],
-                                          proj_options['urcrnrlon']))
-
+def smooth_n_point(values, n=9, passes=1):
+    """Same as metpy.calc.smooth_n_point (only the interior points are smoothed,
+    the edge of 1 point keeps its values, NaNs propagate, every pass is summed in
+    double precision) with identical results, but on all the leading dimensions
+    (e.g. all the time steps) in one call. For n=9 the weights are the product of
+    [0.25, 0.5, 0.25] along the two axes, so every pass is two 3-point sums instead
+    of 9 shifted ones. The frames are smoothed one at a time so that the
+    temporaries stay small (faster than smoothing the whole cube at once)."""
+    if n not in (5, 9):
+        raise ValueError('The number of points to use in the smoothing '
+                         'calculation must be either 5 or 9.')
+    # A C-ordered copy, so that the frames below are views of it (and not copies)
+    data = np.array(values, order='C')
+    side, center = np.float64(0.25), np.float64(0.5)
+    edge = side * center
+    for frame in data.reshape(-1, *data.shape[-2:]):
+        for _ in range(passes):
+            if n == 9:
+                rows = side * frame[:, :-2] + center * frame[:, 1:-1] + side * frame[:, 2:]
+                frame[1:-1, 1:-1] = side * rows[:-2] + center * rows[1:-1] + side * rows[2:]
+            else:
+                # The corners have weight 0, but still propagate the NaNs
+                frame[1:-1, 1:-1] = center * frame[1:-1, 1:-1] \
+                    + edge * frame[:-2, 1:-1] + edge * frame[2:, 1:-1] \
+                    + edge * frame[1:-1, :-2] + edge * frame[1:-1, 2:] \
+                    + 0. * (frame[:-2, :-2] + frame[:-2, 2:] + frame[2:, :-2] + frame[2:, 2:])
+    return data
+
+
+def compute_smoothed(dset, var='prmsl', n=9, passes=10):
+    """Smooth var (e.g. mslp for the isobars) on all the time steps at once"""
+    dset[var] = dset[var].copy(data=smooth_n_point(dset[var].values, n=n, passes=passes))
+
+    return dset
+
+
+def compute_soil_moisture_sat(dset, projection=None):
+    """Saturation of the soil moisture W_SO (first layer, 3 cm) in % of the
+    climatology, prepared once on the grid of dset (see static_fields.py)"""
     w_so = dset['W_SO']
+    saturation = static_fields.soil_saturation(utils.soil_saturation_file, utils.static_folder,
+                                               dset['lat'].values, dset['lon'].values, projection)
 
     rho_w = 1000.
-    w_so = w_so / (0.03 * 2 * rho_w)
-
-    w_so_sat = (w_so.values[:, :, :] / saturation.values[None, :, :]) * 100.
-
-    w_so_sat = xr.DataArray(w_so_sat, coords=w_so.coords,
-                           attrs={'standard_name': 'Soil moisture saturation',
-                                  'units': '%'},
-                            name='w_so_sat')
+    # Divide by the saturation once, then every frame is only multiplied (the grid
+    # was already checked by soil_saturation, so it's not aligned again)
+    factor = (100. / (0.03 * 2 * rho_w * saturation.values)).astype(w_so.dtype)
+    w_so_sat = w_so * xr.DataArray(factor, dims=('lat', 'lon'))
+    w_so_sat.attrs = {'standard_name': 'Soil moisture saturation', 'units': '%'}
+    w_so_sat = w_so_sat.rename('w_so_sat')
 
     # Fix weird points with ice/rock
     w_so_sat = w_so_sat.where(w_so != 0, 0.)
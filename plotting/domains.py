@@ -0,0 +1,75 @@
+"""Domains of the projections used for the plots. This is kept separate from
+utils.py so that it can also be used by the download/ingestion scripts."""
+import os
+
+proj_defs = {
+    'nord':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 4,
+        'llcrnrlat': 50,
+        'urcrnrlon': 12,
+        'urcrnrlat': 56,
+        'resolution': 'i',
+        'epsg': 4269
+    },
+    'it':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 5.5,
+        'llcrnrlat': 43.5,
+        'urcrnrlon': 14.5,
+        'urcrnrlat': 48,
+        'resolution': 'i',
+        'epsg': 4269
+    },
+    'de':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 4.5,
+        'llcrnrlat': 46.5,
+        'urcrnrlon': 16,
+        'urcrnrlat': 56,
+        'resolution': 'i',
+        'epsg': 4269
+    },
+    'north_sea':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': 0,
+        'llcrnrlat': 50,
+        'urcrnrlon': 10,
+        'urcrnrlat': 58,
+        'resolution': 'i',
+    },
+    'domain':
+    {
+        'projection': 'cyl',
+        'llcrnrlon': -3.9,
+        'llcrnrlat': 43.2,
+        'urcrnrlon': 20.3,
+        'urcrnrlat': 58,
+        'resolution': 'i',
+    },
+}
+
+# Projections which are actually plotted, as exported by copy_data.run
+if 'PROJECTIONS' in os.environ:
+    projections = os.environ['PROJECTIONS'].split()
+else:
+    projections = list(proj_defs.keys())
+# Margin (degrees) added around the projections when cropping the data at ingest
+crop_margin = 0.5
+
+
+def get_crop_bbox(projections=projections, margin=crop_margin):
+    """Bounding box (lon_min, lat_min, lon_max, lat_max) of the union of the
+    domains of projections, plus a margin"""
+    return (min(proj_defs[p]['llcrnrlon'] for p in projections) - margin,
+            min(proj_defs[p]['llcrnrlat'] for p in projections) - margin,
+            max(proj_defs[p]['urcrnrlon'] for p in projections) + margin,
+            max(proj_defs[p]['urcrnrlat'] for p in projections) + margin)
+
+
+def bbox_to_string(bbox):
+    return '%.3f %.3f %.3f %.3f' % tuple(bbox)
@@ -0,0 +1,185 @@
+"""Cache of the decoded fields shared by all the plotting processes of a run.
+
+Every plotting script runs once per projection, and most variables (e.g. pmsl, fi)
+are read by several scripts, so without this the same files would be opened,
+decompressed and loaded by tens of processes. Instead the first process which
+reads a field (one variable of a NETCDF file or of the run store) writes it
+decoded into .npy files in cache_folder, by default in shared memory (/dev/shm),
+and every other process maps them: the pages are shared between all the processes
+and nothing is decoded or copied again. Fields are memory mapped copy-on-write,
+so that they can still be modified in place by the scripts.
+
+Entries are named after the run and the identity of the source (e.g. path, size
+and modification time of the file), so a field rewritten in place is read again.
+The fields of other runs are removed when a new one is added.
+
+The same format is used to hand the time chunks of a dataset over to the workers
+of a multiprocessing Pool (see utils.chunks_dataset and share_dataset): the dataset
+is written once in shared memory and the workers only receive its path and the
+time slice, then map their chunk without copies.
+"""
+import atexit
+import fcntl
+import os
+import pickle
+import re
+import shutil
+import tempfile
+
+import dask.array
+import numpy as np
+import xarray as xr
+
+shared_folder = '/dev/shm' if os.path.isdir('/dev/shm') else None
+cache_folder = os.environ.get('FIELD_CACHE_FOLDER',
+                              os.path.join(shared_folder, 'icon-d2-fields') if shared_folder
+                              else os.path.join(os.environ.get('MODEL_DATA_FOLDER', '.'), 'field_cache'))
+# Set FIELD_CACHE=0 to always read the fields from the sources
+enabled = os.environ.get('FIELD_CACHE', '1') != '0'
+
+
+def mappable(var):
+    """True if the data of var can be written as a plain array (not e.g. the
+    projection objects of metpy or arrays with units)"""
+    return isinstance(var.data, (np.ndarray, dask.array.Array)) and var.dtype.kind in 'biufcmM'
+
+
+def write_dataset(path, dset):
+    """Write dset into the new folder path, as one .npy file per variable
+    (computing the dask arrays chunk by chunk) and the metadata. The variables which can't
+    be mapped are kept as they are in the metadata."""
+    os.makedirs(path)
+    meta = {'attrs': dset.attrs, 'coords': list(dset.coords), 'variables': {}}
+    for i, (name, var) in enumerate(dset.variables.items()):
+        if not mappable(var):
+            meta['variables'][name] = (None, var, None, None)
+            continue
+        array = np.lib.format.open_memmap(os.path.join(path, '%d.npy' % i), mode='w+',
+                                          dtype=var.dtype, shape=var.shape)
+        if isinstance(var.data, dask.array.Array):
+            # chunk by chunk, without computing the whole array in memory first
+            dask.array.store(var.data, array, lock=False)
+        else:
+            array[...] = var.values
+        array.flush()
+        del array
+        meta['variables'][name] = ('%d.npy' % i, var.dims, var.attrs, var.encoding)
+    with open(os.path.join(path, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f)
+
+
+def open_dataset(path):
+    """Dataset written by write_dataset at path, memory mapped copy-on-write"""
+    with open(os.path.join(path, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+    variables = {}
+    for name, (file, dims, attrs, encoding) in meta['variables'].items():
+        if file is None:
+            variables[name] = dims
+            continue
+        var = xr.Variable(dims, np.load(os.path.join(path, file), mmap_mode='c'), attrs)
+        var.encoding = encoding
+        variables[name] = var
+    coords = {n: v for n, v in variables.items() if n in meta['coords']}
+    data_vars = {n: v for n, v in variables.items() if n not in meta['coords']}
+    return xr.Dataset(data_vars, coords=coords, attrs=meta['attrs'])
+
+
+def file_key(path):
+    """Key of the field of the NETCDF file at path"""
+    stat = os.stat(path)
+    return '%s-%d-%d' % (os.path.basename(path), stat.st_size, stat.st_mtime_ns)
+
+
+class FieldCache():
+    def __init__(self, run_string, folder=None):
+        self.run_string = run_string
+        self.root = folder if folder else cache_folder
+        self.folder = os.path.join(self.root, run_string)
+
+    def entry_path(self, key):
+        return os.path.join(self.folder, key.replace('/', '_'))
+
+    def get(self, key, load):
+        """Dataset of key, memory mapped from the cache. If it's not there yet
+        load() (returning a Dataset) is called and its result is cached first.
+        Other processes asking for the same key meanwhile wait for it."""
+        path = self.entry_path(key)
+        if not os.path.isfile(os.path.join(path, 'meta.pkl')):
+            os.makedirs(self.folder, exist_ok=True)
+            with open(path + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if not os.path.isfile(os.path.join(path, 'meta.pkl')):
+                    self.put(path, load())
+                    self.prune()
+        return self.open(path)
+
+    def put(self, path, dset):
+        """Write dset decoded into the entry at path, published atomically"""
+        tmp_path = '%s.%d.part' % (path, os.getpid())
+        write_dataset(tmp_path, dset)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+
+    def open(self, path):
+        return open_dataset(path)
+
+    def prune(self):
+        """Remove the fields of the other runs"""
+        for name in os.listdir(self.root):
+            if name != self.run_string and os.path.isdir(os.path.join(self.root, name)):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+
+class SharedChunk():
+    """Time chunk [start, stop) of a dataset written by share_dataset at path.
+    It is pickled as these three values only, and unpickled (in the workers)
+    as the Dataset of the chunk, memory mapped"""
+    def __init__(self, path, start, stop):
+        self.path, self.start, self.stop = path, start, stop
+
+    def __reduce__(self):
+        return (open_chunk, (self.path, self.start, self.stop))
+
+
+# Datasets already opened by this process (a Pool worker gets several chunks)
+_shared = {}
+
+
+def open_chunk(path, start, stop):
+    if path not in _shared:
+        _shared[path] = open_dataset(path)
+    return _shared[path].isel(time=slice(start, stop))
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_stale_shared(folder=None):
+    """Remove the datasets shared by processes which are not running anymore
+    (e.g. killed, so their atexit never ran): they would take RAM in /dev/shm"""
+    folder = folder or shared_folder or tempfile.gettempdir()
+    for name in os.listdir(folder):
+        match = re.match(r'icon-d2-chunks-(\d+)-', name)
+        if match and not process_alive(int(match.group(1))):
+            shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+
+
+def share_dataset(dset):
+    """Write dset in shared memory for the Pool workers, return its path.
+    It's removed when this process exits, after the workers are done, or by the
+    next process sharing a dataset if this one is killed."""
+    remove_stale_shared()
+    path = os.path.join(tempfile.mkdtemp(prefix='icon-d2-chunks-%d-' % os.getpid(),
+                                         dir=shared_folder), 'dataset')
+    atexit.register(shutil.rmtree, os.path.dirname(path), ignore_errors=True)
+    write_dataset(path, dset)
+    return path
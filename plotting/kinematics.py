@@ -0,0 +1,153 @@
+"""Kinematics (divergence, vorticity, deformation, advection) on the lat/lon grid.
+
+The same finite differences as metpy.calc (second order, one-sided on the edges,
+with the map factor corrections of a latitude_longitude grid, as metpy applies
+them to DataArrays), but as a NumPy kernel: the weights of the stencils, already
+multiplied by the map factors, and the corrections only depend on the grid, so
+they are computed once per grid (e.g. the domain of the files or of a projection)
+and kept on disk in metrics_folder. Every field is then a few multiply-adds on
+all the time steps and levels at once, on arrays of any shape (..., lat, lon).
+"""
+import hashlib
+import os
+
+import numpy as np
+from pyproj import CRS, Proj
+
+metrics_folder = os.environ.get('GRID_METRICS_FOLDER',
+                                os.path.join(os.environ.get('MODEL_DATA_FOLDER', '.'), 'grid_metrics'))
+
+# Metrics already loaded by this process, by key of the grid
+_grids = {}
+
+
+def stencil_weights(delta):
+    """Weights (3, n) of the first derivative on the n points spaced by delta
+    (n - 1), applied to the points j-1, j, j+1 in the interior, 0, 1, 2 on the
+    first one and n-3, n-2, n-1 on the last one (as metpy.calc.first_derivative)"""
+    weights = np.empty((3, len(delta) + 1))
+    d0, d1 = delta[:-1], delta[1:]
+    total = d0 + d1
+    weights[:, 1:-1] = [-d1 / (total * d0), (d1 - d0) / (d0 * d1), d0 / (total * d1)]
+    d0, d1 = delta[0], delta[1]
+    total = d0 + d1
+    weights[:, 0] = [-(total + d0) / (total * d0), total / (d0 * d1), -d0 / (total * d1)]
+    d0, d1 = delta[-2], delta[-1]
+    total = d0 + d1
+    weights[:, -1] = [d1 / (total * d0), -total / (d0 * d1), (total + d1) / (total * d1)]
+    return weights
+
+
+def derivative(f, weights, axis):
+    """First derivative of f along axis (-1 or -2) with the stencil weights,
+    shaped (3,) + the grid so that they can vary over it"""
+    def take(index):
+        return (Ellipsis, index) if axis == -1 else (Ellipsis, index, slice(None))
+
+    def part(k, index):
+        return weights[k][take(index)]
+
+    out = np.empty(f.shape, dtype=np.result_type(f, weights))
+    # Points of the stencil for the interior, the first and the last point
+    for target, points in ((slice(1, -1), (slice(None, -2), slice(1, -1), slice(2, None))),
+                           (slice(None, 1), (slice(0, 1), slice(1, 2), slice(2, 3))),
+                           (slice(-1, None), (slice(-3, -2), slice(-2, -1), slice(-1, None)))):
+        values = out[take(target)]
+        np.multiply(part(0, target), f[take(points[0])], out=values)
+        values += part(1, target) * f[take(points[1])]
+        values += part(2, target) * f[take(points[2])]
+    return out
+
+
+class GridMetrics():
+    """Metrics of the grid with 1D coordinates lat, lon (degrees):
+    - x_weights, y_weights: stencils of d/dx and d/dy, times the map factors
+    - x_correction, y_correction: map factor corrections of the vector derivatives"""
+    names = ('x_weights', 'y_weights', 'x_correction', 'y_correction')
+
+    def __init__(self, lat, lon, dtype=np.float32):
+        lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+        # Nominal grid deltas on the ellipsoid, as metpy's grid_deltas of a DataArray
+        geod = CRS('+proj=latlon').get_geod()
+        dx = geod.a * np.diff(np.radians(lon))
+        zeros = np.zeros(len(lat) - 1)
+        forward_az, _, dy = geod.inv(zeros, lat[:-1], zeros, lat[1:])
+        dy[(forward_az < -90.) | (forward_az > 90.)] *= -1
+        factors = Proj(CRS('+proj=latlon')).get_factors(*np.meshgrid(lon, lat))
+        parallel_scale, meridional_scale = factors.parallel_scale, factors.meridional_scale
+        x_stencil = stencil_weights(dx)[:, None, :]
+        y_stencil = stencil_weights(dy)[:, :, None]
+        self.x_weights = (parallel_scale * x_stencil).astype(dtype)
+        self.y_weights = (meridional_scale * y_stencil).astype(dtype)
+        self.x_correction = (meridional_scale / parallel_scale
+                             * derivative(parallel_scale, y_stencil, -2)).astype(dtype)
+        self.y_correction = (parallel_scale / meridional_scale
+                             * derivative(meridional_scale, x_stencil, -1)).astype(dtype)
+
+    @classmethod
+    def for_grid(cls, lat, lon):
+        """Metrics of the grid lat, lon, computed only once per grid: they are
+        kept in this process and in metrics_folder"""
+        lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+        key = hashlib.blake2b(lat.tobytes() + b'/' + lon.tobytes(), digest_size=16).hexdigest()
+        if key not in _grids:
+            path = os.path.join(metrics_folder, 'grid-%s.npz' % key)
+            grid = cls.__new__(cls)
+            if os.path.isfile(path):
+                with np.load(path) as saved:
+                    for name in cls.names:
+                        setattr(grid, name, saved[name])
+            else:
+                grid.__init__(lat, lon)
+                os.makedirs(metrics_folder, exist_ok=True)
+                tmp_path = '%s.%d.part.npz' % (path[:-len('.npz')], os.getpid())
+                np.savez(tmp_path, **{name: getattr(grid, name) for name in cls.names})
+                os.replace(tmp_path, path)
+            _grids[key] = grid
+        return _grids[key]
+
+    def ddx(self, f):
+        return derivative(f, self.x_weights, -1)
+
+    def ddy(self, f):
+        return derivative(f, self.y_weights, -2)
+
+
+def divergence(u, v, grid):
+    """du/dx + dv/dy of the arrays (..., lat, lon) u, v on grid (GridMetrics)"""
+    div = grid.ddx(u)
+    div += grid.ddy(v)
+    div -= v * grid.x_correction
+    div -= u * grid.y_correction
+    return div
+
+
+def vorticity(u, v, grid):
+    """dv/dx - du/dy"""
+    vort = grid.ddx(v)
+    vort -= grid.ddy(u)
+    vort += u * grid.x_correction
+    vort -= v * grid.y_correction
+    return vort
+
+
+def deformation(u, v, grid):
+    """Shearing (dv/dx + du/dy), stretching (du/dx - dv/dy) and total deformation"""
+    dudx, dudy = grid.ddx(u), grid.ddy(u)
+    dvdx, dvdy = grid.ddx(v), grid.ddy(v)
+    dudx -= v * grid.x_correction
+    dvdx += u * grid.x_correction
+    dudy += v * grid.y_correction
+    dvdy -= u * grid.y_correction
+    shearing = dvdx + dudy
+    stretching = dudx - dvdy
+    return shearing, stretching, np.hypot(shearing, stretching)
+
+
+def advection(scalar, u, v, grid):
+    """Horizontal advection -(u ds/dx + v ds/dy) of scalar by the wind u, v"""
+    adv = grid.ddx(scalar)
+    adv *= u
+    adv += v * grid.ddy(scalar)
+    adv *= -1
+    return adv
@@ -2,9 +2,9 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
 import sys
-from computations import compute_geopot_height
-import metpy.calc as mpcalc
+from computations import compute_geopot_height, compute_smoothed
 
 debug = False
 if not debug:
@@ -28,14 +28,18 @@ else:
     projection = sys.argv[1]
 
 
+def derive_fields(dset):
+    """500 hPa geopotential height, smoothed mslp in hPa"""
+    dset = compute_geopot_height(dset, zvar='z', level=50000)
+    dset['prmsl'] = convert_units(dset['prmsl'], 'hPa')
+    return compute_smoothed(dset, 'prmsl', n=9, passes=10)
+
+
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['fi', 'pmsl'], level=[50000],
-                        projection=projection)
-
-    dset = compute_geopot_height(dset, zvar='z', level=50000)
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
+    dset = utils.read_derived(derive_fields, variables=['fi', 'pmsl'], level=[50000],
+                              projection=projection)
 
     levels_gph = np.arange(5000., 6000., 40.)
 
@@ -74,7 +78,6 @@ def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['prmsl'].values = mpcalc.smooth_n_point(data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + '/' + variable_name + '_%s.png' % cum_hour
@@ -3,6 +3,7 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
 import sys
 from computations import compute_geopot_height
 from matplotlib import patheffects
@@ -31,10 +32,9 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['t', 'fi'], level=[50000, 85000],
-                        projection=projection)
-
-    dset = compute_geopot_height(dset, zvar='z', level=50000)
+    dset = utils.read_derived(partial(compute_geopot_height, zvar='z', level=50000),
+                              variables=['t', 'fi'], level=[50000, 85000],
+                              projection=projection)
     dset = dset.sel(plev=85000, method='nearest')
 
     levels_temp = np.arange(-34., 36., 2.)
@@ -71,7 +71,7 @@ def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['t'] = data['t'].metpy.convert_units('degC').metpy.dequantify()
+        data['t'] = convert_units(data['t'], 'degC')
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + \
@@ -2,9 +2,9 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
 import sys
-from computations import compute_thetae
-import metpy.calc as mpcalc
+from computations import compute_thetae, compute_smoothed
 
 debug = False
 if not debug:
@@ -28,14 +28,19 @@ else:
     projection = sys.argv[1]
 
 
+def derive_fields(dset):
+    """850 hPa theta-e, smoothed mslp in hPa"""
+    dset = compute_thetae(dset)
+    dset['prmsl'] = convert_units(dset['prmsl'], 'hPa')
+    return compute_smoothed(dset, 'prmsl', n=9, passes=10)
+
+
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['t', 'relhum', 'pmsl'],
-                        level=85000,
-                        projection=projection)
-
-    dset = compute_thetae(dset)
+    dset = utils.read_derived(derive_fields, variables=['t', 'relhum', 'pmsl'],
+                              level=85000,
+                              projection=projection)
 
     cmap = plt.get_cmap('nipy_spectral')
 
@@ -46,8 +51,6 @@ def main():
     m, x, y = utils.get_projection(dset, projection, labels=True)
 
     dset = dset.drop(['lon', 'lat', 't', 'r']).load()
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
-
     levels_temp = np.arange(-10, 80, .5)
     levels_mslp = np.arange(dset.prmsl.min().astype("int"),
                             dset.prmsl.max().astype("int"), 4)
@@ -73,7 +76,6 @@ def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['prmsl'].values = mpcalc.smooth_n_point(data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + '/' + variable_name + '_%s.png' % cum_hour
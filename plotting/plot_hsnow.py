@@ -5,6 +5,7 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
 import sys
 from computations import compute_snow_change
 
@@ -29,16 +30,19 @@ else:
     projection = sys.argv[1]
 
 
+def derive_fields(dset):
+    """Snow depth in cm, snow limit in m and the hourly snow change"""
+    dset['sde'] = convert_units(dset['sde'], 'cm')
+    dset['SNOWLMT'] = convert_units(dset['SNOWLMT'], 'm')
+
+    return compute_snow_change(dset)
+
+
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['h_snow', 'snowlmt'],
+    dset = utils.read_derived(derive_fields, variables=['h_snow', 'snowlmt'],
                               projection=projection)
-    dset['sde'] = dset['sde'].metpy.convert_units('cm').metpy.dequantify()
-    dset['SNOWLMT'] = dset['SNOWLMT'].metpy.convert_units(
-        'm').metpy.dequantify()
-
-    dset = compute_snow_change(dset)
 
     levels_hsnow = (-50, -40, -30, -20, -10, -5, -2.5, -2, -1, -0.5,
                     0, 0.5, 1, 2, 2.5, 5, 10, 20, 30, 40, 50)
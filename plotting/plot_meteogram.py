@@ -7,11 +7,12 @@ import numpy as np
 import pandas as pd
 import os
 import utils
+from thermo import convert_units
 import sys
 import matplotlib.dates as mdates
 from matplotlib.dates import DateFormatter
 from matplotlib import gridspec
-from matplotlib.offsetbox import annotationBbox, OffsetImage
+from matplotlib.offsetbox import AnnotationBbox, OffsetImage
 from tqdm.contrib.concurrent import process_map
 import time
 import sys
@@ -26,16 +27,27 @@ else:
     cities = sys.argv[1:]
 
 
+variables = ['t_2m', 'td_2m', 't', 'vmax_10m', 'pmsl', 'HSURF', 'ww', 'relhum', 'u', 'v', 'clc']
+variables_prec = ['rain_gsp', 'rain_con', 'snow_gsp', 'snow_con']
+
+
 def main():
-    dset = utils.read_dataset(variables=['t_2m', 'td_2m', 't', 'vmax_10m',
-                                    'pmsl', 'HSURF', 'ww', 'relhum', 'u', 'v', 'clc'])
-    dset_prec = utils.read_dataset(variables=['rain_gsp', 'rain_con', 'snow_gsp', 'snow_con',], freq=None).rename_dims({'time':'time_fine'}).rename({'time':'time_fine'})
-    dset = dset.merge(dset_prec)
+    # Read only the columns of the cities from the point store when there is one
+    points = utils.open_point_store(variables + variables_prec)
+    if points is None:
+        dset = utils.read_dataset(variables=variables)
+        dset_prec = utils.read_dataset(variables=variables_prec, freq=None).rename_dims({'time':'time_fine'}).rename({'time':'time_fine'})
+        dset = dset.merge(dset_prec)
     # Subset dataset on cities and create iterator
     it = []
     for city in cities:
-        lon, lat = get_city_coordinates(city)
-        d = dset.sel(lon=lon, lat=lat, method='nearest').copy()
+        lon, lat = utils.get_city_coordinates(city)
+        if points is None:
+            d = dset.sel(lon=lon, lat=lat, method='nearest').copy()
+        else:
+            d = utils.read_point(points, variables, lat, lon).merge(
+                utils.read_point(points, variables_prec, lat, lon, freq=None).rename(
+                    {'time': 'time_fine'}).drop_vars('run'))
         d.attrs['city'] = city
         it.append(d)
         del d
@@ -48,17 +60,17 @@ def plot(dset_city):
     time_hourly, run, cum_hour = utils.get_time_run_cum(dset_city)
     time_prec = dset_city['time_fine'].to_pandas()
     t = dset_city['t'].load()
-    t = t.metpy.convert_units('degC').metpy.dequantify()
+    t = convert_units(t, 'degC')
     rh = dset_city['r'].load()
     t2m = dset_city['2t'].load()
-    t2m = t2m.metpy.convert_units('degC').metpy.dequantify()
+    t2m = convert_units(t2m, 'degC')
     td2m = dset_city['2d'].load()
-    td2m = td2m.metpy.convert_units('degC').metpy.dequantify()
+    td2m = convert_units(td2m, 'degC')
     vmax_10m = dset_city['VMAX_10M'].load()
-    vmax_10m = vmax_10m.metpy.convert_units('kph').metpy.dequantify()
+    vmax_10m = convert_units(vmax_10m, 'kph')
     pmsl = dset_city['prmsl'].load()
-    pmsl = pmsl.metpy.convert_units('hPa').metpy.dequantify()
-    plevs = dset_city['t'].metpy.vertical.metpy.convert_units('hPa').metpy.dequantify()
+    pmsl = convert_units(pmsl, 'hPa')
+    plevs = convert_units(dset_city['t'].metpy.vertical, 'hPa')
 
     rain_acc = dset_city['RAIN_GSP']
     snow_acc = dset_city['SNOW_GSP']
@@ -107,7 +119,7 @@ def plot(dset_city):
 
     for dt, weather_icon, dewp in zip(time_hourly, weather_icons, t2m):
         imagebox = OffsetImage(weather_icon, zoom=.025)
-        ab = utils.annotationBbox(
+        ab = AnnotationBbox(
             imagebox, (mdates.date2num(dt), dewp), frameon=False)
         ax1.add_artist(ab)
 
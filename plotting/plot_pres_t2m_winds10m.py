@@ -3,8 +3,9 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
+from computations import compute_smoothed
 import sys
-import metpy.calc as mpcalc
 
 debug = False
 if not debug:
@@ -27,14 +28,18 @@ else:
     projection = sys.argv[1]
 
 
+def derive_fields(dset):
+    """2m temperature in degC, smoothed mslp in hPa"""
+    dset['2t'] = convert_units(dset['2t'], 'degC')
+    dset['prmsl'] = convert_units(dset['prmsl'], 'hPa')
+    return compute_smoothed(dset, 'prmsl', n=9, passes=10)
+
+
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['u_10m', 'v_10m', 't_2m', 'pmsl'],
-                        projection=projection)
-
-    dset['2t'] = dset['2t'].metpy.convert_units('degC').metpy.dequantify()
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
+    dset = utils.read_derived(derive_fields, variables=['u_10m', 'v_10m', 't_2m', 'pmsl'],
+                              projection=projection)
 
     levels_t2m = np.arange(-25, 45, 1)
 
@@ -70,8 +75,6 @@ def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['prmsl'].values = mpcalc.smooth_n_point(
-            data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + \
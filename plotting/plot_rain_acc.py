@@ -2,8 +2,9 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
+from computations import compute_smoothed
 import sys
-import metpy.calc as mpcalc
 
 debug = False
 if not debug:
@@ -27,12 +28,17 @@ else:
     projection = sys.argv[1]
 
 
+def derive_fields(dset):
+    """Smoothed mslp in hPa"""
+    dset['prmsl'] = convert_units(dset['prmsl'], 'hPa')
+    return compute_smoothed(dset, 'prmsl', n=9, passes=10)
+
+
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['tot_prec', 'pmsl'],
-                        projection=projection)
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
+    dset = utils.read_derived(derive_fields, variables=['tot_prec', 'pmsl'],
+                              projection=projection)
 
     levels_precip = list(np.arange(1, 50, 0.4)) + \
                     list(np.arange(51, 100, 2)) +\
@@ -76,7 +82,6 @@ def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['prmsl'].values = mpcalc.smooth_n_point(data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + '/' + variable_name + '_%s.png' % cum_hour
@@ -3,9 +3,9 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
 import sys
-from computations import compute_rate
-import metpy.calc as mpcalc
+from computations import compute_rate, compute_smoothed
 
 debug = False
 if not debug:
@@ -28,17 +28,20 @@ else:
     projection = sys.argv[1]
 
 
+def derive_fields(dset):
+    """Rain and snow rates, smoothed mslp in hPa"""
+    dset = compute_rate(dset)
+    dset['prmsl'] = convert_units(dset['prmsl'], 'hPa')
+    return compute_smoothed(dset, 'prmsl', n=9, passes=10)
+
+
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['rain_gsp',
-                                         'snow_gsp',
-                                         'pmsl', 'clcl', 'clch'],
+    dset = utils.read_derived(derive_fields, variables=['rain_gsp',
+                                                        'snow_gsp',
+                                                        'pmsl', 'clcl', 'clch'],
                               projection=projection)
-    # Convert to hourly data
-    dset = dset.resample(time="1H").nearest(tolerance="1H")
-    dset = compute_rate(dset)
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
 
     levels_rain = (0.1, 0.2, 0.4, 0.6, 0.8, 1., 1.5, 2., 2.5, 3.0, 4.,
                    5, 7.5, 10., 15., 20., 30., 40., 60., 80., 100., 120.)
@@ -87,8 +90,6 @@ def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['prmsl'].values = mpcalc.smooth_n_point(
-            data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + \
@@ -31,9 +31,8 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['relhum', 'fi'], level=[l * 100 for l in levels],
-                        projection=projection)
-    dset = compute_geopot_height(dset)
+    dset = utils.read_derived(compute_geopot_height, variables=['relhum', 'fi'],
+                              level=[l * 100 for l in levels], projection=projection)
     cmap = utils.get_colormap('rh')
     levels_rh = np.arange(10, 100, 5)
 
@@ -2,6 +2,7 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
 import sys
 from computations import compute_rate
 import pickle
@@ -37,8 +38,8 @@ def main():
                                     projection=projection)
 
     #dset = compute_rate(dset)
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
-    dset['SYNMSG_BT_CL_IR10.8'] = dset['SYNMSG_BT_CL_IR10.8'].metpy.convert_units('degC').metpy.dequantify()
+    dset['prmsl'] = convert_units(dset['prmsl'], 'hPa')
+    dset['SYNMSG_BT_CL_IR10.8'] = convert_units(dset['SYNMSG_BT_CL_IR10.8'], 'degC')
 
     levels_rain  = (0.1, 0.2, 0.4, 0.6, 0.8, 1., 1.5, 2., 2.5, 3.0, 4.,
                     5, 7.5, 10., 15., 20., 30., 40., 60., 80., 100., 120.)
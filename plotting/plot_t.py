@@ -2,6 +2,7 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
 import sys
 from computations import compute_geopot_height
 
@@ -31,14 +32,13 @@ else:
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['t', 'fi'], level=[l * 100 for l in levels],
-                        projection=projection)
-    dset = compute_geopot_height(dset)
+    dset = utils.read_derived(compute_geopot_height, variables=['t', 'fi'],
+                              level=[l * 100 for l in levels], projection=projection)
     cmap = utils.get_colormap('temp')
 
     for level in levels:    
         dset_level = dset.sel(plev=level*100., method='nearest')
-        dset_level.t =         dset_level.t.metpy.convert_units('degC').metpy.dequantify()
+        dset_level.t = convert_units(dset_level.t, 'degC')
         levels_gph = np.arange(np.nanmin(dset_level.geop).astype("int"),
                                 np.nanmax(dset_level.geop).astype("int"), 25.)
         levels_temp = np.arange(np.nanmin(dset_level.t).astype("int"), 
@@ -2,6 +2,7 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
 import sys
 
 debug = False
@@ -29,8 +30,8 @@ def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
     dset = utils.read_dataset(variables=['t', 'pmsl'], level=85000, projection=projection)
-    dset['t'] = dset['t'].metpy.convert_units('degC').metpy.dequantify()
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
+    dset['t'] = convert_units(dset['t'], 'degC')
+    dset['prmsl'] = convert_units(dset['prmsl'], 'hPa')
 
     levels_temp = np.arange(-25., 25., 1.)
     cmap = utils.get_colormap('temp')
@@ -2,6 +2,7 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
 import sys
 
 debug = False
@@ -30,7 +31,7 @@ def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
     dset = utils.read_dataset(variables=['tmax_2m'], projection=projection)
-    dset['TMAX_2M'] = dset['TMAX_2M'].metpy.convert_units('degC').metpy.dequantify()
+    dset['TMAX_2M'] = convert_units(dset['TMAX_2M'], 'degC')
 
     levels_t2m = np.arange(-25, 50, 1)
 
@@ -3,8 +3,9 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
+from computations import compute_smoothed
 import sys
-import metpy.calc as mpcalc
 
 debug = False
 if not debug:
@@ -27,16 +28,19 @@ else:
     projection = sys.argv[1]
 
 
+def derive_fields(dset):
+    """Wind gusts in km/h, smoothed mslp in hPa"""
+    dset['VMAX_10M'] = convert_units(dset['VMAX_10M'], 'kph')
+    dset['prmsl'] = convert_units(dset['prmsl'], 'hPa')
+    return compute_smoothed(dset, 'prmsl', n=9, passes=10)
+
+
 def main():
     """In the main function we basically read the files and prepare the variables to be plotted.
     This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['vmax_10m', 'pmsl', 'u_10m', 'v_10m'],
+    dset = utils.read_derived(derive_fields, variables=['vmax_10m', 'pmsl', 'u_10m', 'v_10m'],
                               projection=projection)
 
-    dset['VMAX_10M'] = dset['VMAX_10M'].metpy.convert_units(
-        'kph').metpy.dequantify()
-    dset['prmsl'] = dset['prmsl'].metpy.convert_units('hPa').metpy.dequantify()
-
     levels_winds_10m = np.linspace(0, 255., 178)
     cmap, norm = utils.get_colormap_norm(
         'winds_wxcharts', levels=levels_winds_10m)
@@ -74,8 +78,6 @@ def plot_files(dss, **args):
     first = True
     for time_sel in dss.time:
         data = dss.sel(time=time_sel)
-        data['prmsl'].values = mpcalc.smooth_n_point(
-            data['prmsl'].values, n=9, passes=10)
         time, run, cum_hour = utils.get_time_run_cum(data)
         # Build the name of the output image
         filename = utils.subfolder_images[projection] + \
@@ -3,8 +3,9 @@ import numpy as np
 from multiprocessing import Pool
 from functools import partial
 import utils
+from thermo import convert_units
 import sys
-from computations import compute_snow_change
+from computations import compute_snow_change, deaccumulate
 import xarray as xr
 
 debug = False
@@ -28,22 +29,25 @@ else:
     projection = sys.argv[1]
 
 
-def main():
-    """In the main function we basically read the files and prepare the variables to be plotted.
-    This is not included in utils.py as it can change from case to case."""
-    dset = utils.read_dataset(variables=['rain_gsp', 'h_snow', 'snowlmt'],
-                              projection=projection)
-    dset = dset.resample(time="1H").nearest(tolerance="1H")
-
-    rain = (dset['RAIN_GSP'] - dset['RAIN_GSP'][0, :, :])
+def derive_fields(dset):
+    """Snow depth in cm and its hourly change, rain increment and snow limit in m"""
+    rain = deaccumulate(dset['RAIN_GSP'], 'increment')
     rain = xr.DataArray(rain, name='rain_increment')
 
-    dset['sde'] = dset['sde'].metpy.convert_units('cm').metpy.dequantify()
+    dset['sde'] = convert_units(dset['sde'], 'cm')
     dset = compute_snow_change(dset)
 
     dset = xr.merge([dset, rain])
-    dset['SNOWLMT'] = dset['SNOWLMT'].metpy.convert_units(
-        'm').metpy.dequantify()
+    dset['SNOWLMT'] = convert_units(dset['SNOWLMT'], 'm')
+
+    return dset
+
+
+def main():
+    """In the main function we basically read the files and prepare the variables to be plotted.
+    This is not included in utils.py as it can change from case to case."""
+    dset = utils.read_derived(derive_fields, variables=['rain_gsp', 'h_snow', 'snowlmt'],
+                              projection=projection)
 
     levels_snow = (0.25, 0.5, 1, 2.5, 5, 10, 15,
                    20, 25, 30, 40, 50, 70, 90, 150)
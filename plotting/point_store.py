@@ -0,0 +1,110 @@
+"""Point-major store of the variables of a run, for the meteograms.
+
+In the NETCDF files (and in the run store) the data of one grid point is spread
+over chunks which span many points, so extracting the time series of a point reads
+much more than needed. Here all the variables written (e.g. the ones read by
+plot_meteogram.py, see download_dwd.update_point_store) are instead laid out once
+per run in MODEL_DATA_FOLDER/icon-d2_<run>.points/ as a single array
+
+    data.npy   (lat, lon, feature)
+
+where the features of a point are all the values of all the variables (every
+time step and level), one after the other. Reading the full multi-variable column
+of a point is a single contiguous read of a few kB, so meteograms for thousands of
+locations are cheap. index.pkl describes where every variable is in the features,
+with its dimensions, coordinates and attributes.
+"""
+import os
+import pickle
+from glob import glob
+
+import numpy as np
+import xarray as xr
+
+
+def store_path(folder, run_string):
+    return os.path.join(folder, 'icon-d2_%s.points' % run_string)
+
+
+def latest_store(folder):
+    """Path of the point store of the most recent run in folder, None if there is none"""
+    stores = sorted(p for p in glob(os.path.join(folder, 'icon-d2_*.points'))
+                    if os.path.isfile(os.path.join(p, 'index.pkl')))
+    return stores[-1] if stores else None
+
+
+def store_run(path):
+    """Run (YYYYMMDDHH) of the store at path"""
+    return os.path.basename(path)[len('icon-d2_'):-len('.points')]
+
+
+def write_store(path, nc_files):
+    """Write the point store at path with the variables in nc_files, given as
+    {variable: NETCDF file}. All the files must be on the same lat/lon grid."""
+    index = {'variables': {}}
+    n_features = 0
+    for var, nc_file in nc_files.items():
+        with xr.open_dataset(nc_file) as dset:
+            dset = dset.squeeze(drop=True)
+            if 'plev_bnds' in dset.variables:
+                dset = dset.drop_vars('plev_bnds')
+            if 'lat' not in index:
+                index['lat'], index['lon'] = dset.lat.variable.load(), dset.lon.variable.load()
+            elif not (np.array_equal(index['lat'].values, dset.lat.values)
+                      and np.array_equal(index['lon'].values, dset.lon.values)):
+                raise ValueError('%s is not on the same grid as the other variables' % nc_file)
+            for name, data in dset.data_vars.items():
+                dims = [d for d in data.dims if d not in ('lat', 'lon')]
+                shape = [data.sizes[d] for d in dims]
+                index['variables'][var] = {
+                    'name': name, 'dims': dims, 'shape': shape, 'offset': n_features,
+                    'attrs': data.attrs, 'dset_attrs': dset.attrs,
+                    'coords': {d: dset[d].variable.load() for d in dims if d in dset.coords}}
+                n_features += int(np.prod(shape))
+    tmp_path = '%s.%d.part' % (path, os.getpid())
+    os.makedirs(tmp_path)
+    data = np.lib.format.open_memmap(os.path.join(tmp_path, 'data.npy'), mode='w+', dtype=np.float32,
+                                     shape=(index['lat'].size, index['lon'].size, n_features))
+    for var, nc_file in nc_files.items():
+        entry = index['variables'][var]
+        with xr.open_dataset(nc_file) as dset:
+            values = dset[entry['name']].squeeze(drop=True).transpose(
+                'lat', 'lon', *entry['dims']).values
+        data[:, :, entry['offset']:entry['offset'] + int(np.prod(entry['shape']))] = \
+            values.reshape(values.shape[0], values.shape[1], -1)
+    data.flush()
+    del data
+    with open(os.path.join(tmp_path, 'index.pkl'), 'wb') as f:
+        pickle.dump(index, f)
+    os.replace(tmp_path, path)
+
+
+class PointStore():
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.pkl'), 'rb') as f:
+            self.index = pickle.load(f)
+        self.data = np.load(os.path.join(path, 'data.npy'), mmap_mode='r')
+
+    def variables(self):
+        return list(self.index['variables'])
+
+    def read(self, variables, lat, lon):
+        """Dataset with variables (DWD names, as in read_dataset) at the grid point
+        nearest to lat, lon. The variables must have the same time steps."""
+        i = int(np.abs(self.index['lat'].values - lat).argmin())
+        j = int(np.abs(self.index['lon'].values - lon).argmin())
+        column = np.array(self.data[i, j])
+        data_vars = {}
+        coords = {'lat': self.index['lat'][i], 'lon': self.index['lon'][j]}
+        for var in variables:
+            entry = self.index['variables'][var]
+            size = int(np.prod(entry['shape']))
+            values = column[entry['offset']:entry['offset'] + size].reshape(entry['shape'])
+            data_vars[entry['name']] = xr.Variable(entry['dims'], values, entry['attrs'])
+            for dim, coord in entry['coords'].items():
+                if dim in coords and not np.array_equal(coords[dim].values, coord.values):
+                    raise ValueError('%s has different %s than the other variables' % (var, dim))
+                coords[dim] = coord
+        attrs = self.index['variables'][variables[0]]['dset_attrs'] if variables else {}
+        return xr.Dataset(data_vars, coords=coords, attrs=attrs)
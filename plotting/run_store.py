@@ -0,0 +1,111 @@
+"""Single chunked Zarr store with all the variables of a run.
+
+Instead of opening one NETCDF file per variable in every script/projection
+process, all the variables are copied at ingest into MODEL_DATA_FOLDER/icon-d2_<run>.zarr
+with consolidated metadata, so that opening the run is a single small read.
+Every variable is a group named as on the DWD server (e.g. maps/t_2m, also in
+its dwd_name attribute) with one of two layouts
+- maps: one chunk per time step (and level), for the map products which read
+  the whole domain at every step
+- columns: all the steps and levels of small tiles, for the meteograms which
+  read all the steps at a few points
+utils.read_dataset uses the store when it contains all the variables requested.
+"""
+import os
+import threading
+from glob import glob
+
+import xarray as xr
+import zarr
+
+# Size of the lat/lon tiles of the columns layout
+column_tile = 32
+layouts = ('maps', 'columns')
+# Lock for the writes from different threads of the same process
+write_lock = threading.Lock()
+
+
+def store_path(folder, run_string):
+    return os.path.join(folder, 'icon-d2_%s.zarr' % run_string)
+
+
+def latest_store(folder):
+    """Path of the store of the most recent run in folder, None if there is none"""
+    stores = sorted(glob(os.path.join(folder, 'icon-d2_*.zarr')))
+    return stores[-1] if stores else None
+
+
+def layout_chunks(dset, layout):
+    chunks = {}
+    for dim, size in dset.sizes.items():
+        if layout == 'maps':
+            chunks[dim] = size if dim in ('lat', 'lon') else 1
+        else:
+            chunks[dim] = min(column_tile, size) if dim in ('lat', 'lon') else size
+    return chunks
+
+
+def write_variable(path, var, nc_file, layouts=('maps',), source_hash=None):
+    """Copy the NETCDF file of var into the store at path, with the given layouts.
+    The metadata is only consolidated by consolidate, once all the variables are in.
+    source_hash (of nc_file) is kept in the attributes, see is_written."""
+    with xr.open_dataset(nc_file) as dset:
+        dset = dset.load()
+    for layout in layouts:
+        chunks = layout_chunks(dset, layout)
+        out = dset.chunk(chunks)
+        for name in out.variables:
+            out[name].encoding = {}
+        out.attrs['dwd_name'] = var
+        out.attrs['source_hash'] = source_hash if source_hash else ''
+        for name in out.data_vars:
+            out[name].attrs['dwd_name'] = var
+        with write_lock:
+            out.to_zarr(path, group='%s/%s' % (layout, var), mode='w',
+                        consolidated=False, zarr_format=2)
+
+
+def is_written(path, var, layout, source_hash):
+    """True if var is already in the store with the given layout, copied from
+    the file with source_hash"""
+    try:
+        group = zarr.open_group(path, mode='r', zarr_format=2)['%s/%s' % (layout, var)]
+    except (KeyError, FileNotFoundError, zarr.errors.GroupNotFoundError):
+        return False
+    return group.attrs.get('source_hash') == source_hash
+
+
+def consolidate(path):
+    zarr.consolidate_metadata(path, zarr_format=2)
+
+
+def store_run(path):
+    """Run (YYYYMMDDHH) of the store at path"""
+    return os.path.basename(path)[len('icon-d2_'):-len('.zarr')]
+
+
+def store_variables(path, layout='maps'):
+    """Variables in the store, by their DWD name"""
+    root = zarr.open_consolidated(path, mode='r', zarr_format=2)
+    if layout not in root:
+        return []
+    return [name for name, _ in root[layout].groups()]
+
+
+def open_variables(path, variables, layout='maps', cache=None):
+    """Dataset with variables (DWD names, as in read_dataset) from the store at path,
+    as dask arrays with the chunks of the store. With a field_cache.FieldCache
+    the variables are instead decoded once and memory mapped from there."""
+    tree = xr.open_datatree(path, engine='zarr', consolidated=True, chunks={}, group=layout)
+    dsets = []
+    for var in variables:
+        dset = tree[var].to_dataset()
+        # Same as utils.preprocess does for the files
+        if 'plev_bnds' in dset.variables:
+            dset = dset.drop_vars('plev_bnds')
+        dset = dset.squeeze(drop=True)
+        if cache is not None:
+            key = 'zarr-%s-%s-%s' % (layout, var, dset.attrs.get('source_hash', ''))
+            dset = cache.get(key, dset.load)
+        dsets.append(dset)
+    return xr.merge(dsets, compat='override', join='outer', combine_attrs='drop_conflicts')
@@ -0,0 +1,87 @@
+"""Static fields (which don't change from run to run) prepared on the ICON-D2 grid.
+
+The soil saturation climatology (utils.soil_saturation_file) is on its own grid,
+with longitudes in 0-360. Instead of opening and slicing it in every call of
+computations.compute_soil_moisture_sat, it is regridded (bilinearly) once onto
+the grid of the data of a projection and stored in static_folder with the same
+format as the field cache (see field_cache.py), so that every process maps it.
+Entries are named after the projection and the identity of the climatology file
+and of the target grid, so a new file or a different crop is prepared again.
+The grid of every stored field is checked against the one of the data it's
+applied to.
+
+They can also be prepared in advance for the projections, on the grid of HSURF
+
+    python static_fields.py -p de it nord
+"""
+import argparse
+import hashlib
+import os
+
+import numpy as np
+import xarray as xr
+
+import field_cache
+
+
+class StaticCache(field_cache.FieldCache):
+    """Field cache of the static fields: they don't belong to a run, so
+    nothing is removed when a new entry is added"""
+    def prune(self):
+        pass
+
+
+def grid_key(lat, lon):
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    return hashlib.blake2b(lat.tobytes() + b'/' + lon.tobytes(), digest_size=8).hexdigest()
+
+
+def check_alignment(field, lat, lon, name):
+    """Raise if field is not on the grid lat, lon"""
+    if not (field.sizes['lat'] == len(lat) and field.sizes['lon'] == len(lon)
+            and np.allclose(field['lat'].values, lat) and np.allclose(field['lon'].values, lon)):
+        raise ValueError('%s is not on the grid of the data (%d x %d points from %.3f, %.3f)' % (
+            name, len(lat), len(lon), lat[0], lon[0]))
+
+
+def regrid(field, lat, lon):
+    """field (with coordinates lat, lon in degrees) bilinearly interpolated onto
+    the grid lat, lon. The longitudes are brought to -180-180 first."""
+    field = field.assign_coords(lon=((field['lon'] + 180) % 360) - 180).sortby(['lat', 'lon'])
+    if (lat.min() < field['lat'].values[0] or lat.max() > field['lat'].values[-1]
+            or lon.min() < field['lon'].values[0] or lon.max() > field['lon'].values[-1]):
+        raise ValueError('The grid of the data is not within the domain of %s' % field.name)
+    regridded = field.interp(lat=lat, lon=lon, method='linear')
+    check_alignment(regridded, lat, lon, field.name)
+    return regridded
+
+
+def soil_saturation(path, folder, lat, lon, projection=None):
+    """Soil saturation of the climatology at path on the grid lat, lon (of the
+    data of projection, None for the whole domain), prepared in folder"""
+    lat, lon = np.asarray(lat), np.asarray(lon)
+
+    def load():
+        with xr.open_dataset(path) as dset:
+            return regrid(dset['soil_saturation'].load(), lat, lon).to_dataset()
+
+    key = 'soil_saturation-%s-%s-%s' % (projection if projection else 'domain',
+                                        field_cache.file_key(path), grid_key(lat, lon))
+    saturation = StaticCache('fields', folder).get(key, load)['soil_saturation']
+    check_alignment(saturation, lat, lon, 'soil_saturation')
+    return saturation
+
+
+if __name__ == "__main__":
+    import utils
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--projections', nargs='+', default=['de', 'it', 'nord'])
+    args = parser.parse_args()
+
+    for projection in args.projections:
+        grid = utils.read_dataset(['HSURF'], projection=projection, freq=None)
+        saturation = soil_saturation(utils.soil_saturation_file, utils.static_folder,
+                                     grid['lat'].values, grid['lon'].values, projection)
+        print('Prepared the soil saturation of %s (%d x %d)' % (projection, saturation.sizes['lat'],
+                                                               saturation.sizes['lon']))
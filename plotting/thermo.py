@@ -0,0 +1,181 @@
+"""Thermodynamics on plain arrays, without units.
+
+The same formulas and constants as metpy.calc, but on NumPy arrays in SI units
+(K, Pa, relative humidity as a fraction, m2 s-2, m s-1) instead of pint
+quantities: the computations stay in the dtype of the input (float32 for the
+model fields) and reuse their temporaries where possible, so that a whole cube
+doesn't go through several float64 copies and the unit machinery of pint.
+computations.py applies them to the DataArrays (lazily on dask arrays, with
+xr.apply_ufunc). benchmarks/bench_computations.py checks them against metpy.
+"""
+import numpy as np
+from metpy.units import units
+
+# As in metpy.constants
+T0 = 273.16  # K, triple point of water
+zero_degc = 273.15  # K
+sat_pressure_0c = 611.2  # Pa
+Lv = 2500840.  # J kg-1, latent heat of vaporization at T0
+Rv = 461.52311572606084  # J K-1 kg-1
+Cp_l = 4219.400000000001  # J K-1 kg-1
+Cp_v = 1860.078011865639  # J K-1 kg-1
+epsilon = 0.6219569100577033
+kappa = 0.28571428571428564
+P0 = 100000.  # Pa
+g = 9.80665  # m s-2
+Re = 6371008.7714  # m
+# Elements processed at a time by the functions working in blocks
+block_size = 1 << 16
+
+
+def saturation_vapor_pressure(t):
+    """Saturation vapor pressure (Pa) over liquid water at temperature t (K),
+    as in metpy (Ambaum 2020, eq. 13):
+    e = e0 (T0 / t)^((Cp_l - Cp_v) / Rv) exp((Lv / T0 - L(t) / t) / Rv)
+    with L(t) = Lv - (Cp_l - Cp_v) (t - T0)"""
+    delta_cp = Cp_l - Cp_v
+    heat_power = delta_cp / Rv
+    # All the terms which don't depend on t in the logarithm of e
+    constant = np.log(sat_pressure_0c) + heat_power * np.log(T0) + (Lv / T0 + delta_cp) / Rv
+    e = np.log(t)
+    e *= -heat_power
+    e += constant
+    e -= ((Lv + delta_cp * T0) / Rv) / t
+    return np.exp(e, out=e)
+
+
+def dewpoint(e):
+    """Dewpoint (K) from the vapor pressure e (Pa), as in metpy (Bolton 1980)"""
+    val = e / sat_pressure_0c
+    np.log(val, out=val)
+    denominator = 17.67 - val
+    val *= 243.5
+    val /= denominator
+    val += zero_degc
+    return val
+
+
+def dewpoint_from_relative_humidity(t, rh):
+    """Dewpoint (K) from temperature t (K) and relative humidity rh (0-1)"""
+    e = saturation_vapor_pressure(t)
+    e *= rh
+    return dewpoint(e)
+
+
+def potential_temperature(p, t):
+    """Potential temperature (K) from pressure p (Pa) and temperature t (K)"""
+    factor = np.divide(P0, p)
+    factor **= kappa
+    return factor * t
+
+
+def equivalent_potential_temperature(p, t, td):
+    """Equivalent potential temperature (K) from pressure p (Pa), temperature
+    t (K) and dewpoint td (K), as in metpy (Bolton 1980):
+    theta_e = t (P0 / (p - e))^kappa (t / t_l)^(0.28 r) exp(r (1 + 0.448 r) (3036 / t_l - 1.78))
+    with e and r the saturation vapor pressure and mixing ratio at td and t_l the
+    temperature at the lifting condensation level. The three factors after t
+    are computed as a single exponential."""
+    e = saturation_vapor_pressure(td)
+    # Saturation mixing ratio at the dewpoint, undefined where e >= p
+    dry = p - e
+    r = e
+    r *= epsilon
+    r /= dry
+    r[dry <= 0] = np.nan
+    # kappa log(P0 / (p - e))
+    exponent = np.log(dry, out=dry)
+    exponent *= -kappa
+    exponent += kappa * np.log(P0)
+    # Temperature at the lifting condensation level
+    t_l = np.log(t / td)
+    t_l /= 800.
+    t_l += 1. / (td - 56.)
+    np.divide(1., t_l, out=t_l)
+    t_l += 56.
+    # 0.28 r log(t / t_l)
+    term = np.divide(t, t_l)
+    np.log(term, out=term)
+    term *= r
+    term *= 0.28
+    exponent += term
+    # r (1 + 0.448 r) (3036 / t_l - 1.78)
+    np.divide(3036., t_l, out=t_l)
+    t_l -= 1.78
+    t_l *= r
+    np.multiply(r, 0.448, out=term)
+    term += 1.
+    t_l *= term
+    exponent += t_l
+    del term, t_l
+    np.exp(exponent, out=exponent)
+    exponent *= t
+    return exponent
+
+
+def blocks(out, *arrays):
+    """Flat slices of out and of arrays (with the same shape) of block_size
+    elements, so that the temporaries of the simple formulas below, which are
+    limited by the memory bandwidth, stay in the cache of the CPU"""
+    flat = [a.reshape(-1) for a in (out,) + arrays]
+    for start in range(0, out.size, block_size):
+        yield [a[start:start + block_size] for a in flat]
+
+
+def wind_speed(u, v, scale=1.):
+    """Wind speed from its components u and v, times scale (e.g. to convert it,
+    see conversion)"""
+    u, v = (np.ascontiguousarray(a) for a in np.broadcast_arrays(u, v))
+    speed = np.empty(u.shape, dtype=np.result_type(u, v))
+    buffer = np.empty(min(block_size, speed.size), dtype=speed.dtype)
+    for out, u_block, v_block in blocks(speed, u, v):
+        squared = buffer[:out.size]
+        np.multiply(u_block, u_block, out=out)
+        np.multiply(v_block, v_block, out=squared)
+        out += squared
+        np.sqrt(out, out=out)
+        if scale != 1:
+            out *= scale
+    return speed
+
+
+def geopotential_to_height(z):
+    """Height (m) from the geopotential z (m2 s-2), as in metpy:
+    z Re / (g Re - z)"""
+    z = np.ascontiguousarray(z)
+    height = np.empty_like(z)
+    buffer = np.empty(min(block_size, z.size), dtype=z.dtype)
+    for out, z_block in blocks(height, z):
+        denominator = buffer[:out.size]
+        np.subtract(g * Re, z_block, out=denominator)
+        np.multiply(z_block, Re, out=out)
+        out /= denominator
+    return height
+
+
+def conversion(from_units, to):
+    """Scale and offset converting values in from_units to units to, for
+    units which are a linear function of each other, computed by pint on scalars"""
+    offset = units.Quantity(0., from_units).to(to).magnitude
+    return units.Quantity(1., from_units).to(to).magnitude - offset, offset
+
+
+def units_name(name):
+    """Full name of the units name (e.g. kilometer_per_hour for kph), as metpy
+    writes it in the units attribute"""
+    return str(units.Quantity(1., name).units)
+
+
+def convert_units(da, to):
+    """Same as da.metpy.convert_units(to).metpy.dequantify(), for DataArrays
+    (also lazy ones) with units attributes which are a linear function of to
+    (e.g. K and degC, Pa and hPa, m s-1 and kph): the scale and offset are
+    computed by pint on scalars only and the values keep the dtype of da"""
+    scale, offset = conversion(da.attrs['units'], to)
+    converted = da * scale
+    if offset != 0:
+        converted += offset
+    converted = converted.astype(da.dtype, copy=False)
+    converted.attrs = dict(da.attrs, units=units_name(to))
+    return converted
+
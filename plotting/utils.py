@@ -17,8 +17,16 @@ import re
 from matplotlib.image import imread as read_png
 import requests
 import json
+from functools import partial
+import hashlib
+import inspect
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+from domains import proj_defs
+import catalog
+import field_cache
+import point_store
+import run_store
 
 import warnings
 warnings.filterwarnings(
@@ -35,16 +43,43 @@ else:
     folder = '/home/ekman/ssd/guido/icon-d2/'
 folder_images = folder
 chunks_size = 10
+# Bytes of the HDF5 chunk cache of every variable when reading NETCDF4 files,
+# enough to hold a few steps of the whole domain
+chunk_cache_size = 64 * 1024 * 1024
 processes = 4
+# Memory available to every plotting process: the RAM shared by the
+# N_CONCUR_PROCESSES scripts running at the same time (MEMORY_BUDGET_MB overrides it)
+if 'MEMORY_BUDGET_MB' in os.environ:
+    memory_budget = int(os.environ['MEMORY_BUDGET_MB']) * 1024 * 1024
+else:
+    memory_budget = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') \
+        // int(os.environ.get('N_CONCUR_PROCESSES', 3))
 figsize_x = 11
 figsize_y = 9
 invariant_file = folder+'hsurf_*.nc'
+# When the run is processed progressively (see progressive_run.py) only
+# these forecast hours are plotted
+if 'PLOT_FORECAST_HOURS' in os.environ:
+    forecast_hours = [int(h) for h in os.environ['PLOT_FORECAST_HOURS'].split(',')]
+else:
+    forecast_hours = None
+# Fields derived once per run by read_derived, next to the data of the run
+derived_folder = os.path.join(folder, 'derived')
+# Print the plan of every read_dataset call (see ReadPlan.explain)
+explain_reads = os.environ.get('EXPLAIN_READS', '0') == '1'
 
 if "HOME_FOLDER" in os.environ:
     home_folder = os.environ['HOME_FOLDER']
 else:
     home_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
+# Climatology of the soil saturation (variable soil_saturation, on its own lat/lon
+# grid), regridded once onto the grid of the data by static_fields.py
+soil_saturation_file = os.environ.get('SOIL_SATURATION_FILE',
+                                      home_folder + '/plotting/soil_saturation.nc')
+# Static fields prepared on the grid of the data (see static_fields.py)
+static_folder = os.path.join(folder, 'static')
+
 # Options for savefig
 options_savefig = {
     'dpi': 100,
@@ -110,58 +145,6 @@ WMO_GLYPH_LOOKUP_PNG = {
     '95': '25',
 }
 
-proj_defs = {
-    'nord':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 4,
-        'llcrnrlat': 50,
-        'urcrnrlon': 12,
-        'urcrnrlat': 56,
-        'resolution': 'i',
-        'epsg': 4269
-    },
-    'it':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 5.5,
-        'llcrnrlat': 43.5,
-        'urcrnrlon': 14.5,
-        'urcrnrlat': 48,
-        'resolution': 'i',
-        'epsg': 4269
-    },
-    'de':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 4.5,
-        'llcrnrlat': 46.5,
-        'urcrnrlon': 16,
-        'urcrnrlat': 56,
-        'resolution': 'i',
-        'epsg': 4269
-    },
-    'north_sea':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': 0,
-        'llcrnrlat': 50,
-        'urcrnrlon': 10,
-        'urcrnrlat': 58,
-        'resolution': 'i',
-    },
-    'domain':
-    {
-        'projection': 'cyl',
-        'llcrnrlon': -3.9,
-        'llcrnrlat': 43.2,
-        'urcrnrlon': 20.3,
-        'urcrnrlat': 58,
-        'resolution': 'i',
-    },
-}
-
-
 def get_weather_icons(ww, time):
     """
     Get the path to a png given the weather representation 
@@ -192,41 +175,308 @@ def get_weather_icons(ww, time):
 
 
 def read_dataset(variables=['T_2M', 'TD_2M'], level=None, projection=None,
-                 engine='scipy', freq='1H'):
-    """Wrapper to initialize the dataset"""
-    # Create the regex for the files with the needed variables
-    variables_search = '('+'|'.join(variables)+')'
-    # Get a list of all the files in the folder
-    # In the future we can use Run/Date to have a more selective glob pattern
-    files = glob(folder+'*.nc')
-    run = pd.to_datetime(re.findall(r'(?:\d{10})', files[0])[0],
-                         format='%Y%m%d%H')
-    # find only the files with the variables that we need
-    needed_files = [f for f in files if re.search(
-        r'/%s(?:_\d{10})' % variables_search, f)]
-    dset = xr.open_mfdataset(needed_files,
-                             preprocess=preprocess,
-                             engine=engine)
-    # NOTE!! Even though we use open_mfdataset, which creates a Dask array, we then
-    # load the dataset into memory since otherwise the object cannot be pickled by
-    # multiprocessing
+                 engine=None, freq='1H'):
+    """Wrapper to initialize the dataset (see ReadPlan)"""
+    plan = ReadPlan(variables, level, projection, engine, freq)
+    if explain_reads:
+        print_message(plan.explain())
+    return plan.dset
+
+
+def read_derived(function, variables, level=None, projection=None,
+                  engine=None, freq='1H'):
+    """Same as function(read_dataset(variables, level, projection)), where function
+    derives new fields from the dataset (e.g. computations.compute_rate, or a
+    partial of it with its arguments), but computed only once per run: the first
+    call applies function on the whole domain of the files and caches the result
+    in derived_folder (see field_cache.FieldCache), every other script and
+    projection asking for the same function of the same inputs maps it from there
+    and selects its domain. The entries are named after the run and the sources
+    read, and the ones of older runs are removed when a new run is cached."""
+    plan = ReadPlan(variables, level, None, engine, freq, layout='maps')
+    if field_cache.enabled and plan.complete:
+        cache = field_cache.FieldCache(plan.run_string, derived_folder)
+        dset = cache.get(derived_key(function, plan, variables, level, freq),
+                         lambda: function(plan.dset))
+        plan.steps.append(('derive', 'derived cache of run %s' % plan.run_string, dset.sizes))
+        if projection:
+            dset = plan.select_domain(dset, projection)
+    else:
+        # The files are still being written (progressive processing): don't cache,
+        # but still derive on the whole domain, as the cached fields are
+        dset = function(plan.dset)
+        plan.steps.append(('derive', 'not cached', dset.sizes))
+        if projection:
+            dset = plan.select_domain(dset, projection)
+    if explain_reads:
+        print_message(plan.explain())
+    return dset
+
+
+def derived_key(function, plan, variables, level, freq):
+    """Key of the result of function on the dataset read by plan: the code of
+    function, the arguments of the read and the identity of its sources"""
+    parts = [repr((variables, level, freq))] + plan.sources
+    # e.g. partial(compute_geopot_height, level=50000)
+    if isinstance(function, partial):
+        parts.append(repr((function.args, sorted(function.keywords.items()))))
+        function = function.func
+    digest = hashlib.blake2b(digest_size=16)
+    for part in [inspect.getsource(function)] + parts:
+        digest.update(part.encode())
+    return 'derived-%s-%s' % (function.__name__, digest.hexdigest())
+
+
+class ReadPlan():
+    """Lazy plan to read variables: the source is opened without loading anything,
+    then the level, the domain of the projection and the time steps are selected
+    before anything else, so that only the chunks (of the files or of the run
+    store) needed by the product are ever read. The resampling to freq is
+    skipped when the data is already at that frequency.
+    The resulting (lazy) dataset is dset, explain() describes the steps."""
+    def __init__(self, variables, level=None, projection=None, engine=None, freq='1H',
+                 layout=None):
+        self.steps = []
+        # Identity of what is read (see derived_key) and whether it is complete,
+        # i.e. not still being written
+        self.sources, self.complete = [], False
+        # How the data is accessed: whole frames for the maps, all the steps
+        # of a few points for the products without projection (meteograms)
+        if layout is None:
+            layout = 'maps' if projection else 'columns'
+        dset, run = self.open(variables, layout, engine)
+        self.run_string = run.strftime('%Y%m%d%H')
+        # NOTE!! The dataset is lazy (dask arrays): it's computed when it's loaded by
+        # the scripts or at the latest when it's written in shared memory for the
+        # Pool workers by chunks_dataset
+        dset = dset.metpy.parse_cf()
+        if level:
+            dset = self.select(dset, 'level %s (nearest)' % level, plev=level, method='nearest')
+        if projection:
+            dset = self.select_domain(dset, projection)
+        if freq:
+            if at_frequency(dset.time, freq):
+                self.steps.append(('time', 'already at %s, not resampled' % freq, dset.sizes))
+            else:
+                dset = dset.resample(time=freq).nearest(tolerance='1H')
+                self.steps.append(('time', 'resampled to %s' % freq, dset.sizes))
+        dset['run'] = run
+
+        # chunk now based on the dimension of the dataset after the subsetting
+        # and on how it is accessed (layout)
+        chunks = chunking(dset, layout)
+        dset = dset.chunk(chunks)
+        self.steps.append(('chunk', '%s: %s' % (layout, ' '.join('%s=%d' % c for c in chunks.items())),
+                           dset.sizes))
+        peak = peak_memory(dset, chunks)
+        self.steps.append(('memory', 'peak ~%d MB (budget %d MB)' % (peak / 2**20, memory_budget / 2**20),
+                           dset.sizes))
+        if peak > memory_budget:
+            print_message('Reading %s needs ~%d MB, more than the budget of %d MB' % (
+                ', '.join(variables), peak / 2**20, memory_budget / 2**20))
+        self.dset = dset
+
+    def open(self, variables, layout, engine):
+        store = open_run_store(variables, layout)
+        if store is not None:
+            dset, run, source = store
+            path = run_store.latest_store(folder)
+            self.sources = [field_cache.file_key(os.path.join(path, '.zmetadata'))]
+            self.complete = True
+        else:
+            run_string, needed_files, formats = find_files(variables)
+            run = pd.to_datetime(run_string, format='%Y%m%d%H')
+            self.sources = [field_cache.file_key(f) for f in needed_files]
+            # Files are added to the catalog once they are complete
+            self.complete = formats is not None
+            if engine is None:
+                engine = detect_engine(needed_files, formats)
+            if formats is not None and field_cache.enabled:
+                # The files in the catalog are complete: decode them only once
+                # for all the plotting processes (see field_cache.py)
+                cache = field_cache.FieldCache(run_string)
+                dset = xr.merge([cache.get(field_cache.file_key(f), partial(load_file, f, engine))
+                                 for f in needed_files])
+                source = 'field cache of %d files (%s)' % (len(needed_files), engine)
+            else:
+                # chunks={} keeps the chunks of the files (one per step and level for
+                # NETCDF4) so that only the chunks needed after the subsetting are read
+                dset = xr.open_mfdataset(needed_files,
+                                         preprocess=preprocess,
+                                         engine=engine,
+                                         chunks={},
+                                         **backend_options(engine))
+                source = '%d files (%s)' % (len(needed_files), engine)
+        self.steps.append(('open', '%s of run %s: %s' % (source, run.strftime('%Y%m%d%H'),
+                                                         ', '.join(variables)), dset.sizes))
+        return dset, run
+
+    def select(self, dset, description, method=None, **indexers):
+        dset = dset.sel(method=method, **indexers)
+        self.steps.append(('select', description, dset.sizes))
+        return dset
+
+    def select_domain(self, dset, projection):
+        proj_options = proj_defs[projection]
+        return self.select(dset, 'domain of %s' % projection,
+                           lat=slice(proj_options['llcrnrlat'],
+                                     proj_options['urcrnrlat']),
+                           lon=slice(proj_options['llcrnrlon'],
+                                     proj_options['urcrnrlon']))
+
+    def explain(self):
+        """The steps of the plan with the size of the dataset after each"""
+        lines = ['read_dataset plan:']
+        for step, description, sizes in self.steps:
+            lines.append('  %-7s %-60s %s' % (step, description,
+                                              ' '.join('%s=%d' % s for s in sizes.items())))
+        return '\n'.join(lines)
+
+
+def chunking(dset, layout='maps', budget=None):
+    """Chunks of dset for the access pattern of layout (as in the run store),
+    as large as possible while every thread of dask keeps a chunk of every
+    variable, and the result, within 1/4 of the memory budget:
+    - maps: whole frames (all the levels) and as many time steps as fit
+    - columns: all the steps and levels of square tiles of points"""
+    budget = budget if budget else memory_budget
+    threads = os.cpu_count() or 1
+    data_vars = list(dset.data_vars.values())
+    target = max(budget // (4 * 2 * threads * max(len(data_vars), 1)), 1)
+    itemsize = max([v.dtype.itemsize for v in data_vars] or [4])
+    other = int(np.prod([n for d, n in dset.sizes.items() if d not in ('time', 'lat', 'lon')]))
+    n_time, n_lat, n_lon = (dset.sizes.get(d, 1) for d in ('time', 'lat', 'lon'))
+    if layout == 'maps':
+        steps = target // max(itemsize * other * n_lat * n_lon, 1)
+        chunks = {'time': int(np.clip(steps, 1, max(n_time, 1))), 'lat': -1, 'lon': -1}
+    else:
+        tile = int(np.sqrt(target // max(itemsize * other * n_time, 1)))
+        chunks = {'time': -1, 'lat': int(np.clip(tile, 1, max(n_lat, 1))),
+                  'lon': int(np.clip(tile, 1, max(n_lon, 1)))}
+    return {d: (dset.sizes[d] if c == -1 else c) for d, c in chunks.items() if d in dset.sizes}
+
+
+def peak_memory(dset, chunks):
+    """Estimate (bytes) of the memory needed to load dset: all of it, as the
+    scripts do, plus the chunks being computed by the threads of dask"""
+    threads = os.cpu_count() or 1
+    in_flight = 0
+    for var in dset.data_vars.values():
+        shape = [min(chunks.get(d, n), n) for d, n in var.sizes.items()]
+        in_flight += var.dtype.itemsize * int(np.prod(shape))
+    return dset.nbytes + 2 * threads * in_flight
+
+
+def at_frequency(times, freq):
+    """True if times are already evenly spaced at freq, without gaps and aligned
+    to it, so that resampling them to freq would not change anything"""
+    times = pd.DatetimeIndex(times.values)
+    step = pd.Timedelta(freq)
+    if len(times) == 0 or (times[0] - pd.Timestamp(0)) % step != pd.Timedelta(0):
+        return False
+    return bool((np.diff(times.values) == step.to_timedelta64()).all())
+
+
+def find_files(variables):
+    """Run (YYYYMMDDHH), paths and formats of the files with variables of the most
+    recent run which has all of them. They are looked up in the catalog of the
+    folder (see catalog.py), written after the ingestion. Without it (e.g. while
+    the files are still being written) the file names are matched instead."""
+    entry = catalog.lookup(folder, variables)
+    if entry is not None:
+        return entry
+    runs = {}
+    variables_search = '('+'|'.join(re.escape(v) for v in variables)+')'
+    for f in glob(folder+'*.nc'):
+        match = re.search(r'/%s_(\d{10})' % variables_search, f)
+        if match:
+            runs.setdefault(match.group(2), {})[match.group(1)] = f
+    complete = [r for r in runs if set(variables) <= set(runs[r])]
+    if not complete:
+        raise FileNotFoundError('No run with all of %s in %s' % (', '.join(variables), folder))
+    run_string = max(complete)
+    return run_string, [runs[run_string][v] for v in variables], None
+
+
+def load_file(path, engine):
+    """Decoded content of the NETCDF file at path"""
+    with xr.open_dataset(path, engine=engine, **backend_options(engine)) as dset:
+        return preprocess(dset).load()
+
+
+def detect_engine(paths, formats=None):
+    """xarray engine to read all paths: scipy if they are all NETCDF3 (no
+    compression), otherwise netcdf4 which reads both NETCDF3 and NETCDF4/HDF5.
+    formats (data models, as in the catalog) spare reading the files."""
+    if formats is not None:
+        return 'scipy' if all(f.startswith('NETCDF3') for f in formats) else 'netcdf4'
+    for path in paths:
+        with open(path, 'rb') as f:
+            if not f.read(4).startswith(b'CDF'):
+                return 'netcdf4'
+    return 'scipy'
+
+
+def backend_options(engine):
+    """Options to open the files with engine, setting the size of the chunk cache
+    of the HDF5 library for the NETCDF4 files"""
+    if engine == 'netcdf4':
+        import netCDF4
+        netCDF4.set_chunk_cache(chunk_cache_size)
+    elif engine == 'h5netcdf':
+        return {'driver_kwds': {'rdcc_nbytes': chunk_cache_size}}
+    return {}
+
+
+def open_run_store(variables, layout='maps'):
+    """Open variables from the Zarr store of the run (see run_store.py) if there is one
+    with all of them, otherwise return None. With layout='columns' (the products
+    without projection, e.g. meteograms) the columns layout is used when available,
+    otherwise the maps one.
+    Returns the dataset, the run and a description of the source."""
+    path = run_store.latest_store(folder)
+    if path is None:
+        return None
+    files_run = catalog.latest_run(folder)
+    if files_run is None:
+        files_runs = re.findall(r'_(\d{10})_', ' '.join(glob(folder+'*.nc')))
+        files_run = max(files_runs) if files_runs else None
+    # Don't use the store of an older run
+    if files_run is not None and files_run > run_store.store_run(path):
+        return None
+    layouts = ['columns', 'maps'] if layout == 'columns' else ['maps']
+    for store_layout in layouts:
+        if set(variables) <= set(run_store.store_variables(path, store_layout)):
+            cache = field_cache.FieldCache(run_store.store_run(path)) if field_cache.enabled else None
+            dset = run_store.open_variables(path, variables, store_layout, cache=cache)
+            return dset, pd.to_datetime(run_store.store_run(path), format='%Y%m%d%H'), \
+                'run store %s (%s)' % (os.path.basename(path), store_layout)
+    return None
+
+
+def open_point_store(variables):
+    """Point store of the run (see point_store.py) if there is one with all
+    variables and not older than the files, otherwise None"""
+    path = point_store.latest_store(folder)
+    if path is None:
+        return None
+    files_run = catalog.latest_run(folder)
+    if files_run is not None and files_run > point_store.store_run(path):
+        return None
+    points = point_store.PointStore(path)
+    if not set(variables) <= set(points.variables()):
+        return None
+    return points
+
+
+def read_point(points, variables, lat, lon, freq='1H'):
+    """Same as read_dataset followed by the selection of the nearest grid point
+    to lat, lon, but reading only that point from the point store points"""
+    dset = points.read(variables, lat, lon)
     dset = dset.metpy.parse_cf()
-    if freq:
+    if freq and not at_frequency(dset.time, freq):
         dset = dset.resample(time=freq).nearest(tolerance='1H')
-    if level:
-        dset = dset.sel(plev=level, method='nearest')
-    if projection:
-        proj_options = proj_defs[projection]
-        dset = dset.sel(lat=slice(proj_options['llcrnrlat'],
-                                  proj_options['urcrnrlat']),
-                        lon=slice(proj_options['llcrnrlon'],
-                                  proj_options['urcrnrlon']))
-    dset['run'] = run
-
-    # chunk now based on the dimension of the dataset after the subsetting
-    dset = dset.chunk({'time': round(len(dset.time) / 10),
-                       'lat': round(len(dset.lat) / 4),
-                       'lon': round(len(dset.lon) / 4)})
+    dset['run'] = pd.to_datetime(point_store.store_run(points.path), format='%Y%m%d%H')
 
     return dset
 
@@ -368,11 +618,29 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def ready_steps(ds, hours):
+    """Mask of the time steps of ds to plot when only the forecast hours are
+    ready (see progressive_run.py). A step stands for the hours since the
+    previous one (e.g. 24 for the daily products resampled to 24H), so it's
+    plotted when one of them is in hours, and all of them are ready."""
+    _, _, cum_hour = get_time_run_cum(ds)
+    previous = np.append(cum_hour[0] - 1, cum_hour[:-1])
+    hours = np.asarray(hours)
+    return np.array([h <= hours.max() and bool(((hours > p) & (hours <= h)).any())
+                     for p, h in zip(previous, cum_hour)], dtype=bool)
+
+
 def chunks_dataset(ds, n):
     """Same as 'chunks' but for the time dimension in
-    a dataset"""
+    a dataset. The dataset is written once in shared memory and every chunk
+    is passed to the Pool workers as a field_cache.SharedChunk (path and time
+    slice), which is unpickled there as the Dataset of the chunk, mapped
+    without copies"""
+    if forecast_hours is not None:
+        ds = ds.isel(time=ready_steps(ds, forecast_hours))
+    path = field_cache.share_dataset(ds)
     for i in range(0, len(ds.time), n):
-        yield ds.isel(time=slice(i, i + n))
+        yield field_cache.SharedChunk(path, i, i + n)
 
 
 # Annotation run, models
@@ -0,0 +1,159 @@
+"""Process a run progressively, as its forecast steps are published on the server.
+
+The server is polled every poll_interval seconds: new files are decoded in memory
+into the NETCDF files (written in place, see ingest.VariableStore) and, as soon as
+all the inputs of a plotting script are available for some new steps, the script
+is started for every projection with PLOT_FORECAST_HOURS set to these steps only.
+This way the first maps of a run are available minutes after the publication of
+the first steps, instead of after the whole run.
+
+    python progressive_run.py -p de it nord -s plot_cape.py plot_tmax.py
+
+The variables to ingest are the ones read by the scripts (see planner.py).
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import pandas as pd
+
+import download_dwd
+import catalog
+import ingest
+import planner
+
+# Seconds between two checks of the server
+poll_interval = 60
+# Give up if nothing new appears on the server for this long
+max_wait = 3 * 3600
+forecast_steps = range(0, 49)
+# Maximum number of plotting scripts running at the same time
+max_plot_jobs = 3
+
+
+def contiguous_hours(hours):
+    """Hours without gaps from the first one available (some variables,
+    like the maximum temperature, don't have the first step)"""
+    contiguous = []
+    for h in forecast_steps:
+        if h in hours:
+            contiguous.append(h)
+        elif contiguous:
+            break
+    return set(contiguous)
+
+
+def ready_hours(stores, variables, run):
+    """Forecast hours which can be plotted given the steps already ingested.
+    An hour is ready when it and the following one are available for all the
+    variables without gaps since the start of the run, so that also the rates
+    (which use the neighbouring steps) and the accumulations are correct."""
+    # Products which only read invariants are ready at every hour
+    hours = set(forecast_steps)
+    for var in variables:
+        hours &= contiguous_hours(set(
+            ((stores[var].complete_times() - run) / pd.Timedelta('1 hour')).astype(int)))
+    last = forecast_steps[-1]
+    return sorted(h for h in hours if h + 1 in hours or h == last)
+
+
+class ProgressiveRun():
+    def __init__(self, run_string, scripts, projections):
+        self.run_string = run_string
+        self.run = pd.to_datetime(run_string, format='%Y%m%d%H')
+        # Cheapest products first, so that they are plotted first
+        self.scripts, plan = planner.make_plan(scripts)
+        self.products = {s: [v for v in planner.product_needs(s)
+                             if planner.get_kind(v) != 'invariant'] for s in self.scripts}
+        self.projections = projections
+        # The invariants are downloaded before starting
+        self.plan = {p['var']: p for p in plan if p['kind'] != 'invariant'}
+        self.variables = list(self.plan)
+        times = [self.run + pd.Timedelta(hours=h) for h in forecast_steps]
+        self.stores = {var: ingest.VariableStore(
+            download_dwd.output_file(var, run_string), times, levels=p['levels'],
+            in_place=True, crop=download_dwd.crop_bbox) for var, p in self.plan.items()}
+        self.ingested_urls = set()
+        self.plotted = {s: set() for s in self.scripts}
+        self.plot_semaphore = asyncio.Semaphore(max_plot_jobs)
+        self.plot_tasks = []
+
+    async def ingest_new_files(self, session):
+        """Ingest the files published since the last check, return their number"""
+        async def ingest_variable(var):
+            url = '%s%s/%s/' % (download_dwd.base_url, self.run_string[-2:], var)
+            kind, levels = self.plan[var]['kind'], self.plan[var]['levels']
+            urls = await download_dwd.list_urls(session, url, download_dwd.file_pattern(
+                var, kind, self.run_string, levels or download_dwd.levels_3d))
+            new_urls = [u for u in urls if u not in self.ingested_urls]
+            results = await asyncio.gather(*[download_dwd.fetch_and_decode(session, u, self.stores[var])
+                                             for u in new_urls], return_exceptions=True)
+            # Files which failed are tried again at the next check
+            ingested = [u for u, r in zip(new_urls, results) if not isinstance(r, Exception)]
+            self.ingested_urls.update(ingested)
+            return len(ingested)
+
+        results = await asyncio.gather(*[ingest_variable(var) for var in self.variables],
+                                       return_exceptions=True)
+        return sum(r for r in results if not isinstance(r, Exception))
+
+    async def plot(self, script, projection, hours):
+        env = dict(os.environ, PLOT_FORECAST_HOURS=','.join(str(h) for h in hours))
+        async with self.plot_semaphore:
+            process = await asyncio.create_subprocess_exec('python', script, projection, env=env)
+            await process.wait()
+
+    def launch_plots(self):
+        for script in self.scripts:
+            hours = [h for h in ready_hours(self.stores, self.products[script], self.run)
+                     if h not in self.plotted[script]]
+            if not hours:
+                continue
+            print('%s: plotting forecast hours %s' % (script, hours))
+            self.plotted[script].update(hours)
+            for projection in self.projections:
+                self.plot_tasks.append(asyncio.ensure_future(self.plot(script, projection, hours)))
+
+    def finished(self):
+        return all(forecast_steps[-1] in self.plotted[s] for s in self.scripts)
+
+    async def process(self):
+        last_new = time.time()
+        async with download_dwd.create_session() as session:
+            while not self.finished():
+                if await self.ingest_new_files(session) > 0:
+                    last_new = time.time()
+                    self.launch_plots()
+                elif time.time() - last_new > max_wait:
+                    print('No new files in %d s, giving up' % max_wait)
+                    break
+                if not self.finished():
+                    await asyncio.sleep(poll_interval)
+        for store in self.stores.values():
+            store.close()
+        # Until now the scripts found the files growing in place by their names
+        catalog.add_files('.', self.run_string, {
+            download_dwd.file_variable(s.path, self.run_string): s.path
+            for s in self.stores.values() if os.path.isfile(s.path)})
+        await asyncio.gather(*self.plot_tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--projections', nargs='+', default=['de', 'it', 'nord'])
+    parser.add_argument('-s', '--scripts', nargs='+', required=True,
+                        help='Plotting scripts to run, as in copy_data.run')
+    parser.add_argument('-r', '--run', default=None,
+                        help='Run as YYYYMMDDHH, defaults to the one in the environment')
+    args = parser.parse_args()
+
+    run_string = args.run if args.run else download_dwd.get_run_string()
+    _, plan = planner.make_plan(args.scripts)
+    asyncio.run(download_dwd.download_plan([p for p in plan if p['kind'] == 'invariant'],
+                                           run_string, in_memory=True))
+    asyncio.run(ProgressiveRun(run_string, args.scripts, args.projections).process())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Computations of the derived fields (plotting/computations.py) against metpy."""
+import os
+import sys
+
+import metpy.calc as mpcalc
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'plotting'))
+os.environ.setdefault('MAPBOX_KEY', '')
+from computations import smooth_n_point
+
+
+def mslp(shape=(3, 40, 50), seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:shape[-2], 0:shape[-1]]
+    field = 101300 + 1500 * np.sin(y / 9.) * np.cos(x / 12.)
+    return (field + rng.normal(scale=30, size=shape)).astype(np.float32)
+
+
+@pytest.mark.parametrize('n', [5, 9])
+@pytest.mark.parametrize('passes', [1, 3, 10])
+def test_smooth_n_point(n, passes):
+    data = mslp()
+    expected = np.stack([np.asarray(mpcalc.smooth_n_point(frame, n=n, passes=passes)) for frame in data])
+    result = smooth_n_point(data, n=n, passes=passes)
+    assert result.dtype == data.dtype
+    np.testing.assert_allclose(result, expected, rtol=1e-6)
+    # The input is not modified
+    np.testing.assert_array_equal(data, mslp())
+
+
+@pytest.mark.parametrize('n', [5, 9])
+def test_smooth_n_point_nans(n):
+    data = mslp()
+    data[:, 10, 20] = np.nan
+    data[1, 0, 5] = np.nan
+    expected = np.stack([np.asarray(mpcalc.smooth_n_point(frame, n=n, passes=2)) for frame in data])
+    result = smooth_n_point(data, n=n, passes=2)
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected, rtol=1e-6, equal_nan=True)
+
+
+@pytest.mark.parametrize('n', [5, 9])
+def test_smooth_n_point_fortran_order(n):
+    """Also when the leading dimensions (e.g. time and level) can't be merged without a copy"""
+    data = mslp((2, 3, 40, 50))
+    expected = smooth_n_point(data, n=n, passes=3)
+    for other in (np.asfortranarray(data), data.transpose(1, 0, 2, 3)):
+        result = smooth_n_point(other, n=n, passes=3)
+        assert not np.allclose(result, other)
+        np.testing.assert_array_equal(result, smooth_n_point(np.ascontiguousarray(other), n=n, passes=3))
+    np.testing.assert_array_equal(smooth_n_point(np.asfortranarray(data), n=n, passes=3), expected)
+
+
+def test_smooth_n_point_invalid():
+    with pytest.raises(ValueError):
+        smooth_n_point(mslp(), n=7)
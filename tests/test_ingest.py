@@ -0,0 +1,59 @@
+"""Conversion of GRIB files into NETCDF (ingest.py), with several variables
+written at the same time from threads as download_dwd does."""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+root = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+import ingest
+import mock_dwd_server
+
+run = pd.Timestamp('2021-01-01 00:00')
+shape = (60, 80)
+
+
+def write_grib_files(folder, var, steps):
+    files = []
+    for step in steps:
+        path = os.path.join(folder, '%s_%03d.grib2' % (var, step))
+        with open(path, 'wb') as f:
+            f.write(mock_dwd_server.grib_message(step, mock_dwd_server.short_names[var], shape=shape))
+        files.append(path)
+    return files
+
+
+def test_convert_files_concurrently(tmp_path):
+    """Compressed files of 8 variables converted at the same time (HDF5 is not thread-safe)"""
+    steps = range(6)
+    times = [run + pd.Timedelta(hours=s) for s in steps]
+    variables = ['t_2m', 'td_2m', 'u_10m', 'v_10m', 'pmsl', 'tot_prec', 'fi', 'relhum']
+    grib_files = {var: write_grib_files(str(tmp_path), var, steps) for var in variables}
+
+    def convert(var):
+        store = ingest.VariableStore(str(tmp_path / ('%s.nc' % var)), times,
+                                     compression=ingest.compressions['zlib'])
+        ingest.convert_files(grib_files[var], store, workers=4)
+
+    with ThreadPoolExecutor(len(variables)) as pool:
+        list(pool.map(convert, variables))
+    for var in variables:
+        with xr.open_dataset(tmp_path / ('%s.nc' % var)) as dset:
+            values = dset[mock_dwd_server.short_names[var]]
+            assert values.shape == (len(steps), shape[0], shape[1])
+            assert np.isfinite(values.values).all()
+            assert not os.path.exists(tmp_path / ('%s.nc.part' % var))
+
+
+def test_discard(tmp_path):
+    path = str(tmp_path / 't_2m.nc')
+    store = ingest.VariableStore(path, [run], compression=ingest.compressions['zlib'])
+    ingest.decode_file(write_grib_files(str(tmp_path), 't_2m', [0])[0], store)
+    store.discard()
+    assert not os.path.exists(path + '.part') and not os.path.exists(path)
+    assert not store.append({'time': run})
@@ -0,0 +1,91 @@
+"""Kinematics on the grid metrics (plotting/kinematics.py) against metpy.calc
+on DataArrays with a latitude_longitude grid, which applies the same map factors."""
+import os
+import sys
+
+import metpy.calc as mpcalc
+import numpy as np
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'plotting'))
+os.environ.setdefault('MAPBOX_KEY', '')
+import kinematics
+from computations import compute_convergence, compute_vorticity
+
+lat = np.linspace(43.18, 56.2, 60)
+lon = np.linspace(356.06, 380.34, 50)
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    rng = np.random.default_rng(0)
+    shape = (3, 2, len(lat), len(lon))
+    y, x = np.meshgrid(np.radians(lat), np.radians(lon), indexing='ij')
+    fields = {'u': 10 * np.sin(3 * y) * np.cos(5 * x), 'v': 8 * np.cos(4 * y) * np.sin(2 * x),
+              't': 280 + 10 * np.sin(2 * y + x)}
+    units = {'u': 'm/s', 'v': 'm/s', 't': 'K'}
+    dims = ('time', 'plev', 'lat', 'lon')
+    dset = xr.Dataset({name: (dims, (field + rng.normal(size=shape)).astype(np.float32), {'units': units[name]})
+                       for name, field in fields.items()},
+                      coords={'plev': [85000., 50000.], 'lat': ('lat', lat, {'units': 'degrees_north'}),
+                              'lon': ('lon', lon, {'units': 'degrees_east'})})
+    return dset.metpy.assign_crs(grid_mapping_name='latitude_longitude')
+
+
+@pytest.fixture(scope='module')
+def grid():
+    return kinematics.GridMetrics(lat, lon)
+
+
+def assert_close(result, expected, rtol=1e-5):
+    expected = expected.metpy.dequantify().values
+    np.testing.assert_allclose(result, expected, atol=rtol * np.abs(expected).max())
+
+
+def test_derivative():
+    x = np.cumsum(np.random.default_rng(1).uniform(0.5, 2, 20))
+    weights = kinematics.stencil_weights(np.diff(x))
+    # Exact for polynomials of second degree, also on the edges
+    f = 3 * x ** 2 - 2 * x + 1
+    np.testing.assert_allclose(kinematics.derivative(f, weights, -1), 6 * x - 2)
+    np.testing.assert_allclose(kinematics.derivative(f[:, None], weights[:, :, None], -2)[:, 0], 6 * x - 2)
+
+
+def test_divergence_vorticity(dataset, grid):
+    u, v = dataset['u'].values, dataset['v'].values
+    assert_close(kinematics.divergence(u, v, grid), mpcalc.divergence(dataset['u'], dataset['v']))
+    assert_close(kinematics.vorticity(u, v, grid), mpcalc.vorticity(dataset['u'], dataset['v']))
+
+
+def test_deformation(dataset, grid):
+    shearing, stretching, total = kinematics.deformation(dataset['u'].values, dataset['v'].values, grid)
+    assert_close(shearing, mpcalc.shearing_deformation(dataset['u'], dataset['v']))
+    assert_close(stretching, mpcalc.stretching_deformation(dataset['u'], dataset['v']))
+    assert_close(total, mpcalc.total_deformation(dataset['u'], dataset['v']))
+
+
+def test_advection(dataset, grid):
+    result = kinematics.advection(dataset['t'].values, dataset['u'].values, dataset['v'].values, grid)
+    assert_close(result, mpcalc.advection(dataset['t'], dataset['u'], dataset['v']), rtol=1e-4)
+
+
+def test_cached_metrics(tmp_path, monkeypatch, grid):
+    monkeypatch.setattr(kinematics, 'metrics_folder', str(tmp_path))
+    monkeypatch.setattr(kinematics, '_grids', {})
+    computed = kinematics.GridMetrics.for_grid(lat, lon)
+    assert len(os.listdir(tmp_path)) == 1
+    kinematics._grids.clear()
+    loaded = kinematics.GridMetrics.for_grid(lat, lon)
+    assert loaded is not computed
+    for name in kinematics.GridMetrics.names:
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(grid, name))
+
+
+def test_computations(dataset, grid, tmp_path, monkeypatch):
+    monkeypatch.setattr(kinematics, 'metrics_folder', str(tmp_path))
+    dset = dataset.metpy.dequantify().rename({'u': '10u', 'v': '10v'}).chunk({'time': 1})
+    expected = kinematics.divergence(dataset['u'].values, dataset['v'].values, grid)
+    np.testing.assert_allclose(compute_convergence(dset)['conv'].values, -expected)
+    expected = kinematics.vorticity(dataset['u'].values, dataset['v'].values, grid)
+    np.testing.assert_allclose(compute_vorticity(dset)['vort'].values, expected)
@@ -0,0 +1,100 @@
+"""The pint-free thermodynamics (plotting/thermo.py) and the computations using
+them against metpy.calc."""
+import os
+import sys
+
+import metpy.calc as mpcalc
+import numpy as np
+import pytest
+import xarray as xr
+from metpy.units import units
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'plotting'))
+os.environ.setdefault('MAPBOX_KEY', '')
+import thermo
+from computations import compute_geopot_height, compute_thetae, compute_wind_speed
+
+rng = np.random.default_rng(0)
+plev = np.array([95000., 85000., 70000., 50000.])
+shape = (3, len(plev), 20, 30)
+t = (300 - 60 * (1 - plev[:, None, None] / 1e5) + rng.normal(scale=5, size=shape)).astype(np.float32)
+rh = rng.uniform(5, 100, shape).astype(np.float32)
+u, v = rng.normal(scale=10, size=(2,) + shape).astype(np.float32)
+z = (9.80665 * (1500 + 4000 * (1 - plev[:, None, None] / 1e5))
+     + rng.normal(scale=50, size=shape)).astype(np.float32)
+
+
+def dataset():
+    dims = ('time', 'plev', 'lat', 'lon')
+    dset = xr.Dataset({'t': (dims, t, {'units': 'K'}), 'r': (dims, rh, {'units': '%'}),
+                       'u': (dims, u, {'units': 'm s-1'}), 'v': (dims, v, {'units': 'm s-1'}),
+                       'z': (dims, z, {'units': 'm**2 s**-2'})},
+                      coords={'plev': ('plev', plev, {'units': 'Pa'})})
+    return dset
+
+
+def test_saturation_vapor_pressure():
+    expected = mpcalc.saturation_vapor_pressure(t * units.K).m_as('Pa')
+    np.testing.assert_allclose(thermo.saturation_vapor_pressure(t), expected, rtol=1e-5)
+
+
+def test_dewpoint_from_relative_humidity():
+    expected = mpcalc.dewpoint_from_relative_humidity(t * units.K, rh / 100. * units.dimensionless).m_as('K')
+    np.testing.assert_allclose(thermo.dewpoint_from_relative_humidity(t, rh / 100.), expected, atol=1e-3)
+
+
+def test_potential_temperature():
+    p = plev[:, None, None]
+    expected = mpcalc.potential_temperature(p * units.Pa, t * units.K).m_as('K')
+    np.testing.assert_allclose(thermo.potential_temperature(p, t), expected, rtol=1e-6)
+
+
+def test_equivalent_potential_temperature():
+    p = plev[:, None, None]
+    td = thermo.dewpoint_from_relative_humidity(t, rh / 100.)
+    expected = mpcalc.equivalent_potential_temperature(p * units.Pa, t * units.K, td * units.K).m_as('K')
+    np.testing.assert_allclose(thermo.equivalent_potential_temperature(p, t, td), expected, atol=0.01)
+
+
+@pytest.mark.parametrize('scale', [1., 3.6])
+def test_wind_speed(scale):
+    expected = mpcalc.wind_speed(u * units('m/s'), v * units('m/s')).m_as('m/s') * scale
+    result = thermo.wind_speed(u, v, scale)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=1e-6)
+    # Broadcast and non contiguous inputs
+    np.testing.assert_allclose(thermo.wind_speed(u[..., ::2], v[0, ..., ::2], scale),
+                               np.hypot(u[..., ::2], v[0, ..., ::2]) * scale, rtol=1e-6)
+
+
+def test_geopotential_to_height():
+    expected = mpcalc.geopotential_to_height(z * units('m**2/s**2')).m_as('m')
+    result = thermo.geopotential_to_height(z)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('name, to', [('t', 'degC'), ('u', 'kph'), ('r', 'dimensionless')])
+def test_convert_units(name, to):
+    da = dataset()[name]
+    expected = da.metpy.convert_units(to).metpy.dequantify()
+    result = thermo.convert_units(da, to)
+    assert result.dtype == da.dtype and result.attrs['units'] == expected.attrs['units']
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-6)
+
+
+def test_computations():
+    dset = dataset()
+    td = mpcalc.dewpoint_from_relative_humidity(dset['t'], dset['r'].metpy.convert_units('dimensionless'))
+    theta_e = mpcalc.equivalent_potential_temperature(dset['plev'] * units.Pa, dset['t'], td)
+    expected = theta_e.metpy.convert_units('degC').metpy.dequantify().transpose(*dset['t'].dims)
+    for chunks in (None, {'time': 1}):
+        data = dset.chunk(chunks) if chunks else dset
+        np.testing.assert_allclose(compute_thetae(data)['theta_e'].values, expected.values, atol=0.01)
+        np.testing.assert_allclose(
+            compute_wind_speed(data)['wind_speed'].values,
+            mpcalc.wind_speed(dset['u'], dset['v']).metpy.convert_units('kph').metpy.dequantify().values,
+            rtol=1e-6)
+        np.testing.assert_allclose(compute_geopot_height(data)['geop'].values,
+                                   mpcalc.geopotential_to_height(dset['z']).metpy.dequantify().values,
+                                   rtol=1e-6)